@@ -0,0 +1,1205 @@
+#!/usr/bin/env python3
+# Benchmarks for control.py, running against the emulated input module from
+# emulator.py. No hardware needed.
+#
+# Usage:
+#   ./benchmark.py
+#   ./benchmark.py connection
+#   ./benchmark.py --json after.json --compare before.json
+import argparse
+import asyncio
+import importlib
+import io
+import json
+import platform
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import serial
+
+import control
+from control import CommandVals, FWK_MAGIC
+from client import Client
+from emulator import FakeDevice
+
+
+def send_command_reopen(command, with_response=False):
+    """Previous behaviour of send_command_raw.
+    Opens a new serial connection for every command"""
+    with serial.Serial(control.SERIAL_DEV, control.SERIAL_BAUDRATE) as s:
+        s.write(command)
+        if with_response:
+            return s.read(control.RESPONSE_SIZE)
+
+
+def wait_for_device():
+    """Query the module. It handles commands in order, so once it replies,
+    everything sent before has been handled."""
+    control.send_command(CommandVals.Version, with_response=True)
+
+
+def commands_per_second(send, duration):
+    """Send brightness commands for `duration` seconds"""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        send(FWK_MAGIC + [CommandVals.Brightness, count % 256])
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def bench_connection(duration):
+    """Commands per second with a new connection per command vs. the pool"""
+    with FakeDevice() as dev:
+        control.SERIAL_DEV = dev.path
+        before = commands_per_second(send_command_reopen, duration)
+        after = commands_per_second(control.send_command_raw, duration)
+        control.SERIAL_POOL.close()
+    return {
+        'reopen_cmds_per_s': before,
+        'pooled_cmds_per_s': after,
+        'speedup': after / before,
+    }
+
+
+def b1_send_columns_reopen(columns):
+    """Previous behaviour of b1image_bl.
+    One command per column, each on a new connection"""
+    for x, column in enumerate(columns):
+        command = FWK_MAGIC + [CommandVals.SetPixelColumn] + list(x.to_bytes(2, 'little')) + list(column)
+        send_command_reopen(command)
+    send_command_reopen(FWK_MAGIC + [CommandVals.FlushFramebuffer])
+
+
+def frames_per_second(send_frame, duration):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        send_frame()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def bench_b1(duration):
+    """Full 300x400 B1 frame uploads per second"""
+    columns = [bytes([x % 256]) * control.B1_COLUMN_BYTES for x in range(control.B1_WIDTH)]
+    with FakeDevice() as dev:
+        control.SERIAL_DEV = dev.path
+        before = frames_per_second(lambda: b1_send_columns_reopen(columns), duration)
+        after = frames_per_second(lambda: control.b1_send_frames([columns]), duration)
+        control.SERIAL_POOL.close()
+    return {
+        'reopen_frames_per_s': before,
+        'batched_frames_per_s': after,
+        'speedup': after / before,
+    }
+
+
+def reference_draw_vals(im):
+    """Previous pure Python implementation of image_bl's conversion"""
+    vals = [0 for _ in range(39)]
+    for i, pixel in enumerate(list(im.getdata())):
+        brightness = sum(pixel) / 3
+        if brightness > 0xFF/2:
+            vals[int(i/8)] |= (1 << i % 8)
+    return vals
+
+
+def reference_grey_cols(im):
+    """Previous pure Python implementation of image_greyscale's conversion"""
+    pixel_values = list(im.getdata())
+    cols = []
+    for x in range(control.WIDTH):
+        vals = [0 for _ in range(control.HEIGHT)]
+        for y in range(control.HEIGHT):
+            vals[y] = control.pixel_to_brightness(pixel_values[x+y*control.WIDTH])
+        cols.append(bytes(vals))
+    return cols
+
+
+def reference_b1_columns(im):
+    """Previous pure Python implementation of b1image_bl's conversion"""
+    pixel_values = list(im.getdata())
+    columns = []
+    for x in range(control.B1_WIDTH):
+        vals = [0 for _ in range(50)]
+        byte = None
+        for y in range(control.B1_HEIGHT):
+            pixel = pixel_values[y*control.B1_WIDTH + x]
+            brightness = sum(pixel) / 3
+            black = brightness < 0xFF/2
+            bit = y % 8
+            if bit == 0:
+                byte = 0
+            if black:
+                byte |= 1 << bit
+            if bit == 7:
+                vals[int(y/8)] = byte
+        columns.append(bytes(vals))
+    return columns
+
+
+def random_image(width, height, seed):
+    from PIL import Image
+    rng = random.Random(seed)
+    return Image.frombytes('RGB', (width, height), rng.randbytes(width * height * 3))
+
+
+def conversions_per_second(convert, im, duration):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        convert(im)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def bench_conversion(duration):
+    """Image to frame conversions per second, NumPy vs. the pure Python reference"""
+    cases = [
+        ('draw', control.WIDTH, control.HEIGHT, control.image_draw_vals, reference_draw_vals),
+        ('grey', control.WIDTH, control.HEIGHT, control.image_grey_cols, reference_grey_cols),
+        ('b1', control.B1_WIDTH, control.B1_HEIGHT, control.b1_image_columns, reference_b1_columns),
+    ]
+    results = {}
+    for name, width, height, convert, reference in cases:
+        im = random_image(width, height, 0)
+        before = conversions_per_second(reference, im, duration)
+        after = conversions_per_second(convert, im, duration)
+        results[f'{name}_reference_per_s'] = before
+        results[f'{name}_numpy_per_s'] = after
+        results[f'{name}_speedup'] = after / before
+    return results
+
+
+def bench_greyscale(duration):
+    """Greyscale frames per second and bytes saved by GreyscaleRenderer,
+    for a dashboard that changes a single column per frame"""
+    cols = [[0] * control.HEIGHT for _ in range(control.WIDTH)]
+    cols[0] = [0xFF] * control.HEIGHT
+    with FakeDevice() as dev:
+        control.SERIAL_DEV = dev.path
+        renderer = control.greyscale_renderer()
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            # Redraw the previous frame, then bump one column
+            renderer.render(cols)
+            cols[4][count % control.HEIGHT] = count % 256
+            renderer.render(cols)
+            count += 2
+        elapsed = time.perf_counter() - start
+        control.SERIAL_POOL.close()
+    stats = renderer.stats()
+    return {
+        'frames_per_s': count / elapsed,
+        'bytes_sent': stats['bytes_sent'],
+        'bytes_saved': stats['bytes_saved'],
+        'saved_percent': 100 * stats['bytes_saved'] / (stats['bytes_sent'] + stats['bytes_saved']),
+    }
+
+
+def reference_matrix_vals(matrix):
+    """Previous implementation of render_matrix's packing"""
+    vals = [0x00 for _ in range(39)]
+    for x in range(9):
+        for y in range(34):
+            i = x + 9*y
+            if matrix[x][y]:
+                vals[int(i/8)] = vals[int(i/8)] | (1 << i % 8)
+    return vals
+
+
+def reference_font_vals(font_items):
+    """Previous implementation of show_font's packing"""
+    vals = [0x00 for _ in range(39)]
+    for digit_i, digit_pixels in enumerate(font_items):
+        offset = digit_i * 7
+        for pixel_x in range(5):
+            for pixel_y in range(6):
+                pixel_value = digit_pixels[pixel_x + pixel_y*5]
+                i = (2+pixel_x) + (9*(pixel_y+offset))
+                if pixel_value:
+                    vals[int(i/8)] = vals[int(i/8)] | (1 << i % 8)
+    return vals
+
+
+def reference_leds_vals(leds):
+    """Previous implementation of light_leds's packing"""
+    vals = [0x00 for _ in range(39)]
+    for byte in range(int(leds / 8)):
+        vals[byte] = 0xFF
+    for i in range(leds % 8):
+        vals[int(leds / 8)] += 1 << i
+    return vals
+
+
+def bench_packing(duration):
+    """Draw payloads packed per second, without sending them"""
+    rng = random.Random(0)
+    matrix = [[rng.randint(0, 1) for _ in range(control.HEIGHT)] for _ in range(control.WIDTH)]
+    font_items = [control.convert_font(c) for c in '12:34']
+
+    def matrix_vals(m):
+        return control.draw_vals(control.matrix_mask(m))
+
+    def font_vals(f):
+        return control.draw_vals(control.font_mask(f))
+
+    def leds_vals(n):
+        return control.draw_vals(control.leds_mask(n))
+
+    def string_vals(text):
+        return list(control.string_draw_vals(text))
+
+    def reference_string_vals(text):
+        return reference_font_vals([control.convert_font(c) for c in text])
+
+    cases = [
+        ('matrix', matrix, matrix_vals, reference_matrix_vals),
+        ('font', font_items, font_vals, reference_font_vals),
+        ('leds', 150, leds_vals, reference_leds_vals),
+        ('string', '12:34', string_vals, reference_string_vals),
+    ]
+    results = {}
+    for name, arg, pack, reference in cases:
+        before = conversions_per_second(reference, arg, duration)
+        after = conversions_per_second(pack, arg, duration)
+        results[f'{name}_reference_fps'] = before
+        results[f'{name}_lut_fps'] = after
+        results[f'{name}_speedup'] = after / before
+    return results
+
+
+def bench_async(duration):
+    """Several animations and queries running at once on one AsyncDevice"""
+
+    async def sweep(dev, set_value, get_value, deadline):
+        count = 0
+        while time.perf_counter() < deadline:
+            for value in range(0, 256, 17):
+                set_value(value)
+                count += 1
+            await get_value()
+            count += 1
+        return count
+
+    async def frames(dev, deadline):
+        count = 0
+        cols = [[0] * control.HEIGHT for _ in range(control.WIDTH)]
+        while time.perf_counter() < deadline:
+            cols[count % control.WIDTH][0] = count % 256
+            dev.draw_greyscale(cols)
+            count += control.WIDTH + 1
+            await asyncio.sleep(0)
+        return count
+
+    async def run():
+        async with control.AsyncDevice(control.SERIAL_DEV) as dev:
+            start = time.perf_counter()
+            deadline = start + duration
+            counts = await asyncio.gather(
+                sweep(dev, dev.brightness, dev.get_brightness, deadline),
+                sweep(dev, dev.set_fps, dev.get_fps, deadline),
+                sweep(dev, dev.set_power_mode, dev.get_power_mode, deadline),
+                frames(dev, deadline),
+            )
+            await dev.drain()
+            return sum(counts) / (time.perf_counter() - start)
+
+    with FakeDevice() as dev:
+        control.SERIAL_DEV = dev.path
+        cmds_per_s = asyncio.run(run())
+    return {
+        'cmds_per_s': cmds_per_s,
+    }
+
+
+def bench_multi(duration):
+    """Discover several emulated modules and draw on a canvas across
+    two LED matrices"""
+    kinds = [control.LED_MATRIX, control.B1_DISPLAY, control.LED_MATRIX, control.C1_MINIMAL]
+    devices = [FakeDevice(kind) for kind in kinds]
+    for dev in devices:
+        dev.start()
+    try:
+        start = time.perf_counter()
+        modules = control.find_modules([dev.path for dev in devices])
+        discovery = time.perf_counter() - start
+
+        with control.ModuleGroup(modules) as group:
+            count = 0
+            cols = [[0] * control.HEIGHT for _ in range(control.WIDTH * len(group.matrices))]
+            start = time.perf_counter()
+            while time.perf_counter() - start < duration:
+                cols[count % len(cols)][0] = count % 256
+                group.draw_canvas_greyscale(cols)
+                count += 1
+            elapsed = time.perf_counter() - start
+        control.SERIAL_POOL.close()
+    finally:
+        for dev in devices:
+            dev.stop()
+    return {
+        'discovery_s': discovery,
+        'canvas_frames_per_s': count / elapsed,
+    }
+
+
+def bench_ticker(duration):
+    """countdown's 100 FPS loop, with the previous fixed sleep vs. Ticker.
+    Reports the achieved rate, jitter, drift and CPU usage."""
+    fps = 100
+    with FakeDevice() as dev:
+        control.SERIAL_DEV = dev.path
+
+        frames = 0
+        cpu = time.process_time()
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            control.light_leds(frames % 306)
+            frames += 1
+            time.sleep(1 / fps)
+        sleep_fps = frames / (time.perf_counter() - start)
+
+        cpu = time.process_time()
+        ticker = control.Ticker(fps)
+        start = time.perf_counter()
+        for tick in ticker:
+            if time.perf_counter() - start >= duration:
+                break
+            control.light_leds(tick % 306)
+        ticker_fps = ticker.ticks / (time.perf_counter() - start)
+        ticker_cpu = (time.process_time() - cpu) / (time.perf_counter() - start)
+        control.SERIAL_POOL.close()
+
+    stats = ticker.stats()
+    return {
+        'target_fps': fps,
+        'sleep_fps': sleep_fps,
+        'ticker_fps': ticker_fps,
+        'ticker_jitter_ms': stats['jitter_ms'],
+        'ticker_max_late_ms': stats['max_late_ms'],
+        'ticker_drift_ms': stats['drift_ms'],
+        'ticker_cpu_percent': 100 * ticker_cpu,
+    }
+
+
+def image_file(im):
+    """PNG of the image in memory, as taken by the image upload functions"""
+    f = io.BytesIO()
+    im.save(f, 'PNG')
+    f.seek(0)
+    return f
+
+
+def uploads_per_second(upload, files, duration):
+    """Upload the files in turn for `duration` seconds"""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        f = files[count % len(files)]
+        f.seek(0)
+        upload(f)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def bench_upload(duration):
+    """End to end image uploads per second, from PNG to the emulated module"""
+    bl = [random_image(control.WIDTH, control.HEIGHT, seed).convert('1') for seed in range(2)]
+    grey = [random_image(control.WIDTH, control.HEIGHT, seed) for seed in range(2)]
+    b1 = [random_image(control.B1_WIDTH, control.B1_HEIGHT, seed).convert('1') for seed in range(2)]
+
+    with FakeDevice() as dev:
+        control.SERIAL_DEV = dev.path
+        results = {}
+        # Alternate between two images, repeated frames are skipped
+        results['image_bl_per_s'] = uploads_per_second(
+            control.image_bl, [image_file(im) for im in bl], duration)
+        results['image_greyscale_per_s'] = uploads_per_second(
+            control.image_greyscale, [image_file(im) for im in grey], duration)
+        results['b1image_bl_per_s'] = uploads_per_second(
+            control.b1image_bl, [image_file(im) for im in b1], duration)
+        control.SERIAL_POOL.close()
+    return results
+
+
+def bench_string(duration):
+    """show_string calls per second, cycling through the strings of a clock"""
+    strings = [f"{h:02}:{m:02}" for h in range(24) for m in range(60)]
+    with FakeDevice() as dev:
+        control.SERIAL_DEV = dev.path
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            control.show_string(strings[count % len(strings)])
+            count += 1
+        elapsed = time.perf_counter() - start
+        control.SERIAL_POOL.close()
+    return {'strings_per_s': count / elapsed}
+
+
+def animation_fps(animation, args, command, dev, duration):
+    """Rate at which an animation running in the background sends `command`"""
+    before = dev.counts.get(command, 0)
+    thread = threading.Thread(target=animation, args=args, daemon=True)
+    start = time.perf_counter()
+    thread.start()
+    time.sleep(duration)
+    control.STOP_THREAD.set()
+    thread.join()
+    elapsed = time.perf_counter() - start
+    wait_for_device()
+    return (dev.counts.get(command, 0) - before) / elapsed
+
+
+def bench_animation(duration):
+    """Frame rates that the built-in animations reach"""
+    # Run longer than the benchmark, it is cancelled before it finishes
+    with FakeDevice() as dev:
+        control.SERIAL_DEV = dev.path
+        results = {
+            'countdown_target_fps': 100,
+            'countdown_fps': animation_fps(control.countdown, [duration * 10], CommandVals.Draw,
+                                           dev, duration),
+            'random_eq_target_fps': 5,
+            'random_eq_fps': animation_fps(control.random_eq, [], CommandVals.Draw,
+                                           dev, duration),
+        }
+        control.SERIAL_POOL.close()
+    return results
+
+
+def reference_eq_vals(vals):
+    """Previous eq(), building a new nested list for every frame"""
+    matrix = [[0 for _ in range(34)] for _ in range(9)]
+    for (col, val) in enumerate(vals[:9]):
+        row = int(34 / 2)
+        above = int(val / 2)
+        below = val - above
+        for i in range(above):
+            matrix[col][row+i] = 0xFF
+        for i in range(below):
+            matrix[col][row-1-i] = 0xFF
+    return bytes(control.draw_vals(control.matrix_mask(matrix)))
+
+
+def bench_framebuffer(duration):
+    """EQ frames per second, new nested list per frame vs. a reused Framebuffer"""
+    fb = control.Framebuffer()
+    rng = random.Random(0)
+    frames = [[rng.randint(0, 33) for _ in range(9)] for _ in range(100)]
+
+    def framebuffer_eq(vals):
+        control.draw_eq(fb, vals)
+        return fb.draw_vals()
+    before = conversions_per_second(lambda i: reference_eq_vals(frames[i % 100]), 0, duration)
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        framebuffer_eq(frames[count % 100])
+        count += 1
+    after = count / (time.perf_counter() - start)
+    return {
+        'reference_eq_fps': before,
+        'framebuffer_eq_fps': after,
+        'speedup': after / before,
+    }
+
+
+def bench_compositor(duration):
+    """EQ, clock and a progress bar on one matrix. Frames sent by the
+    compositor vs. the frames the widgets would send on their own"""
+    with FakeDevice() as dev:
+        control.SERIAL_DEV = dev.path
+        compositor = control.Compositor(fps=10)
+        compositor.add('eq', control.random_eq_layer, fps=5)
+        compositor.add('clock', control.clock_layer, fps=1, blend=control.BLEND_XOR)
+        compositor.add('progress', control.progress_layer(duration), fps=10)
+        stop = threading.Timer(duration, compositor.stop_event.set)
+        stop.start()
+        start = time.perf_counter()
+        compositor.run()
+        elapsed = time.perf_counter() - start
+        wait_for_device()
+        control.SERIAL_POOL.close()
+    stats = compositor.stats()
+    return {
+        'frames_sent_per_s': stats['frames_sent'] / elapsed,
+        'widget_frames_per_s': sum(stats['layer_updates'].values()) / elapsed,
+        'draws_received': dev.counts.get(CommandVals.Draw, 0),
+    }
+
+
+def invocation_ms(argv, runs=5):
+    """Mean wall time of running a command"""
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run(argv, check=True, stdout=subprocess.DEVNULL)
+    return 1000 * (time.perf_counter() - start) / runs
+
+
+def bench_daemon(duration):
+    """Requests per second through the daemon, and the time it takes to
+    change the brightness with client.py vs. running control.py"""
+    with FakeDevice() as dev, tempfile.TemporaryDirectory() as tmp:
+        control.SERIAL_DEV = dev.path
+        path = os.path.join(tmp, 'daemon.sock')
+        daemon = control.CommandDaemon(path)
+        thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+        thread.start()
+        daemon.ready.wait()
+
+        results = {}
+        with Client(path) as client:
+            results['requests_per_s'] = commands_per_second(
+                lambda command: client.send('Brightness', command[3:]), duration)
+            results['queries_per_s'] = commands_per_second(
+                lambda command: client.send('Brightness', response=True), duration)
+            # A burst of brightness changes only sends the last one
+            queue = daemon.queue(dev.path)
+            writes = queue.writes
+            for i in range(100):
+                client.send('Brightness', [i])
+            client.send('Brightness', response=True)
+            results['burst_writes_per_100'] = queue.writes - writes
+
+        def connect_and_send(command):
+            with Client(path) as client:
+                client.send('Brightness', command[3:])
+        results['connections_per_s'] = commands_per_second(connect_and_send, duration)
+
+        results['client_invocation_ms'] = invocation_ms(
+            [sys.executable, 'client.py', '--socket', path, 'Brightness', '50'])
+        results['control_invocation_ms'] = invocation_ms(
+            [sys.executable, 'control.py', '--serial-dev', dev.path, '--brightness', '50'])
+
+        daemon.shutdown()
+        thread.join()
+        control.SERIAL_POOL.close()
+    return results
+
+
+def import_ms(argv):
+    """Time spent importing modules, as reported by -X importtime"""
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + argv, check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    total = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) == 3 and not parts[2].startswith('  ') and parts[1].strip().isdigit():
+            total += int(parts[1])
+    return total / 1000
+
+
+def bench_startup(duration):
+    """Wall and import time of one-shot commands, that skip the full parser,
+    vs. commands that need it and Python itself"""
+    with FakeDevice() as dev:
+        fast = ['control.py', '--serial-dev', dev.path, '--brightness', '50']
+        full = ['control.py', '--serial-dev', dev.path, '--string', '12:34']
+        results = {
+            'python_ms': invocation_ms([sys.executable, '-c', 'pass']),
+            'fast_path_ms': invocation_ms([sys.executable] + fast),
+            'full_parser_ms': invocation_ms([sys.executable] + full),
+            'fast_path_import_ms': import_ms(fast) - import_ms(['-c', 'pass']),
+            'full_parser_import_ms': import_ms(full) - import_ms(['-c', 'pass']),
+        }
+    return results
+
+
+def replay_slider(handle, events):
+    """Replay a slider being dragged back and forth, an event every 2ms.
+    Returns the total and longest time the handler blocked the event loop."""
+    total = longest = 0
+    for i in range(events):
+        value = abs(i % 510 - 255)
+        start = time.perf_counter()
+        handle(value)
+        stall = time.perf_counter() - start
+        total += stall
+        longest = max(longest, stall)
+        time.sleep(0.002)
+    return total, longest
+
+
+def bench_slider(duration):
+    """Brightness slider events sent synchronously vs. through CoalescingWriter.
+    Counts the commands that reach the module and how long the GUI stalled."""
+    events = max(10, int(duration * 400))
+    results = {'events': events}
+    with FakeDevice() as dev:
+        control.SERIAL_DEV = dev.path
+        cases = [
+            ('sync', control.brightness, None),
+            ('coalesced', None, control.CoalescingWriter()),
+        ]
+        for name, handle, writer in cases:
+            if writer is not None:
+                handle = lambda value: writer.put(CommandVals.Brightness, [value])
+            before = dev.counts.get(CommandVals.Brightness, 0)
+            total, longest = replay_slider(handle, events)
+            if writer is not None:
+                writer.close()
+            wait_for_device()
+            results[f'{name}_commands'] = dev.counts[CommandVals.Brightness] - before
+            results[f'{name}_stall_total_ms'] = 1000 * total
+            results[f'{name}_stall_max_ms'] = 1000 * longest
+        control.SERIAL_POOL.close()
+    return results
+
+
+def key_stream(count):
+    """Arrow key events with runs of repeats, like from keys held down"""
+    keys = []
+    while len(keys) < count:
+        keys += [random.choice(list(control.OPPOSITE_DIRECTION))] * random.randint(1, 8)
+    return keys[:count]
+
+
+def key_reader(keys, interval):
+    """read_key for InputPipeline that returns the keys `interval` seconds
+    apart, then None"""
+    it = enumerate(keys)
+    start = time.perf_counter()
+
+    def read_key():
+        (i, key) = next(it, (None, None))
+        if key is not None:
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        return key
+    return read_key
+
+
+def direct_keyscan(keys, interval, latency):
+    """Previous behaviour of the embedded games. The key reading thread sends
+    every key itself. Latency counts from when the key was due."""
+    start = time.perf_counter_ns()
+    for i, key in enumerate(keys):
+        due = start + int(i * interval * 1e9)
+        delay = due - time.perf_counter_ns()
+        if delay > 0:
+            time.sleep(delay / 1e9)
+        control.send_command(CommandVals.GameControl, [key])
+        latency.observe((time.perf_counter_ns() - due) / 1e9)
+
+
+def polled_game(pipeline, fps, fb):
+    """Game loop that takes the input once per frame and shows a frame"""
+    frames = 0
+    for _ in control.Ticker(fps):
+        events = pipeline.poll()
+        if events:
+            # Move a pixel, so that every frame differs from the one before
+            fb.clear()
+            fb.set(frames % control.WIDTH, frames // control.WIDTH % control.HEIGHT)
+            fb.show()
+            frames += 1
+            for (_, t) in events:
+                pipeline.done(t)
+        if any(event == control.GameControlVal.Quit for (event, _) in events):
+            return
+
+
+def bench_input(duration):
+    """Key presses 1ms apart, with repeats, sent to an embedded game directly
+    by the key reading thread vs. through InputPipeline, and taken by a 50fps
+    host game. Repeated directions are coalesced, like for the snake.
+    Reports key to LED latency and commands sent."""
+    keys = key_stream(max(20, int(duration * 1000)))
+    interval = 0.001
+    identity = {event: event for event in control.GameControlVal}
+    results = {'keys': len(keys)}
+    with FakeDevice() as dev:
+        control.SERIAL_DEV = dev.path
+
+        latency = control.Histogram()
+        direct_keyscan(keys, interval, latency)
+        wait_for_device()
+        results['direct_commands'] = dev.counts[CommandVals.GameControl]
+        results['direct_latency_avg_ms'] = 1000 * latency.sum / latency.count
+        results['direct_latency_max_ms'] = 1000 * latency.max
+
+        cases = [
+            ('pipeline', lambda p: control.forward_game_control(p)),
+            ('polled', lambda p: polled_game(p, 50, control.Framebuffer())),
+        ]
+        for name, consume in cases:
+            before = dict(dev.counts)
+            pipeline = control.InputPipeline(
+                identity, name, key_reader(keys + [control.GameControlVal.Quit], interval),
+                coalesce=control.OPPOSITE_DIRECTION).start()
+            consume(pipeline)
+            wait_for_device()
+            sent = sum(dev.counts.get(c, 0) - before.get(c, 0)
+                       for c in [CommandVals.GameControl, CommandVals.Draw])
+            results[f'{name}_commands'] = sent
+            results[f'{name}_coalesced'] = pipeline.coalesced
+            results[f'{name}_latency_avg_ms'] = 1000 * pipeline.latency.sum / pipeline.latency.count
+            results[f'{name}_latency_max_ms'] = 1000 * pipeline.latency.max
+        control.SERIAL_POOL.close()
+    return results
+
+
+class ReferenceSnake:
+    """Previous snake() logic: the body is a list, collision checks walk it
+    and every tick redraws the whole frame"""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.head = (0, 0)
+        self.body = []
+        self.direction = control.GameControlVal.Down
+        self.food = (0, 0)
+        self.over = False
+        self.fb = control.Framebuffer()
+        self.place_food()
+        self.draw()
+
+    def place_food(self):
+        while self.food == self.head or self.food in self.body:
+            self.food = (self.rng.randint(0, control.WIDTH-1),
+                         self.rng.randint(0, control.HEIGHT-1))
+
+    def step(self, events):
+        moving = self.direction
+        for event in events:
+            if event == control.OPPOSITE_DIRECTION[moving] and self.body:
+                continue
+            self.direction = event
+        (x, y) = self.head
+        oldhead = self.head
+        if self.direction == control.GameControlVal.Right:
+            self.head = (x+1, y)
+        elif self.direction == control.GameControlVal.Left:
+            self.head = (x-1, y)
+        elif self.direction == control.GameControlVal.Up:
+            self.head = (x, y-1)
+        elif self.direction == control.GameControlVal.Down:
+            self.head = (x, y+1)
+        (x, y) = self.head
+        if self.head in self.body or x >= control.WIDTH or x < 0 or y >= control.HEIGHT or y < 0:
+            self.over = True
+            return
+        if self.head == self.food:
+            self.body.insert(0, oldhead)
+            self.place_food()
+        elif self.body:
+            self.body.pop()
+            self.body.insert(0, oldhead)
+        self.draw()
+
+    def draw(self):
+        self.fb.clear()
+        self.fb.set(*self.head)
+        self.fb.set(*self.food)
+        for bodypart in self.body:
+            self.fb.set(*bodypart)
+
+
+def autopilot(game):
+    """Head for the food, first sideways, then up or down"""
+    (x, y) = game.head
+    (fx, fy) = game.food
+    if fx != x:
+        return [control.GameControlVal.Right if fx > x else control.GameControlVal.Left]
+    return [control.GameControlVal.Down if fy > y else control.GameControlVal.Up]
+
+
+def snake_ticks_per_second(new_game, step, duration):
+    """Play games back to back with the autopilot"""
+    count = 0
+    game = new_game(random.Random(0))
+    start = time.perf_counter()
+    while True:
+        for _ in range(100):
+            if game.over:
+                game = new_game(random.Random(count))
+            step(game)
+            count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def bench_snake(duration):
+    """Headless snake steps per second, driven by an autopilot.
+    The list based reference vs. SnakeGame."""
+    before = snake_ticks_per_second(ReferenceSnake, lambda g: g.step(autopilot(g)), duration)
+    after = snake_ticks_per_second(lambda rng: control.SnakeGame(rng=rng),
+                                   lambda g: g.simulate(1, autopilot), duration)
+    return {
+        'reference_ticks_per_s': before,
+        'engine_ticks_per_s': after,
+        'speedup': after / before,
+    }
+
+
+class ReferenceLife:
+    """Game of Life of the firmware, cell by cell on a grid of rows.
+    The columns of each module are mirrored, like Draw does. The rules are
+    symmetric, so a single module still runs like the firmware."""
+
+    def __init__(self, param, width=control.WIDTH):
+        self.width = width
+        self.cells = [[0] * width for _ in range(control.HEIGHT)]
+        for m in range(width // control.WIDTH):
+            for (row, col) in control.life_seed_cells(param):
+                self.cells[row][m * control.WIDTH + control.WIDTH - 1 - col] = 1
+
+    def live_neighbor_count(self, row, col):
+        count = 0
+        for delta_row in [control.HEIGHT - 1, 0, 1]:
+            for delta_col in [self.width - 1, 0, 1]:
+                if delta_row == 0 and delta_col == 0:
+                    continue
+                count += self.cells[(row + delta_row) % control.HEIGHT][(col + delta_col) % self.width]
+        return count
+
+    def tick(self):
+        self.cells = [[int(n == 3 or (cell and n == 2))
+                       for (col, cell) in enumerate(cells)
+                       for n in [self.live_neighbor_count(row, col)]]
+                      for (row, cells) in enumerate(self.cells)]
+
+    def matches(self, life):
+        return all(life.alive(x, y) == bool(self.cells[y][x])
+                   for y in range(control.HEIGHT) for x in range(self.width))
+
+
+def generations_per_second(step, duration):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(10):
+            step()
+        count += 10
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def bench_life(duration):
+    """Game of Life generations per second, the firmware's algorithm cell by
+    cell vs. the bit-parallel Life, on one module and on a canvas of four."""
+    results = {}
+    for modules in [1, 4]:
+        ref = ReferenceLife(control.GameOfLifeStartParam.Pattern1, control.WIDTH * modules)
+        life = control.Life.seeded(control.GameOfLifeStartParam.Pattern1, modules)
+        before = generations_per_second(ref.tick, duration)
+        after = generations_per_second(life.step, duration)
+        results[f'reference_{modules}_generations_per_s'] = before
+        results[f'bitwise_{modules}_generations_per_s'] = after
+        results[f'speedup_{modules}'] = after / before
+    return results
+
+
+def band_tone(spectrum, band, amplitude, seconds=None):
+    """Sine wave in the middle of a band of an AudioSpectrum, filling its ring"""
+    import numpy as np
+    freqs = np.geomspace(control.AUDIO_MIN_FREQ, min(control.AUDIO_MAX_FREQ, spectrum.rate / 2),
+                         len(spectrum.levels) + 1)
+    freq = np.sqrt(freqs[band] * freqs[band + 1])
+    count = spectrum.ring.size if seconds is None else int(seconds * spectrum.rate)
+    return (amplitude * np.sin(2 * np.pi * freq * np.arange(count) / spectrum.rate)).astype(np.float32)
+
+
+def reference_spectrum(samples, rate, bands):
+    """Straightforward equalizer levels. Window and frequencies are
+    recomputed and the bands summed up one by one, every frame."""
+    import numpy as np
+    window = np.hanning(len(samples))
+    spectrum = np.abs(np.fft.rfft(samples * window)) ** 2
+    freqs = np.fft.rfftfreq(len(samples), 1 / rate)
+    edges = np.geomspace(control.AUDIO_MIN_FREQ, min(control.AUDIO_MAX_FREQ, rate / 2), bands + 1)
+    full_scale = (window.sum() / 2) ** 2
+    levels = []
+    for lo, hi in zip(edges, edges[1:]):
+        in_band = spectrum[(freqs >= lo) & (freqs < hi)]
+        power = in_band.max() if len(in_band) else 0
+        levels.append(min(1, max(0, 1 + 10 * np.log10(power / full_scale + 1e-12) / control.AUDIO_DYNAMIC_RANGE)))
+    return levels
+
+
+def bench_audio(duration):
+    """Equalizer frames computed per second from 2048 samples at 44.1kHz,
+    AudioSpectrum vs. a straightforward version. Also how long a WAV file
+    takes through --audio-eq on the module."""
+    import numpy as np
+    import wave
+    spectrum = control.AudioSpectrum()
+    noise = np.random.default_rng(0).standard_normal(spectrum.ring.size).astype(np.float32) * 0.1
+    spectrum.ring.write(noise)
+
+    samples = spectrum.ring.latest()
+    before = conversions_per_second(lambda s: reference_spectrum(s, control.AUDIO_RATE, control.WIDTH),
+                                    samples, duration)
+    after = conversions_per_second(lambda _: spectrum.update(), None, duration)
+
+    # Half a second of a tone in the seventh band, through the emulated module
+    tone = band_tone(spectrum, 6, 0.5, seconds=0.5)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tone.wav')
+        with wave.open(path, 'wb') as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(control.AUDIO_RATE)
+            w.writeframes((tone * 32767).astype('<i2').tobytes())
+        with FakeDevice() as dev:
+            control.SERIAL_DEV = dev.path
+            start = time.perf_counter()
+            control.audio_eq(path)
+            elapsed = time.perf_counter() - start
+            wait_for_device()
+            control.SERIAL_POOL.close()
+            # The next emulator may get the same path, but shows nothing yet
+            control.GREYSCALE_RENDERERS.clear()
+    return {
+        'reference_frames_per_s': before,
+        'spectrum_frames_per_s': after,
+        'speedup': after / before,
+        'window_latency_ms': 1000 * control.AUDIO_FFT_SIZE / control.AUDIO_RATE,
+        'playback_s': elapsed,
+        'frames_sent': dev.counts.get(CommandVals.DrawGreyColBuffer, 0),
+    }
+
+
+def brightness_loop(read, write, duration):
+    """Control loop that reads the brightness and sets a target that changes
+    every 50 iterations. Returns iterations per second."""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        target = 100 + 50 * (count // 50 % 2)
+        read()
+        write(target)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def bench_state(duration):
+    """Brightness control loop querying the module every time vs. through
+    DeviceState, which skips no-op writes. The module answers after 1ms.
+    Also FPS and power mode read one after the other vs. in one pass."""
+    results = {}
+    with FakeDevice(latency=0.001) as dev:
+        control.SERIAL_DEV = dev.path
+        state = control.device_state()
+        cases = [
+            ('uncached',
+             lambda: control.send_command(CommandVals.Brightness, with_response=True),
+             lambda b: control.send_command(CommandVals.Brightness, [b])),
+            ('cached', control.get_brightness, control.brightness),
+        ]
+        for name, read, write in cases:
+            state.invalidate()
+            wait_for_device()
+            before = dev.counts.get(CommandVals.Brightness, 0)
+            queries = state.queries
+            results[f'{name}_loops_per_s'] = brightness_loop(read, write, duration)
+            wait_for_device()
+            results[f'{name}_commands'] = dev.counts[CommandVals.Brightness] - before
+        results['cached_queries'] = state.queries - queries
+        results['skipped_writes'] = state.skipped
+        results['speedup'] = results['cached_loops_per_s'] / results['uncached_loops_per_s']
+
+        fps_queries = [CommandVals.SetFps, CommandVals.SetPowerMode]
+        sequential = conversions_per_second(
+            lambda _: [control.send_command(c, with_response=True) for c in fps_queries], None, duration)
+        batched = conversions_per_second(
+            lambda _: (state.invalidate(), state.get_many(fps_queries)), None, duration)
+        results['fps_sequential_reads_per_s'] = sequential
+        results['fps_batched_reads_per_s'] = batched
+        control.SERIAL_POOL.close()
+    return results
+
+
+def bench_register_map(duration):
+    """LED register maps generated per second by led-matrix.py,
+    vectorized vs. LED by LED, and framebuffers converted to register pages"""
+    led_matrix = importlib.import_module('led-matrix')
+
+    before = conversions_per_second(lambda _: led_matrix.get_leds(), None, duration)
+    after = conversions_per_second(led_matrix.register_map, led_matrix.FL16, duration)
+    table = led_matrix.get_leds()
+    levels = bytes(i % 256 for i in range(len(table)))
+    return {
+        'reference_maps_per_s': before,
+        'vectorized_maps_per_s': after,
+        'speedup': after / before,
+        'pages_per_s': conversions_per_second(table.pages, levels, duration),
+    }
+
+
+class CountingSerial(serial.Serial):
+    """Serial port that counts write() calls"""
+    writes = 0
+
+    def write(self, data):
+        CountingSerial.writes += 1
+        return super().write(data)
+
+
+def bench_encoder(duration):
+    """Brightness sweeps and StageGreyCol bursts, sent directly as Python
+    lists vs. through CommandQueue. Reports commands and write() calls."""
+    cols = [[x * 20] * control.HEIGHT for x in range(control.WIDTH)]
+
+    def sweep_lists():
+        for b in range(256):
+            control.send_command_raw(FWK_MAGIC + [CommandVals.Brightness, b])
+        return 256
+
+    def sweep_queue(queue):
+        for b in range(256):
+            queue.put(CommandVals.Brightness, [b])
+        queue.flush()
+        return 256
+
+    def burst_lists():
+        with control.SERIAL_POOL.connection(control.SERIAL_DEV) as s:
+            for x, vals in enumerate(cols):
+                control.send_serial(s, FWK_MAGIC + [CommandVals.StageGreyCol, x] + vals)
+            control.send_serial(s, FWK_MAGIC + [CommandVals.DrawGreyColBuffer, 0x00])
+        return control.WIDTH + 1
+
+    def burst_queue(queue):
+        for x, vals in enumerate(cols):
+            queue.put(CommandVals.StageGreyCol, [x] + vals)
+        queue.put(CommandVals.DrawGreyColBuffer, [0x00])
+        queue.flush()
+        return control.WIDTH + 1
+
+    def measure(run):
+        commands = 0
+        rounds = 0
+        CountingSerial.writes = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            commands += run()
+            rounds += 1
+        return commands / (time.perf_counter() - start), CountingSerial.writes / rounds
+
+    results = {}
+    original = serial.Serial
+    serial.Serial = CountingSerial
+    try:
+        with FakeDevice() as dev:
+            control.SERIAL_DEV = dev.path
+            queue = control.CommandQueue()
+            cases = [
+                ('sweep_list', sweep_lists),
+                ('sweep_queue', lambda: sweep_queue(queue)),
+                ('burst_list', burst_lists),
+                ('burst_queue', lambda: burst_queue(queue)),
+            ]
+            for name, run in cases:
+                cmds_per_s, writes = measure(run)
+                results[f'{name}_cmds_per_s'] = cmds_per_s
+                results[f'{name}_writes_per_round'] = writes
+            control.SERIAL_POOL.close()
+    finally:
+        serial.Serial = original
+    return results
+
+
+BENCHMARKS = {
+    'connection': bench_connection,
+    'b1': bench_b1,
+    'conversion': bench_conversion,
+    'greyscale': bench_greyscale,
+    'packing': bench_packing,
+    'async': bench_async,
+    'multi': bench_multi,
+    'ticker': bench_ticker,
+    'encoder': bench_encoder,
+    'upload': bench_upload,
+    'string': bench_string,
+    'animation': bench_animation,
+    'register_map': bench_register_map,
+    'framebuffer': bench_framebuffer,
+    'compositor': bench_compositor,
+    'daemon': bench_daemon,
+    'startup': bench_startup,
+    'slider': bench_slider,
+    'state': bench_state,
+    'input': bench_input,
+    'snake': bench_snake,
+    'life': bench_life,
+    'audio': bench_audio,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*',
+                        help=f"Benchmarks to run: {', '.join(BENCHMARKS)}. Default: all")
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='Seconds to run each measurement')
+    parser.add_argument('--json', help='Save the results to a JSON file')
+    parser.add_argument('--compare', help='Compare with results saved with --json')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark: {name}")
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        # Same random images and animations on every run
+        random.seed(0)
+        for key, value in BENCHMARKS[name](args.duration).items():
+            key = f"{name}.{key}"
+            results[key] = value
+            if key in previous and previous[key]:
+                change = 100 * (value - previous[key]) / previous[key]
+                print(f"{key}: {value:.1f} (was {previous[key]:.1f}, {change:+.1f}%)")
+            else:
+                print(f"{key}: {value:.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'meta': run_info(args.duration), 'results': results}, f, indent=2)
+
+
+def run_info(duration):
+    """What the results were measured on, to tell runs apart"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'duration': duration,
+    }
+
+
+if __name__ == "__main__":
+    main()
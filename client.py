@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Thin client for `control.py --daemon`. Only uses the standard library and
+# doesn't import control.py, so that it starts quickly.
+#
+# Usage:
+#   ./control.py --daemon &
+#   ./client.py Brightness 50
+#   ./client.py Pattern 0 30 --priority high
+#   ./client.py Version --response
+#   echo '{"cmd": "Brightness", "params": [50]}' | ./client.py -
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+
+
+def default_socket_path():
+    """Same as in control.py"""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(runtime_dir, 'inputmodule.sock')
+
+
+class Client:
+    """Connection to the daemon. Requests are answered in order."""
+
+    def __init__(self, path=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path or default_socket_path())
+        self.file = self.sock.makefile('rwb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def request(self, request):
+        """Send a request and wait for the reply"""
+        return json.loads(self.request_line(json.dumps(request).encode()))
+
+    def request_line(self, line):
+        """Send a JSON encoded request and return the JSON encoded reply"""
+        self.file.write(line.rstrip(b'\n') + b'\n')
+        self.file.flush()
+        return self.file.readline()
+
+    def send(self, cmd, params=[], response=False, priority=None, dev=None):
+        request = {'cmd': cmd, 'params': list(params)}
+        if response:
+            request['response'] = True
+        if priority:
+            request['priority'] = priority
+        if dev:
+            request['dev'] = dev
+        return self.request(request)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cmd', help="Command name, like Brightness, or - to read JSON lines from stdin")
+    parser.add_argument('params', nargs='*', type=int, help="Parameter bytes")
+    parser.add_argument('--response', action='store_true', help="Wait for and print the response")
+    parser.add_argument('--priority', choices=['high'], help="Send right away, don't coalesce")
+    parser.add_argument('--dev', help="Serial device. Default: the daemon's")
+    parser.add_argument('--socket', help="Unix socket of the daemon")
+    args = parser.parse_args()
+
+    try:
+        client = Client(args.socket)
+    except OSError as e:
+        sys.exit(f"Can't connect to the daemon: {e}")
+
+    with client:
+        if args.cmd == '-':
+            for line in sys.stdin.buffer:
+                sys.stdout.buffer.write(client.request_line(line))
+            return
+        reply = client.send(args.cmd, args.params, args.response, args.priority, args.dev)
+    if not reply['ok']:
+        sys.exit(reply['error'])
+    if 'response' in reply:
+        print(' '.join(str(b) for b in reply['response']))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,31 @@
 #!/usr/bin/env python3
-import argparse
+import atexit
+import os
 import sys
 import threading
 import time
-from datetime import datetime, timedelta
-import random
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
 import math
-import sys
 from enum import IntEnum
+from functools import lru_cache
+from types import MappingProxyType
 
+# Imported where they're used, so that one-shot commands start quickly:
+# import argparse
+# import asyncio
+# from concurrent.futures import ThreadPoolExecutor
+# from datetime import datetime
+# import random
 
-# Need to install
-import serial
+# Need to install, also imported where it's used
+# import serial
 
 # Optional dependencies:
 # from PIL import Image
+# import numpy as np
 # import PySimpleGUI as sg
 
 FWK_MAGIC = [0x32, 0xAC]
@@ -92,6 +103,8 @@ class GameControlVal(IntEnum):
     Left = 2
     Right = 3
     Quit = 4
+    SecondLeft = 5
+    SecondRight = 6
 
 
 PATTERNS = [
@@ -111,6 +124,12 @@ WIDTH = 9
 HEIGHT = 34
 B1_WIDTH = 300
 B1_HEIGHT = 400
+# 400 pixels, one bit each
+B1_COLUMN_BYTES = 50
+# Magic, command, column (u16) and pixels
+B1_COLUMN_CMD_SIZE = 3 + 2 + B1_COLUMN_BYTES
+# Every column and the flush command
+B1_FRAME_SIZE = B1_WIDTH * B1_COLUMN_CMD_SIZE + 3
 
 ARG_UP = 0
 ARG_DOWN = 1
@@ -127,11 +146,114 @@ HIGH_FPS_MASK = 0b00010000
 LOW_FPS_MASK = 0b00000111
 
 SERIAL_DEV = None
+SERIAL_BAUDRATE = 115200
+
+# CommandStats, if collecting statistics is enabled
+STATS = None
+
+# Set to stop the animation that's currently running
+STOP_THREAD = threading.Event()
+
+
+def checked_brightness(b):
+    if b > 255 or b < 0:
+        print("Brightness must be 0-255")
+        sys.exit(1)
+    brightness(b)
+
+
+def checked_percentage(p):
+    if p > 100 or p < 0:
+        print("Percentage must be 0-100")
+        sys.exit(1)
+    percentage(p)
+
+
+def print_sleeping():
+    # The module can fall asleep by itself, don't trust the cache
+    res = send_command(CommandVals.Sleep, with_response=True)
+    sleeping = bool(res[0])
+    print(f"Currently sleeping: {sleeping}")
+
 
-STOP_THREAD = False
+def print_brightness():
+    br = get_brightness()
+    print(f"Current brightness: {br}")
+
+
+def print_animate():
+    animating = get_animate()
+    print(f"Currently animating: {animating}")
+
+
+def print_version():
+    version = get_version()
+    print(f"Device version: {version}")
+
+
+DEFAULT_SERIAL_DEV = '/dev/ttyACM0'
+
+# One-shot commands that main() runs without building the full parser.
+# Hooks and monitoring scripts call these many times a second, so startup
+# time dominates. Option => (whether it takes an integer, function)
+FAST_COMMANDS = {
+    '--brightness': (True, checked_brightness),
+    '--get-brightness': (False, print_brightness),
+    '--percentage': (True, checked_percentage),
+    '--sleep': (False, lambda: send_command(CommandVals.Sleep, [True])),
+    '--no-sleep': (False, lambda: send_command(CommandVals.Sleep, [False])),
+    '--is-sleeping': (False, print_sleeping),
+    '--animate': (False, lambda: animate(True)),
+    '--no-animate': (False, lambda: animate(False)),
+    '--get-animate': (False, print_animate),
+    '-v': (False, print_version),
+    '--version': (False, print_version),
+}
+
+
+def fast_main(argv):
+    """Run a command from FAST_COMMANDS, optionally with --serial-dev.
+    Returns False if argv needs the full parser."""
+    global SERIAL_DEV
+    dev = DEFAULT_SERIAL_DEV
+    rest = []
+    i = 0
+    while i < len(argv):
+        if argv[i] == '--serial-dev' and i + 1 < len(argv):
+            dev = argv[i + 1]
+            i += 2
+        elif argv[i].startswith('--serial-dev='):
+            dev = argv[i].partition('=')[2]
+            i += 1
+        else:
+            rest.append(argv[i])
+            i += 1
+
+    if not rest or rest[0] not in FAST_COMMANDS:
+        return False
+    (takes_int, command) = FAST_COMMANDS[rest[0]]
+    if len(rest) != 1 + takes_int:
+        return False
+    if takes_int:
+        try:
+            value = int(rest[1])
+        except ValueError:
+            # Let argparse report it
+            return False
+
+    SERIAL_DEV = dev
+    if takes_int:
+        command(value)
+    else:
+        command()
+    return True
 
 
 def main():
+    if fast_main(sys.argv[1:]):
+        return
+
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--bootloader", help="Jump to the bootloader to flash new firmware",
                         action="store_true")
@@ -153,6 +275,12 @@ def main():
                         type=argparse.FileType('rb'))
     parser.add_argument("--image-grey", help="Display a PNG or GIF image in greyscale",
                         type=argparse.FileType('rb'))
+    parser.add_argument("--play", help="Play an animated GIF, a sequence of images or raw greyscale frames (.raw file or - for stdin)",
+                        nargs='+')
+    parser.add_argument("--dashboard", help="Show several widgets at once: clock, eq, progress:SECONDS",
+                        nargs='+')
+    parser.add_argument("--fps", help="Frame rate for --play, --dashboard, --game-of-life and --audio-eq. Default: GIF frame durations or 30, 10 for --dashboard, 2 for --game-of-life",
+                        type=float)
     parser.add_argument("--percentage", help="Fill a percentage of the screen",
                         type=int)
     parser.add_argument("--clock", help="Display the current time",
@@ -172,6 +300,9 @@ def main():
     parser.add_argument("--eq", help="Equalizer", nargs='+', type=int)
     parser.add_argument(
         "--random-eq", help="Random Equalizer", action="store_true")
+    parser.add_argument("--audio-eq", help="Equalizer of audio from a WAV file, raw 16-bit mono PCM or - for stdin")
+    parser.add_argument("--audio-rate", help=f"Sample rate of raw PCM. Default: {AUDIO_RATE}",
+                        type=int, default=AUDIO_RATE)
     parser.add_argument("--wpm", help="WPM Demo", action="store_true")
     parser.add_argument("--snake", help="Snake", action="store_true")
     parser.add_argument("--snake-embedded",
@@ -180,6 +311,12 @@ def main():
                         help="Pong on the module", action="store_true")
     parser.add_argument("--game-of-life-embedded",
                         help="Game of Life", type=GameOfLifeStartParam.argparse, choices=list(GameOfLifeStartParam))
+    parser.add_argument("--game-of-life",
+                        help="Game of Life, simulated on the host", type=GameOfLifeStartParam.argparse,
+                        choices=[p for p in GameOfLifeStartParam if p != GameOfLifeStartParam.Currentmatrix])
+    parser.add_argument("--game-of-life-canvas",
+                        help="Game of Life across all LED matrices side by side", type=GameOfLifeStartParam.argparse,
+                        choices=[p for p in GameOfLifeStartParam if p != GameOfLifeStartParam.Currentmatrix])
     parser.add_argument("--quit-embedded-game",
                         help="Quit the current game", action="store_true")
     parser.add_argument(
@@ -190,8 +327,18 @@ def main():
         "--get-color", help="Get RGB color (C1 Minimal Input Module)", action="store_true")
     parser.add_argument("-v", "--version",
                         help="Get device version", action="store_true")
+    parser.add_argument("--list-modules", help="List all connected input modules",
+                        action="store_true")
+    parser.add_argument("--canvas-grey", help="Display a greyscale image across all LED matrices side by side",
+                        type=argparse.FileType('rb'))
+    parser.add_argument("--daemon", help="Keep running and send the commands of local clients, see client.py",
+                        action="store_true")
+    parser.add_argument("--socket", help="Unix socket of --daemon. Default: $XDG_RUNTIME_DIR/inputmodule.sock")
+    parser.add_argument("--stats", help="Print command latency and frame timing statistics on exit",
+                        nargs='?', const='text', choices=['text', 'json', 'prometheus'])
+    parser.add_argument("--stats-file", help="Write the statistics to a file instead of stderr")
     parser.add_argument("--serial-dev", help="Change the serial dev. Probably /dev/ttyACM0 on Linux, COM0 on Windows",
-                        default='/dev/ttyACM0')
+                        default=DEFAULT_SERIAL_DEV)
 
     parser.add_argument(
         "--disp-str", help="Display a string on the LCD Display", type=str)
@@ -218,40 +365,35 @@ def main():
         global SERIAL_DEV
         SERIAL_DEV = args.serial_dev
 
+    if args.stats is not None:
+        enable_stats(args.stats, args.stats_file)
+
     if args.bootloader:
         bootloader()
     elif args.sleep is not None:
         send_command(CommandVals.Sleep, [args.sleep])
     elif args.is_sleeping:
-        res = send_command(CommandVals.Sleep, with_response=True)
-        sleeping = bool(res[0])
-        print(f"Currently sleeping: {sleeping}")
+        print_sleeping()
     elif args.brightness is not None:
-        if args.brightness > 255 or args.brightness < 0:
-            print("Brightness must be 0-255")
-            sys.exit(1)
-        brightness(args.brightness)
+        checked_brightness(args.brightness)
     elif args.get_brightness:
-        br = get_brightness()
-        print(f"Current brightness: {br}")
+        print_brightness()
     elif args.percentage is not None:
-        if args.percentage > 100 or args.percentage < 0:
-            print("Percentage must be 0-100")
-            sys.exit(1)
-        percentage(args.percentage)
+        checked_percentage(args.percentage)
     elif args.pattern is not None:
         pattern(args.pattern)
     elif args.animate is not None:
         animate(args.animate)
     elif args.get_animate:
-        animating = get_animate()
-        print(f"Currently animating: {animating}")
+        print_animate()
     elif args.panic:
         send_command(CommandVals.Panic, [0x00])
     elif args.image is not None:
         image_bl(args.image)
     elif args.image_grey is not None:
         image_greyscale(args.image_grey)
+    elif args.play is not None:
+        play(args.play, args.fps)
     elif args.all_brightnesses:
         all_brightnesses()
     elif args.set_color:
@@ -273,6 +415,10 @@ def main():
         snake_embedded()
     elif args.game_of_life_embedded is not None:
         game_of_life_embedded(args.game_of_life_embedded)
+    elif args.game_of_life is not None:
+        game_of_life(args.game_of_life, args.fps)
+    elif args.game_of_life_canvas is not None:
+        game_of_life_canvas(args.game_of_life_canvas, args.fps)
     elif args.quit_embedded_game:
         send_command(CommandVals.GameControl, [GameControlVal.Quit])
     elif args.pong_embedded:
@@ -281,8 +427,12 @@ def main():
         eq(args.eq)
     elif args.random_eq:
         random_eq()
+    elif args.audio_eq is not None:
+        audio_eq(args.audio_eq, args.fps, args.audio_rate)
     elif args.clock:
         clock()
+    elif args.dashboard is not None:
+        dashboard(args.dashboard, args.fps)
     elif args.string is not None:
         show_string(args.string)
     elif args.symbols is not None:
@@ -305,9 +455,14 @@ def main():
         get_power_mode_cmd()
     elif args.b1image is not None:
         b1image_bl(args.b1image)
+    elif args.list_modules:
+        list_modules()
+    elif args.daemon:
+        daemon(args.socket)
+    elif args.canvas_grey is not None:
+        canvas_greyscale(args.canvas_grey)
     elif args.version:
-        version = get_version()
-        print(f"Device version: {version}")
+        print_version()
     else:
         parser.print_help(sys.stderr)
         sys.exit(1)
@@ -326,19 +481,19 @@ def percentage(p):
 def brightness(b: int):
     """Adjust the brightness scaling of the entire screen.
     """
-    send_command(CommandVals.Brightness, [b])
+    device_state().set(CommandVals.Brightness, [b])
 
 
 def get_brightness():
     """Adjust the brightness scaling of the entire screen.
     """
-    res = send_command(CommandVals.Brightness, with_response=True)
+    res = device_state().get(CommandVals.Brightness)
     return int(res[0])
 
 
 def get_version():
     """Get the device's firmware version"""
-    res = send_command(CommandVals.Version, with_response=True)
+    res = device_state().get(CommandVals.Version)
     major = res[0]
     minor = (res[1] & 0xF0) >> 4
     patch = res[1] & 0xF
@@ -353,13 +508,13 @@ def get_version():
 def animate(b: bool):
     """Tell the firmware to start/stop animation.
     Scrolls the currently saved grid vertically down."""
-    send_command(CommandVals.Animate, [b])
+    device_state().set(CommandVals.Animate, [b])
 
 
 def get_animate():
     """Tell the firmware to start/stop animation.
     Scrolls the currently saved grid vertically down."""
-    res = send_command(CommandVals.Animate, with_response=True)
+    res = device_state().get(CommandVals.Animate)
     return bool(res[0])
 
 
@@ -375,34 +530,51 @@ def b1image_bl(image_file):
     width, height = im.size
     assert (width == B1_WIDTH)
     assert (height == B1_HEIGHT)
-    pixel_values = list(im.getdata())
 
-    for x in range(B1_WIDTH):
-        vals = [0 for _ in range(50)]
+    b1_send_frames([b1_image_columns(im)])
 
-        byte = None
-        for y in range(B1_HEIGHT):
-            pixel = pixel_values[y*B1_WIDTH + x]
-            brightness = sum(pixel) / 3
-            black = brightness < 0xFF/2
 
-            bit = y % 8
+def b1_image_columns(im):
+    """Convert a 300x400 RGB image to 300 columns of 50 bytes.
+    Each bit is one pixel, set if it's black."""
+    import numpy as np
+    # Average brightness below half => black
+    black = image_rgb_sums(im) * 2 < 3 * 0xFF
+    return [col.tobytes() for col in np.packbits(black.T, axis=1, bitorder='little')]
 
-            if bit == 0:
-                byte = 0
-            if black:
-                byte |= 1 << bit
 
-            if bit == 7:
-                vals[int(y/8)] = byte
+def b1_pack_frame(columns, buf=None):
+    """Pack a B1 frame into one buffer holding a SetPixelColumn command for
+    every column, followed by FlushFramebuffer.
+    Reuses buf if given, so that streaming doesn't allocate per frame."""
+    if buf is None:
+        buf = bytearray(B1_FRAME_SIZE)
+    assert (len(columns) == B1_WIDTH)
 
-        column_le = list((x).to_bytes(2, 'little'))
-        command = FWK_MAGIC + [0x16] + column_le + vals
-        send_command(command)
+    header = encode_command(CommandVals.SetPixelColumn)
+    for x, column in enumerate(columns):
+        offset = x * B1_COLUMN_CMD_SIZE
+        buf[offset:offset+3] = header
+        buf[offset+3:offset+5] = x.to_bytes(2, 'little')
+        buf[offset+5:offset+B1_COLUMN_CMD_SIZE] = column
+    buf[B1_WIDTH*B1_COLUMN_CMD_SIZE:] = encode_command(CommandVals.FlushFramebuffer)
+    return buf
 
-    # Flush
-    command = FWK_MAGIC + [0x17]
-    send_command(command)
+
+def b1_send_frames(frames):
+    """Stream full frames to the B1 display, over a single connection.
+    Each frame is a sequence of 300 columns of 50 bytes, see b1_image_columns.
+
+    The firmware parses exactly one command per USB packet, so the packed
+    commands are written back to back, but not in a single write."""
+    buf = bytearray(B1_FRAME_SIZE)
+    view = memoryview(buf)
+    with SERIAL_POOL.connection(SERIAL_DEV) as s:
+        for columns in frames:
+            b1_pack_frame(columns, buf)
+            for offset in range(0, B1_FRAME_SIZE - 3, B1_COLUMN_CMD_SIZE):
+                send_serial(s, view[offset:offset+B1_COLUMN_CMD_SIZE])
+            send_serial(s, view[B1_FRAME_SIZE-3:])
 
 
 def image_bl(image_file):
@@ -411,27 +583,39 @@ def image_bl(image_file):
     Must be 9x34 in size.
     Sends everything in a single command
     """
-    vals = [0 for _ in range(39)]
-
     from PIL import Image
     im = Image.open(image_file).convert("RGB")
     width, height = im.size
     assert (width == 9)
     assert (height == 34)
-    pixel_values = list(im.getdata())
-    for i, pixel in enumerate(pixel_values):
-        brightness = sum(pixel) / 3
-        if brightness > 0xFF/2:
-            vals[int(i/8)] |= (1 << i % 8)
 
-    send_command(CommandVals.Draw, vals)
+    send_command(CommandVals.Draw, image_draw_vals(im))
+
+
+def image_rgb_sums(im):
+    """Sum of the RGB channels of every pixel of an RGB image.
+    Array with shape (height, width)"""
+    import numpy as np
+    return np.asarray(im, dtype=np.uint16).sum(axis=2)
+
+
+def image_draw_vals(im):
+    """Convert a 9x34 RGB image to the 39 bytes of the Draw command.
+    Each bit is one pixel, set if it's bright."""
+    import numpy as np
+    # Average brightness above half => on
+    on = image_rgb_sums(im).ravel() * 2 > 3 * 0xFF
+    return list(np.packbits(on, bitorder='little').tobytes())
 
 
 def pixel_to_brightness(pixel):
     """Calculate pixel brightness from an RGB triple"""
     assert (len(pixel) == 3)
-    brightness = sum(pixel) / len(pixel)
+    return scale_brightness(sum(pixel) / len(pixel))
+
 
+def scale_brightness(brightness):
+    """Scale the average brightness of a pixel for display on the LED matrix"""
     # Poor man's scaling to make the greyscale pop better.
     # Should find a good function.
     if brightness > 200:
@@ -448,42 +632,225 @@ def pixel_to_brightness(pixel):
     return int(brightness)
 
 
+_BRIGHTNESS_LUT = None
+
+
+def brightness_lut():
+    """Lookup table from the sum of a pixel's RGB channels to its scaled brightness"""
+    global _BRIGHTNESS_LUT
+    if _BRIGHTNESS_LUT is None:
+        import numpy as np
+        _BRIGHTNESS_LUT = np.array([scale_brightness(total / 3) for total in range(3 * 0xFF + 1)],
+                                   dtype=np.uint8)
+    return _BRIGHTNESS_LUT
+
+
+def image_grey_cols(im):
+    """Convert a 9x34 RGB image to 9 columns of 34 brightness values.
+    Wider images have more columns."""
+    cols = brightness_lut()[image_rgb_sums(im)].T
+    return [col.tobytes() for col in cols]
+
+
 def image_greyscale(image_file):
     """Display an image in greyscale
     Sends each 1x34 column and then commits => 10 commands
     """
-    with serial.Serial(SERIAL_DEV, 115200) as s:
-        from PIL import Image
-        im = Image.open(image_file).convert("RGB")
-        width, height = im.size
-        assert (width == 9)
-        assert (height == 34)
-        pixel_values = list(im.getdata())
-        for x in range(0, WIDTH):
-            vals = [0 for _ in range(HEIGHT)]
-
-            for y in range(HEIGHT):
-                vals[y] = pixel_to_brightness(pixel_values[x+y*WIDTH])
-
-            send_col(s, x, vals)
-        commit_cols(s)
+    from PIL import Image
+    im = Image.open(image_file).convert("RGB")
+    width, height = im.size
+    assert (width == 9)
+    assert (height == 34)
+    greyscale_renderer().render(image_grey_cols(im))
+
+
+RAW_FRAME_SIZE = WIDTH * HEIGHT
+PLAY_DEFAULT_FPS = 30
+
+
+def iter_frames(sources, fps=None):
+    """Lazily decode frames for playback, one at a time.
+    Yields (frame, duration in seconds). A frame is either a 9x34 RGB image
+    or RAW_FRAME_SIZE bytes of brightness values, row by row.
+
+    Sources can be images (animated GIFs yield every frame), raw frame files
+    ending in .raw or '-' to read raw frames from stdin."""
+    default_duration = 1 / (fps or PLAY_DEFAULT_FPS)
+    for source in sources:
+        if source == '-' or source.endswith('.raw'):
+            f = sys.stdin.buffer if source == '-' else open(source, 'rb')
+            with f:
+                while True:
+                    frame = f.read(RAW_FRAME_SIZE)
+                    if len(frame) < RAW_FRAME_SIZE:
+                        break
+                    yield (frame, default_duration)
+        else:
+            from PIL import Image, ImageSequence
+            with Image.open(source) as im:
+                for frame in ImageSequence.Iterator(im):
+                    duration = default_duration
+                    if fps is None and frame.info.get('duration'):
+                        duration = frame.info['duration'] / 1000
+                    frame = frame.convert("RGB")
+                    width, height = frame.size
+                    assert (width == WIDTH)
+                    assert (height == HEIGHT)
+                    yield (frame, duration)
+
+
+def frame_grey_cols(frame):
+    """Convert a frame from iter_frames() to 9 columns of brightness values"""
+    if isinstance(frame, bytes):
+        return [frame[x::WIDTH] for x in range(WIDTH)]
+    return image_grey_cols(frame)
+
+
+def play(sources, fps=None):
+    """Play frames in greyscale, paced by the monotonic clock.
+    Frames that are already late by the time they're decoded are dropped
+    instead of delaying all following frames."""
+    start = None
+    due = 0.0
+    shown = 0
+    dropped = 0
+    renderer = greyscale_renderer()
+    for frame, duration in iter_frames(sources, fps):
+        # Start the clock once the first frame is on screen
+        now = 0.0 if start is None else time.monotonic() - start
+        if now >= due + duration:
+            # Missed this frame's whole slot
+            dropped += 1
+        else:
+            if now < due:
+                time.sleep(due - now)
+            renderer.render(frame_grey_cols(frame))
+            shown += 1
+            if start is None:
+                start = time.monotonic()
+        due += duration
+    print(f"Played {shown} frames, dropped {dropped}, saved {renderer.bytes_saved} bytes")
 
 
 def send_col(s, x, vals):
     """Stage greyscale values for a single column. Must be committed with commit_cols()"""
-    command = FWK_MAGIC + [CommandVals.StageGreyCol, x] + vals
-    send_serial(s, command)
+    send_serial(s, encode_command(CommandVals.StageGreyCol, bytes((x,)) + bytes(vals)))
 
 
 def commit_cols(s):
     """Commit the changes from sending individual cols with send_col(), displaying the matrix.
     This makes sure that the matrix isn't partially updated."""
-    command = FWK_MAGIC + [CommandVals.DrawGreyColBuffer, 0x00]
-    send_serial(s, command)
+    send_serial(s, encode_command(CommandVals.DrawGreyColBuffer, [0x00]))
+
+
+# Size of the StageGreyCol and DrawGreyColBuffer commands on the wire
+GREY_COL_CMD_SIZE = 3 + 1 + HEIGHT
+GREY_COMMIT_CMD_SIZE = 3 + 1
+
+
+class GreyscaleRenderer:
+    """Uploads greyscale frames to one LED matrix, skipping what's redundant.
+
+    Remembers the last committed 9x34 frame. If a new frame is identical,
+    nothing is sent at all. The firmware clears its staging buffer on every
+    commit, so columns that are completely dark don't need to be staged.
+    Every other column has to be sent, even if it didn't change.
+    """
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.last_frame = None
+        # Unknown until our first commit, something else might have staged columns
+        self.staging_clear = False
+        self.frames = 0
+        self.frames_skipped = 0
+        self.cols_sent = 0
+        self.cols_skipped = 0
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+
+    def invalidate(self):
+        """Forget the last frame, the display was changed by another command"""
+        self.last_frame = None
+
+    def render(self, cols):
+        """Display 9 columns of 34 brightness values.
+        Returns whether anything was sent."""
+        frame = tuple(bytes(col) for col in cols)
+        assert (len(frame) == WIDTH)
+        self.frames += 1
+
+        if frame == self.last_frame:
+            self.frames_skipped += 1
+            self.cols_skipped += WIDTH
+            self.bytes_saved += WIDTH * GREY_COL_CMD_SIZE + GREY_COMMIT_CMD_SIZE
+            return False
+
+        with SERIAL_POOL.connection(self.dev) as s:
+            for x, vals in enumerate(frame):
+                if self.staging_clear and not any(vals):
+                    self.cols_skipped += 1
+                    self.bytes_saved += GREY_COL_CMD_SIZE
+                    continue
+                send_col(s, x, vals)
+                self.cols_sent += 1
+                self.bytes_sent += GREY_COL_CMD_SIZE
+            commit_cols(s)
+            self.bytes_sent += GREY_COMMIT_CMD_SIZE
+
+        self.staging_clear = True
+        self.last_frame = frame
+        DRAWN_FRAMES.pop(self.dev, None)
+        return True
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'frames_skipped': self.frames_skipped,
+            'cols_sent': self.cols_sent,
+            'cols_skipped': self.cols_skipped,
+            'bytes_sent': self.bytes_sent,
+            'bytes_saved': self.bytes_saved,
+        }
+
+
+GREYSCALE_RENDERERS = {}
+GREYSCALE_RENDERERS_LOCK = threading.Lock()
+
+# Commands that change what's on the LED matrix, besides our own greyscale frames
+GRID_COMMANDS = [
+    CommandVals.Pattern,
+    CommandVals.Animate,
+    CommandVals.Draw,
+    CommandVals.StartGame,
+    CommandVals.GameControl,
+    CommandVals.BootloaderReset,
+]
+
+
+# Black/white frame that each device shows, from Framebuffer.show
+DRAWN_FRAMES = {}
+
+
+def grid_changed(dev):
+    """Something other than the greyscale renderer changed the display"""
+    DRAWN_FRAMES.pop(dev, None)
+    renderer = GREYSCALE_RENDERERS.get(dev)
+    if renderer is not None:
+        renderer.invalidate()
+
+
+def greyscale_renderer(dev=None):
+    """Get the greyscale renderer of a device, SERIAL_DEV by default"""
+    dev = dev or SERIAL_DEV
+    with GREYSCALE_RENDERERS_LOCK:
+        if dev not in GREYSCALE_RENDERERS:
+            GREYSCALE_RENDERERS[dev] = GreyscaleRenderer(dev)
+        return GREYSCALE_RENDERERS[dev]
 
 
 def get_color():
-    res = send_command(CommandVals.SetColor, with_response=True)
+    res = device_state().get(CommandVals.SetColor)
     return (int(res[0]), int(res[1]), int(res[2]))
 
 
@@ -510,48 +877,130 @@ def set_color(color):
         return
 
     if rgb:
-        send_command(CommandVals.SetColor, rgb)
+        device_state().set(CommandVals.SetColor, rgb)
 
 
 def all_brightnesses():
     """Increase the brightness with each pixel.
     Only 0-255 available, so it can't fill all 306 LEDs"""
-    with serial.Serial(SERIAL_DEV, 115200) as s:
-        for x in range(0, WIDTH):
-            vals = [0 for _ in range(HEIGHT)]
-
-            for y in range(HEIGHT):
-                brightness = x + WIDTH * y
-                if brightness > 255:
-                    vals[y] = 0
-                else:
-                    vals[y] = brightness
+    fb = Framebuffer(greyscale=True)
+    for brightness in range(256):
+        fb.set(brightness % WIDTH, brightness // WIDTH, brightness)
+    fb.show()
+
+
+# What a Ticker does when it falls behind
+TICK_DROP = 'drop'
+TICK_CATCHUP = 'catchup'
 
-            send_col(s, x, vals)
-        commit_cols(s)
+
+class Ticker:
+    """Fixed rate tick scheduler, based on time.monotonic_ns.
+
+    Iterating yields the number of the tick, on a fixed grid of deadlines, so
+    the time the loop body takes doesn't make it drift. Between ticks it
+    sleeps, it never busy-waits.
+    If the loop falls behind, the 'drop' policy skips the ticks it missed,
+    'catchup' runs them back to back.
+    Stops when cancel() is called or when the stop event is set.
+    With --stats, the render and transmit time of every tick is recorded.
+
+        for tick in Ticker(30, stop=STOP_THREAD):
+            draw_frame(tick)
+    """
+
+    def __init__(self, fps, policy=TICK_DROP, stop=None, name='ticker'):
+        assert (policy in [TICK_DROP, TICK_CATCHUP])
+        self.name = name
+        self.period = int(1_000_000_000 / fps)
+        self.policy = policy
+        self.stop = stop if stop is not None else threading.Event()
+        self.cancelled = False
+        self.ticks = 0
+        self.dropped = 0
+        self._late_sum = 0
+        self._late_sq_sum = 0
+        self._late_max = 0
+        self._late_last = 0
+        self._deadline = 0
+
+    def cancel(self):
+        self.stop.set()
+
+    def behind(self):
+        """Whether the next tick is due already"""
+        return time.monotonic_ns() >= self._deadline + self.period
+
+    def __iter__(self):
+        start = time.monotonic_ns()
+        n = 0
+        while True:
+            deadline = start + n * self.period
+            now = time.monotonic_ns()
+            if now < deadline:
+                # Waiting on the event wakes up immediately on cancellation
+                self.stop.wait((deadline - now) / 1_000_000_000)
+                now = time.monotonic_ns()
+            if self.stop.is_set():
+                self.cancelled = True
+                return
+
+            self._deadline = deadline
+            late = now - deadline
+            self.ticks += 1
+            self._late_sum += late
+            self._late_sq_sum += late * late
+            self._late_max = max(self._late_max, late)
+            self._late_last = late
+            if STATS is None:
+                yield n
+            else:
+                body_start = time.perf_counter_ns()
+                io_start = STATS.io_ns()
+                yield n
+                STATS.record_frame(self.name, time.perf_counter_ns() - body_start,
+                                   STATS.io_ns() - io_start)
+
+            n += 1
+            if self.policy == TICK_DROP:
+                # Slot of the current time, skip to it if we're behind
+                current = (time.monotonic_ns() - start) // self.period
+                if current > n:
+                    self.dropped += current - n
+                    n = current
+
+    def stats(self):
+        """Lateness of the ticks, compared to their deadlines, in milliseconds.
+        Jitter is the standard deviation, drift how late the last tick was."""
+        ticks = max(self.ticks, 1)
+        mean = self._late_sum / ticks
+        variance = max(self._late_sq_sum / ticks - mean * mean, 0)
+        return {
+            'ticks': self.ticks,
+            'dropped': self.dropped,
+            'mean_late_ms': mean / 1e6,
+            'jitter_ms': math.sqrt(variance) / 1e6,
+            'max_late_ms': self._late_max / 1e6,
+            'drift_ms': self._late_last / 1e6,
+        }
 
 
 def countdown(seconds):
     """ Run a countdown timer. Lighting more LEDs every 100th of a seconds.
     Until the timer runs out and every LED is lit"""
-    start = datetime.now()
-    target = seconds * 1_000_000
-    global STOP_THREAD
-    while True:
-        if STOP_THREAD:
-            STOP_THREAD = False
-            return
-        now = datetime.now()
-        passed_time = (now - start) / timedelta(microseconds=1)
-
-        ratio = passed_time / target
-        if passed_time >= target:
+    ticker = Ticker(100, stop=STOP_THREAD, name='countdown')
+    start = time.monotonic()
+    for _ in ticker:
+        ratio = (time.monotonic() - start) / seconds
+        if ratio >= 1:
             break
 
         leds = int(306 * ratio)
         light_leds(leds)
 
-        time.sleep(0.01)
+    if ticker.cancelled:
+        STOP_THREAD.clear()
+        return
 
     light_leds(306)
     # breathing()
@@ -561,126 +1010,190 @@ def countdown(seconds):
 def blinking():
     """Blink brightness high/off every second.
     Keeps currently displayed grid"""
-    while True:
-        brightness(0)
-        time.sleep(0.5)
-        brightness(200)
-        time.sleep(0.5)
+    for tick in Ticker(2, stop=STOP_THREAD, name='blinking'):
+        brightness(0 if tick % 2 == 0 else 200)
+    STOP_THREAD.clear()
+
+
+# Brightness of the breathing animation, one value per 30ms.
+# Bright ranges appear similar, so we have to go through those faster.
+BREATHING_STEPS = (
+    # Go quickly from 250 to 50
+    [250 - i*20 for i in range(10)]
+    # Go slowly from 50 to 0
+    + [50 - i*5 for i in range(10) for _ in range(2)]
+    # Go slowly from 0 to 50
+    + [i*5 for i in range(10) for _ in range(2)]
+    # Go quickly from 50 to 250
+    + [50 + i*20 for i in range(10)]
+)
 
 
 def breathing():
     """Animate breathing brightness.
     Keeps currently displayed grid"""
-    # Bright ranges appear similar, so we have to go through those faster
-    while True:
-        # Go quickly from 250 to 50
-        for i in range(10):
-            time.sleep(0.03)
-            brightness(250 - i*20)
-
-        # Go slowly from 50 to 0
-        for i in range(10):
-            time.sleep(0.06)
-            brightness(50 - i*5)
-
-        # Go slowly from 0 to 50
-        for i in range(10):
-            time.sleep(0.06)
-            brightness(i*5)
-
-        # Go quickly from 50 to 250
-        for i in range(10):
-            time.sleep(0.03)
-            brightness(50 + i*20)
-
+    current = None
+    for tick in Ticker(1 / 0.03, stop=STOP_THREAD, name='breathing'):
+        step = BREATHING_STEPS[tick % len(BREATHING_STEPS)]
+        # Slow parts hold each value for two ticks
+        if step != current:
+            brightness(step)
+            current = step
+    STOP_THREAD.clear()
+
+
+# Key presses kept while the game is busy. Beyond that reading keys pauses.
+INPUT_QUEUE_SIZE = 16
+
+
+class InputPipeline:
+    """Reads keys on a background thread and turns them into GameControlVal
+    events, through `keymap`.
+
+    Events wait in a deque, which appends and pops atomically without a lock.
+    Key presses are never dropped: once `size` events wait, reading keys
+    pauses until the game takes them, and the keys wait in the terminal
+    meanwhile.
+    Events in `coalesce` only set a state, like the direction of the snake.
+    A repeat of the newest waiting one, like from a key that's held down,
+    changes nothing and is coalesced into it. Other events, like moving the
+    paddle, count every time.
+    Every event carries the time the key was read. Call `done` with it once
+    the event has reached the LEDs, to measure the input latency.
+    """
 
-direction = None
-body = []
+    def __init__(self, keymap, name='input', read_key=None, size=INPUT_QUEUE_SIZE, coalesce=()):
+        self.keymap = keymap
+        self.name = name
+        # Returns the next key, None at the end of input. getkey by default.
+        self.read_key = read_key
+        self.size = size
+        self.coalesce = frozenset(coalesce)
+        self._events = deque()
+        self._ready = threading.Event()
+        self._taken = threading.Event()
+        self._thread = None
+        self.received = 0
+        self.coalesced = 0
+        self.latency = Histogram()
+
+    def start(self):
+        """Start reading keys"""
+        if self.read_key is None:
+            from getkey import getkey
+            self.read_key = getkey
+        self._thread = threading.Thread(target=self._read_keys, daemon=True)
+        self._thread.start()
+        return self
+
+    def _read_keys(self):
+        while True:
+            key = self.read_key()
+            if key is None:
+                return
+            event = self.keymap.get(key)
+            if event is not None:
+                self.put(event)
+
+    def put(self, event, t=None):
+        """Queue an event that happened at time.perf_counter_ns() t, now by default"""
+        if t is None:
+            t = time.perf_counter_ns()
+        self.received += 1
+        if event in self.coalesce:
+            try:
+                if self._events[-1][0] == event:
+                    self.coalesced += 1
+                    return
+            except IndexError:
+                pass
+        while len(self._events) >= self.size:
+            self._taken.clear()
+            # Check again, poll may have emptied it before the clear
+            if len(self._events) < self.size:
+                break
+            self._taken.wait()
+        self._events.append((event, t))
+        self._ready.set()
+
+    def poll(self):
+        """Take all waiting events without blocking, as (event, time) tuples"""
+        self._ready.clear()
+        events = []
+        while True:
+            try:
+                events.append(self._events.popleft())
+            except IndexError:
+                self._taken.set()
+                return events
+
+    def wait(self, timeout=None):
+        """Wait for events and take them"""
+        self._ready.wait(timeout)
+        return self.poll()
+
+    def done(self, t):
+        """An event that happened at t is shown now"""
+        ns = time.perf_counter_ns() - t
+        self.latency.observe(ns / 1e9)
+        if STATS is not None:
+            STATS.record_input(self.name, ns)
+
+
+def forward_game_control(pipeline, dev=None):
+    """Send the events of an InputPipeline to the game running on the module,
+    over its pooled connection, until Quit"""
+    dev = dev or SERIAL_DEV
+    while True:
+        events = pipeline.wait()
+        with SERIAL_POOL.connection(dev) as s:
+            for (event, t) in events:
+                raw = encode_command(CommandVals.GameControl, [event])
+                command_sent(dev, raw)
+                send_serial(s, raw)
+                pipeline.done(t)
+        if any(event == GameControlVal.Quit for (event, _) in events):
+            return
 
 
-def opposite_direction(direction):
+def arrow_keymap():
     from getkey import keys
-    if direction == keys.RIGHT:
-        return keys.LEFT
-    elif direction == keys.LEFT:
-        return keys.RIGHT
-    elif direction == keys.UP:
-        return keys.DOWN
-    elif direction == keys.DOWN:
-        return keys.UP
-    return direction
-
-
-def snake_keyscan():
-    from getkey import getkey, keys
-    global direction
-    global body
+    return {
+        keys.UP: GameControlVal.Up,
+        keys.DOWN: GameControlVal.Down,
+        keys.LEFT: GameControlVal.Left,
+        keys.RIGHT: GameControlVal.Right,
+        'q': GameControlVal.Quit,
+    }
 
-    while True:
-        current_dir = direction
-        key = getkey()
-        if key in [keys.RIGHT, keys.UP, keys.LEFT, keys.DOWN]:
-            # Don't allow accidental suicide if we have a body
-            if key == opposite_direction(current_dir) and body:
-                continue
-            direction = key
+
+OPPOSITE_DIRECTION = {
+    GameControlVal.Up: GameControlVal.Down,
+    GameControlVal.Down: GameControlVal.Up,
+    GameControlVal.Left: GameControlVal.Right,
+    GameControlVal.Right: GameControlVal.Left,
+}
 
 
 def snake_embedded_keyscan():
-    from getkey import getkey, keys
+    pipeline = InputPipeline(arrow_keymap(), 'snake_embedded', coalesce=OPPOSITE_DIRECTION)
+    forward_game_control(pipeline.start())
 
-    while True:
-        key_arg = None
-        key = getkey()
-        if key == keys.UP:
-            key_arg = GameControlVal.Up
-        elif key == keys.DOWN:
-            key_arg = GameControlVal.Down
-        elif key == keys.LEFT:
-            key_arg = GameControlVal.Left
-        elif key == keys.RIGHT:
-            key_arg = GameControlVal.Right
-        elif key == 'q':
-            # Quit
-            key_arg = GameControlVal.Quit
-        if key_arg is not None:
-            send_command(CommandVals.GameControl, [key_arg])
-
-
-def game_over():
-    global body
-    while True:
-        show_string('GAME ')
-        time.sleep(0.75)
-        show_string('OVER!')
-        time.sleep(0.75)
-        score = len(body)
-        show_string(f'{score:>3} P')
-        time.sleep(0.75)
+
+def game_over(score):
+    messages = ['GAME ', 'OVER!', f'{score:>3} P']
+    for tick in Ticker(1 / 0.75, name='game_over'):
+        show_string(messages[tick % len(messages)])
 
 
 def pong_embedded():
     # Start game
     send_command(CommandVals.StartGame, [Game.Pong])
 
-    from getkey import getkey, keys
-
-    while True:
-        key_arg = None
-        key = getkey()
-        if key == keys.LEFT:
-            key_arg = ARG_LEFT
-        elif key == keys.RIGHT:
-            key_arg = ARG_RIGHT
-        elif key == 'a':
-            key_arg = ARG_2LEFT
-        elif key == 'd':
-            key_arg = ARG_2RIGHT
-        elif key == 'q':
-            # Quit
-            key_arg = ARG_QUIT
-        if key_arg is not None:
-            send_command(CommandVals.GameControl, [key_arg])
+    keymap = arrow_keymap()
+    keymap['a'] = GameControlVal.SecondLeft
+    keymap['d'] = GameControlVal.SecondRight
+    forward_game_control(InputPipeline(keymap, 'pong_embedded').start())
 
 
 def game_of_life_embedded(arg):
@@ -690,6 +1203,132 @@ def game_of_life_embedded(arg):
     send_command(CommandVals.StartGame, [Game.GameOfLife, int(arg)])
 
 
+# The firmware advances the Game of Life every 500ms
+LIFE_FPS = 2
+
+
+def life_seed_cells(param):
+    """Live cells of a start pattern of the firmware, as (row, col) of its grid"""
+    if param == GameOfLifeStartParam.Pattern1:
+        # Starts off with lots of alive cells, quickly reduced.
+        # Eventually reaches a stable pattern without changes.
+        return [(row, col) for col in range(WIDTH) for row in range(HEIGHT)
+                if (col * HEIGHT + row) % 2 == 0 or (col * HEIGHT + row) % 7 == 0]
+    return {
+        GameOfLifeStartParam.Blinker: [(10, 5), (10, 6), (10, 7), (14, 5), (14, 6), (14, 7)],
+        GameOfLifeStartParam.Toad: [(10, 4), (10, 5), (10, 6), (11, 5), (11, 6), (11, 7)],
+        GameOfLifeStartParam.Beacon: [(10, 4), (10, 5), (11, 4), (11, 5),
+                                      (12, 6), (12, 7), (13, 6), (13, 7)],
+        GameOfLifeStartParam.Glider: [(2, 3), (3, 4), (4, 2), (4, 3), (4, 4),
+                                      (20, 5), (21, 6), (22, 4), (22, 5), (22, 6)],
+    }[param]
+
+
+class Life:
+    """Conway's Game of Life on a torus, like game_of_life_embedded runs it
+    on the module, for one or several LED matrices side by side.
+
+    The board is a single int with bit x + width*y per cell, the layout of
+    Draw, so a generation is a few dozen bitwise operations on all cells at
+    once. Neighbours are counted with bit-sliced adders.
+    """
+
+    def __init__(self, width=WIDTH, height=HEIGHT, cells=0):
+        self.width = width
+        self.height = height
+        self.size = width * height
+        self.full = leds_mask(self.size)
+        self.first_col = sum(1 << (width * y) for y in range(height))
+        self.last_col = self.first_col << (width - 1)
+        self.cells = cells
+        self.generation = 0
+
+    @classmethod
+    def seeded(cls, param, modules=1):
+        """Start with one of the firmware's patterns on every module"""
+        life = cls(WIDTH * modules, HEIGHT)
+        for m in range(modules):
+            for (row, col) in life_seed_cells(param):
+                # Draw mirrors the columns of the firmware's grid
+                life.set(m * WIDTH + WIDTH - 1 - col, row)
+        return life
+
+    def set(self, x, y, alive=True):
+        bit = 1 << (x + self.width * y)
+        self.cells = self.cells | bit if alive else self.cells & ~bit
+
+    def alive(self, x, y):
+        return bool(self.cells >> (x + self.width * y) & 1)
+
+    def population(self):
+        return bin(self.cells).count("1")
+
+    def _rotate(self, b, n):
+        """Move every cell n bits up, wrapping around the board"""
+        n %= self.size
+        return ((b << n) | (b >> (self.size - n))) & self.full
+
+    def step(self):
+        """Advance by one generation"""
+        b = self.cells
+        w = self.width
+        # Neighbour to the right and to the left of each cell, wrapping within the row
+        east = ((b >> 1) & ~self.last_col) | ((b & self.first_col) << (w - 1))
+        west = ((b << 1) & ~self.first_col & self.full) | ((b & self.last_col) >> (w - 1))
+        neighbours = [east, west]
+        for row in [b, east, west]:
+            # Same for the rows above and below
+            neighbours.append(self._rotate(row, w))
+            neighbours.append(self._rotate(row, -w))
+
+        # Count in binary, one bit of the count per int. fours is sticky,
+        # four or more neighbours kill a cell anyway.
+        ones = twos = fours = 0
+        for n in neighbours:
+            carry = ones & n
+            ones ^= n
+            fours |= twos & carry
+            twos ^= carry
+        # Three neighbours, or two and alive
+        self.cells = twos & (ones | b) & ~fours & self.full
+        self.generation += 1
+
+    def run(self, generations):
+        for _ in range(generations):
+            self.step()
+
+    def draw_vals(self, module=0):
+        """Payload of Draw for one of the modules"""
+        if self.width == WIDTH:
+            return self.cells.to_bytes(DRAW_BYTES, 'little')
+        mask = 0
+        for y in range(self.height):
+            row = (self.cells >> (y * self.width + module * WIDTH)) & leds_mask(WIDTH)
+            mask |= row << (y * WIDTH)
+        return mask.to_bytes(DRAW_BYTES, 'little')
+
+
+def game_of_life(param, fps=None):
+    """Run the Game of Life on the host and show every generation.
+    Same patterns and speed as game_of_life_embedded."""
+    life = Life.seeded(param)
+    fb = Framebuffer()
+    for _ in Ticker(fps or LIFE_FPS, stop=STOP_THREAD, name='game_of_life'):
+        fb.load(life.draw_vals())
+        fb.show()
+        life.step()
+
+
+def game_of_life_canvas(param, fps=None):
+    """Run the Game of Life across all LED matrices side by side"""
+    with ModuleGroup(find_modules()) as group:
+        life = Life.seeded(param, len(group.matrices))
+        for _ in Ticker(fps or LIFE_FPS, stop=STOP_THREAD, name='game_of_life'):
+            group.shard({m: [encode_command(CommandVals.Draw, life.draw_vals(i))]
+                         for (i, m) in enumerate(group.matrices)})
+            life.step()
+
+
 def snake_embedded():
     # Start game
     send_command(CommandVals.StartGame, [Game.Snake])
@@ -697,84 +1336,164 @@ def snake_embedded():
     snake_embedded_keyscan()
 
 
-def snake():
-    from getkey import keys
-    global direction
-    global body
-    head = (0, 0)
-    direction = keys.DOWN
-    food = (0, 0)
-    while food == head:
-        food = (random.randint(0, WIDTH-1),
-                random.randint(0, HEIGHT-1))
-
-    # Setting
-    WRAP = False
-
-    thread = threading.Thread(target=snake_keyscan, args=(), daemon=True)
-    thread.start()
+class GameEngine(ABC):
+    """Core of the host side games. The game advances in fixed steps, `tps`
+    per second, and draws what changed into a persistent Framebuffer.
 
-    prev = datetime.now()
-    while True:
-        now = datetime.now()
-        delta = (now - prev) / timedelta(milliseconds=1)
+    Showing frames is decoupled from the steps: if the loop falls behind, it
+    catches up on the steps and only shows the latest frame. `simulate` runs
+    the steps as fast as possible, without a module, for tests and benchmarks.
+    Subclasses implement `control` and `update` and set `over` when the game
+    has ended. Quit ends any game.
+    """
 
-        if delta > 200:
-            prev = now
-        else:
-            continue
-
-        # Update position
-        (x, y) = head
-        oldhead = head
-        if direction == keys.RIGHT:
-            head = (x+1, y)
-        elif direction == keys.LEFT:
-            head = (x-1, y)
-        elif direction == keys.UP:
-            head = (x, y-1)
-        elif direction == keys.DOWN:
-            head = (x, y+1)
+    def __init__(self, tps, name='game'):
+        self.tps = tps
+        self.name = name
+        self.fb = Framebuffer()
+        self.ticks = 0
+        self.over = False
+        self.quit = False
+
+    def control(self, events):
+        """Handle the GameControlVal events since the last step"""
+
+    @abstractmethod
+    def update(self):
+        """Advance the game by one step"""
+
+    def step(self, events=()):
+        if GameControlVal.Quit in events:
+            self.over = True
+            self.quit = True
+            return
+        self.control(events)
+        self.update()
+        self.ticks += 1
+
+    def simulate(self, ticks, controller=None):
+        """Run up to `ticks` steps right away. controller(game) returns the
+        events for each step. Returns the number of steps run."""
+        start = self.ticks
+        while self.ticks - start < ticks and not self.over:
+            self.step(controller(self) if controller is not None else ())
+        return self.ticks - start
+
+    def run(self, controls=None, stop=None, dev=None):
+        """Play in real time, with the input of an InputPipeline, until the
+        game is over"""
+        ticker = Ticker(self.tps, TICK_CATCHUP, stop=stop, name=self.name)
+        shown = []
+        for _ in ticker:
+            events = controls.poll() if controls is not None else []
+            shown += events
+            self.step([event for (event, _) in events])
+            if self.over or not ticker.behind():
+                self.fb.show(dev)
+                for (_, t) in shown:
+                    controls.done(t)
+                shown = []
+            if self.over:
+                return
+
+
+def cell_bit(x, y):
+    return 1 << (x + WIDTH * y)
+
+
+class SnakeGame(GameEngine):
+    """Snake, eating food makes it longer. Running into itself or, unless
+    `wrap`, into the edge ends the game.
+
+    The snake is a deque of cells from head to tail and an occupancy bitset
+    of the same cells, bit x + WIDTH*y, so that moving and collision checks
+    don't depend on its length. Only the cells that changed are drawn.
+    """
+
+    def __init__(self, wrap=False, tps=5, rng=None):
+        super().__init__(tps, name='snake')
+        if rng is None:
+            import random
+            rng = random.Random()
+        self.rng = rng
+        self.wrap = wrap
+        self.direction = GameControlVal.Down
+        self.head = (0, 0)
+        self.cells = deque([self.head])
+        self.occupied = cell_bit(*self.head)
+        self.fb.set(*self.head)
+        self.food = self.head
+        self.place_food()
+
+    @property
+    def score(self):
+        return len(self.cells) - 1
+
+    def place_food(self):
+        if self.occupied == leds_mask(WIDTH * HEIGHT):
+            # Nowhere left, the snake fills the screen
+            self.over = True
+            return
+        while self.occupied & cell_bit(*self.food):
+            self.food = (self.rng.randint(0, WIDTH-1),
+                         self.rng.randint(0, HEIGHT-1))
+        self.fb.set(*self.food)
+
+    def control(self, events):
+        moving = self.direction
+        for event in events:
+            # Don't allow accidental suicide if we have a body
+            if event == OPPOSITE_DIRECTION.get(moving) and self.score:
+                continue
+            if event in OPPOSITE_DIRECTION:
+                self.direction = event
+
+    def update(self):
+        (x, y) = self.head
+        if self.direction == GameControlVal.Right:
+            x += 1
+        elif self.direction == GameControlVal.Left:
+            x -= 1
+        elif self.direction == GameControlVal.Up:
+            y -= 1
+        elif self.direction == GameControlVal.Down:
+            y += 1
 
         # Detect edge condition
-        (x, y) = head
-        if head in body:
-            return game_over()
-        elif x >= WIDTH or x < 0 or y >= HEIGHT or y < 0:
-            if WRAP:
-                if x >= WIDTH:
-                    x = 0
-                elif x < 0:
-                    x = WIDTH-1
-                elif y >= HEIGHT:
-                    y = 0
-                elif y < 0:
-                    y = HEIGHT-1
-                head = (x, y)
-            else:
-                return game_over()
-        elif head == food:
-            body.insert(0, oldhead)
-            while food == head:
-                food = (random.randint(0, WIDTH-1),
-                        random.randint(0, HEIGHT-1))
-        elif body:
-            body.pop()
-            body.insert(0, oldhead)
-
-        # Draw on screen
-        matrix = [[0 for _ in range(HEIGHT)] for _ in range(WIDTH)]
-        matrix[x][y] = 1
-        matrix[food[0]][food[1]] = 1
-        for bodypart in body:
-            (x, y) = bodypart
-            matrix[x][y] = 1
-        render_matrix(matrix)
+        if x >= WIDTH or x < 0 or y >= HEIGHT or y < 0:
+            if not self.wrap:
+                self.over = True
+                return
+            x %= WIDTH
+            y %= HEIGHT
+        bit = cell_bit(x, y)
+        if self.occupied & bit:
+            self.over = True
+            return
+
+        self.head = (x, y)
+        self.cells.appendleft(self.head)
+        self.occupied |= bit
+        self.fb.set(x, y)
+        if self.head == self.food:
+            self.place_food()
+        else:
+            tail = self.cells.pop()
+            self.occupied &= ~cell_bit(*tail)
+            self.fb.set(*tail, 0)
+
+
+def snake():
+    game = SnakeGame()
+    game.run(InputPipeline(arrow_keymap(), 'snake', coalesce=OPPOSITE_DIRECTION).start())
+    if not game.quit:
+        game_over(game.score)
 
 
 def wpm_demo():
     """Capture keypresses and calculate the WPM of the last 10 seconds
     TODO: I'm not sure my calculation is right."""
+    from datetime import datetime
     from getkey import getkey, keys
     start = datetime.now()
     keypresses = []
@@ -797,58 +1516,456 @@ def wpm_demo():
 def random_eq():
     """Display an equlizer looking animation with random values.
     """
-    global STOP_THREAD
-    while True:
-        if STOP_THREAD:
-            STOP_THREAD = False
-            return
-        # Lower values more likely, makes it look nicer
-        weights = [i*i for i in range(33, 0, -1)]
-        population = list(range(1, 34))
+    import random
+    # Lower values more likely, makes it look nicer
+    weights = [i*i for i in range(33, 0, -1)]
+    population = list(range(1, 34))
+    fb = Framebuffer()
+    for _ in Ticker(5, stop=STOP_THREAD, name='random_eq'):
         vals = random.choices(population, weights=weights, k=9)
-        eq(vals)
-        time.sleep(0.2)
+        eq(vals, fb)
+    STOP_THREAD.clear()
+
 
+def eq(vals, fb=None):
+    """Display 9 values in equalizer diagram starting from the middle, going up and down.
+    Pass the same Framebuffer to draw each frame into it."""
+    if fb is None:
+        fb = Framebuffer()
+    draw_eq(fb, vals)
+    fb.show()
 
-def eq(vals):
-    """Display 9 values in equalizer diagram starting from the middle, going up and down"""
-    matrix = [[0 for _ in range(34)] for _ in range(9)]
 
+def draw_eq(fb, vals, value=0xFF):
+    fb.clear()
     for (col, val) in enumerate(vals[:9]):
         row = int(34 / 2)
         above = int(val / 2)
         below = val - above
+        fb.rect(col, row - below, 1, above + below, value)
+
+
+AUDIO_RATE = 44100
+AUDIO_FPS = 30
+# Samples per FFT, about 46ms at 44.1kHz. Only this many are kept.
+AUDIO_FFT_SIZE = 2048
+# Samples read at once, 10ms at 44.1kHz
+AUDIO_CHUNK = 441
+# Frequencies that the equalizer shows, split into one band per column
+AUDIO_MIN_FREQ = 40
+AUDIO_MAX_FREQ = 16000
+# Levels this many dB or more below full scale show as empty columns
+AUDIO_DYNAMIC_RANGE = 60
+# Brightness of the bars, their peaks are at full brightness
+AUDIO_BAR_LEVEL = 0x40
+
+
+class SampleRing:
+    """Keeps the latest `size` samples, older ones are overwritten.
+    Written by the thread reading the audio, read by the one rendering it."""
+
+    def __init__(self, size):
+        import numpy as np
+        self.size = size
+        self.buf = np.zeros(size, dtype=np.float32)
+        self.pos = 0
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def write(self, samples):
+        n = len(samples)
+        with self._lock:
+            if n >= self.size:
+                self.buf[:] = samples[-self.size:]
+                self.pos = 0
+            else:
+                end = self.pos + n
+                if end <= self.size:
+                    self.buf[self.pos:end] = samples
+                else:
+                    split = self.size - self.pos
+                    self.buf[self.pos:] = samples[:split]
+                    self.buf[:n - split] = samples[split:]
+                self.pos = end % self.size
+            self.total += n
+
+    def latest(self):
+        """All samples, oldest first"""
+        import numpy as np
+        with self._lock:
+            return np.concatenate((self.buf[self.pos:], self.buf[:self.pos]))
+
+
+class AudioSpectrum:
+    """Turns the latest audio samples into equalizer levels from 0 to 1.
+
+    The power spectrum of a Hann windowed FFT over the samples in `ring` is
+    split into `bands` bands, evenly spaced on a log scale, each as loud as
+    its loudest frequency, relative to a full scale sine wave. Levels jump up
+    and fall by `decay` per frame. Peaks stay for `hold` frames, then fall.
+    """
+
+    def __init__(self, rate=AUDIO_RATE, fft_size=AUDIO_FFT_SIZE, bands=WIDTH, decay=0.05, hold=15):
+        import numpy as np
+        self.rate = rate
+        self.decay = decay
+        self.hold = hold
+        self.ring = SampleRing(fft_size)
+        self.window = np.hanning(fft_size).astype(np.float32)
+        # A full scale sine peaks at half the window's sum
+        self.full_scale = (self.window.sum() / 2) ** 2
+
+        freqs = np.fft.rfftfreq(fft_size, 1 / rate)
+        edges = np.searchsorted(freqs, np.geomspace(AUDIO_MIN_FREQ, min(AUDIO_MAX_FREQ, rate / 2), bands + 1))
+        # Low bands are narrower than an FFT bin, give each at least one
+        for i in range(1, len(edges)):
+            edges[i] = max(edges[i], edges[i - 1] + 1)
+        self.starts = edges[:-1]
+        self.end = edges[-1]
+
+        self.levels = np.zeros(bands)
+        self.peaks = np.zeros(bands)
+        self.held = np.zeros(bands, dtype=int)
+
+    def analyse(self):
+        """Levels of the latest samples, without decay"""
+        import numpy as np
+        spectrum = np.fft.rfft(self.ring.latest() * self.window)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        bands = np.maximum.reduceat(power[:self.end], self.starts)
+        db = 10 * np.log10(bands / self.full_scale + 1e-12)
+        return np.clip(1 + db / AUDIO_DYNAMIC_RANGE, 0, 1)
+
+    def update(self):
+        """Levels and peaks of the next frame"""
+        import numpy as np
+        self.levels = np.maximum(self.analyse(), self.levels - self.decay)
+        rising = self.levels >= self.peaks
+        self.held = np.where(rising, 0, self.held + 1)
+        falling = self.held > self.hold
+        self.peaks = np.where(rising, self.levels,
+                              np.where(falling, np.maximum(self.peaks - self.decay, self.levels), self.peaks))
+        return (self.levels, self.peaks)
+
+
+class PcmReader:
+    """Reads mono samples from -1 to 1 out of a WAV file or raw signed 16-bit
+    little endian mono PCM, from a file, a pipe or '-' for stdin.
+    Files are read no faster than they'd play, see `paced`."""
+
+    def __init__(self, source, rate=AUDIO_RATE):
+        self.rate = rate
+        self.channels = 1
+        self.width = 2
+        self._file = sys.stdin.buffer if source == '-' else open(source, 'rb')
+        self._wav = None
+        if self._file.peek(4)[:4] == b'RIFF':
+            import wave
+            self._wav = wave.open(self._file, 'rb')
+            self.rate = self._wav.getframerate()
+            self.channels = self._wav.getnchannels()
+            self.width = self._wav.getsampwidth()
+            if self.width not in [1, 2, 4]:
+                raise ValueError("Only 8, 16 and 32-bit WAV files are supported")
+        # Pipes deliver audio as it plays, files all at once
+        self.paced = self._file.seekable()
+
+    def read(self, frames):
+        """Up to `frames` samples, None at the end"""
+        import numpy as np
+        if self._wav is not None:
+            data = self._wav.readframes(frames)
+        else:
+            data = self._file.read(frames * self.width * self.channels)
+        count = len(data) // (self.width * self.channels)
+        if count == 0:
+            return None
+        data = data[:count * self.width * self.channels]
+        if self.width == 1:
+            samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128) / 128
+        else:
+            dtype = {2: '<i2', 4: '<i4'}[self.width]
+            samples = np.frombuffer(data, dtype=dtype).astype(np.float32) / (1 << (8 * self.width - 1))
+        return samples.reshape(count, self.channels).mean(axis=1)
+
+    def close(self):
+        if self._file is not sys.stdin.buffer:
+            self._file.close()
+
+
+def draw_spectrum(fb, levels, peaks):
+    """Draw equalizer levels from 0 to 1 like eq(), with the peaks at the
+    ends of each bar"""
+    draw_eq(fb, [round(level * HEIGHT) for level in levels], AUDIO_BAR_LEVEL)
+    for (col, peak) in enumerate(peaks[:WIDTH]):
+        val = round(peak * HEIGHT)
+        if val:
+            row = int(34 / 2)
+            above = int(val / 2)
+            fb.set(col, row - (val - above))
+            fb.set(col, row + above - 1)
+
+
+def audio_eq(source, fps=None, rate=AUDIO_RATE):
+    """Equalizer of live audio, see PcmReader for the sources.
+    A thread reads the audio into a ring buffer as it comes, so no backlog
+    builds up, and every frame shows the spectrum of the latest samples."""
+    reader = PcmReader(source, rate)
+    spectrum = AudioSpectrum(reader.rate)
+    ended = threading.Event()
+
+    def read_audio():
+        start = time.monotonic()
+        total = 0
+        while not STOP_THREAD.is_set():
+            samples = reader.read(AUDIO_CHUNK)
+            if samples is None:
+                break
+            spectrum.ring.write(samples)
+            total += len(samples)
+            if reader.paced:
+                delay = start + total / reader.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        ended.set()
+
+    thread = threading.Thread(target=read_audio, daemon=True)
+    thread.start()
+    fb = Framebuffer(greyscale=True)
+    for _ in Ticker(fps or AUDIO_FPS, stop=ended, name='audio_eq'):
+        draw_spectrum(fb, *spectrum.update())
+        fb.show()
+    reader.close()
+    STOP_THREAD.clear()
+
+
+# The Draw command packs the 9x34 black/white pixels into 39 bytes, pixel
+# x + 9*y into bit (i % 8) of byte (i / 8). Taken together as a little endian
+# integer, that's simply bit x + 9*y. So frames are composed as integer
+# bitmasks and converted to bytes once at the end.
+DRAW_BYTES = 39
+
+# Bitmask of every pixel, index with [x][y]
+PIXEL_MASKS = [[1 << (x + WIDTH * y) for y in range(HEIGHT)] for x in range(WIDTH)]
+
+# Font items are 5x6 pixels, with 2 pixels margin to the left.
+# Five of them fit on the screen, each slot is 7 rows high.
+FONT_SLOTS = 5
+FONT_SLOT_SHIFT = WIDTH * 7
+
+_GLYPH_MASKS = {}
+
+
+def glyph_masks(glyph):
+    """Bitmasks of a 5x6 font item, for each of the five slots.
+    Computed once per font item"""
+    key = bytes(glyph)
+    masks = _GLYPH_MASKS.get(key)
+    if masks is None:
+        base = 0
+        for i, pixel in enumerate(key):
+            if pixel:
+                base |= PIXEL_MASKS[2 + i % 5][i // 5]
+        masks = tuple(base << (FONT_SLOT_SHIFT * slot) for slot in range(FONT_SLOTS))
+        _GLYPH_MASKS[key] = masks
+    return masks
+
+
+def draw_vals(mask):
+    """Convert a frame bitmask to the payload of the Draw command"""
+    return list(mask.to_bytes(DRAW_BYTES, 'little'))
+
+
+def matrix_mask(matrix):
+    """Bitmask of a black/white matrix, indexed by [x][y]"""
+    mask = 0
+    for column, pixels in zip(PIXEL_MASKS, matrix):
+        for pixel_mask, pixel in zip(column, pixels):
+            if pixel:
+                mask |= pixel_mask
+    return mask
 
-        for i in range(above):
-            matrix[col][row+i] = 0xFF
-        for i in range(below):
-            matrix[col][row-1-i] = 0xFF
 
-    render_matrix(matrix)
+def font_mask(font_items):
+    """Bitmask of up to five 5x6 pixel font items"""
+    mask = 0
+    for slot, glyph in enumerate(font_items[:FONT_SLOTS]):
+        mask |= glyph_masks(glyph)[slot]
+    return mask
+
+
+def leds_mask(leds):
+    """Bitmask of the first few LEDs"""
+    return (1 << leds) - 1
 
 
 def render_matrix(matrix):
     """Show a black/white matrix
     Send everything in a single command"""
-    vals = [0x00 for _ in range(39)]
-
-    for x in range(9):
-        for y in range(34):
-            i = x + 9*y
-            if matrix[x][y]:
-                vals[int(i/8)] = vals[int(i/8)] | (1 << i % 8)
-
-    send_command(CommandVals.Draw, vals)
+    send_command(CommandVals.Draw, draw_vals(matrix_mask(matrix)))
 
 
 def light_leds(leds):
     """ Light a specific number of LEDs """
-    vals = [0x00 for _ in range(39)]
-    for byte in range(int(leds / 8)):
-        vals[byte] = 0xFF
-    for i in range(leds % 8):
-        vals[int(leds / 8)] += 1 << i
-    send_command(CommandVals.Draw, vals)
+    send_command(CommandVals.Draw, draw_vals(leds_mask(leds)))
+
+
+# Bitmask of the first pixel of the first n rows, index with [n]
+COLUMN_BITS = [sum(1 << (WIDTH * y) for y in range(n)) for n in range(HEIGHT + 1)]
+ALL_ON = leds_mask(WIDTH * HEIGHT).to_bytes(DRAW_BYTES, 'little')
+ALL_OFF = bytes(DRAW_BYTES)
+
+
+class Framebuffer:
+    """Reusable WIDTH x HEIGHT frame, backed by a bytearray in wire format.
+
+    In black/white mode the pixels are packed like the payload of Draw.
+    In greyscale mode there's one byte per pixel, column by column, so each
+    column is the payload of StageGreyCol.
+    Drawing outside of the frame is clipped. Showing a frame that the module
+    already shows sends nothing, so it can be redrawn from scratch every time.
+    """
+    __slots__ = ('greyscale', 'buf')
+
+    def __init__(self, greyscale=False):
+        self.greyscale = greyscale
+        self.buf = bytearray(WIDTH * HEIGHT if greyscale else DRAW_BYTES)
+
+    def pixel(self, x, y):
+        """Brightness of a pixel, 0 or 0xFF in black/white mode"""
+        if self.greyscale:
+            return self.buf[x * HEIGHT + y]
+        i = x + WIDTH * y
+        return 0xFF if self.buf[i >> 3] & (1 << (i & 7)) else 0
+
+    def set(self, x, y, value=0xFF):
+        """Set a pixel, nothing happens outside of the frame"""
+        if not (0 <= x < WIDTH and 0 <= y < HEIGHT):
+            return
+        if self.greyscale:
+            self.buf[x * HEIGHT + y] = value
+            return
+        i = x + WIDTH * y
+        if value:
+            self.buf[i >> 3] |= 1 << (i & 7)
+        else:
+            self.buf[i >> 3] &= ~(1 << (i & 7))
+
+    def clear(self, value=0):
+        """Set every pixel"""
+        if self.greyscale:
+            frame = bytes([value]) * len(self.buf)
+        elif value:
+            # Don't light the padding after the last pixel
+            frame = ALL_ON
+        else:
+            frame = ALL_OFF
+        self.buf[:] = frame
+
+    def rect(self, x, y, w, h, value=0xFF, fill=True):
+        """Draw a rectangle, filled or just the outline"""
+        if not fill:
+            self.rect(x, y, w, 1, value)
+            self.rect(x, y + h - 1, w, 1, value)
+            self.rect(x, y, 1, h, value)
+            self.rect(x + w - 1, y, 1, h, value)
+            return
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, WIDTH), min(y + h, HEIGHT)
+        if x0 >= x1 or y0 >= y1:
+            return
+        buf = self.buf
+        if self.greyscale:
+            span = bytes([value]) * (y1 - y0)
+            for px in range(x0, x1):
+                buf[px * HEIGHT + y0:px * HEIGHT + y1] = span
+        else:
+            # One bit per column in each row, repeated for each row
+            mask = (((1 << (x1 - x0)) - 1) * COLUMN_BITS[y1 - y0]) << (x0 + WIDTH * y0)
+            old = int.from_bytes(buf, 'little')
+            buf[:] = (old | mask if value else old & ~mask).to_bytes(DRAW_BYTES, 'little')
+
+    def line(self, x0, y0, x1, y1, value=0xFF):
+        """Draw a line from x0, y0 to x1, y1, both included"""
+        if x0 == x1 or y0 == y1:
+            self.rect(min(x0, x1), min(y0, y1), abs(x1 - x0) + 1, abs(y1 - y0) + 1, value)
+            return
+        dx, dy = abs(x1 - x0), -abs(y1 - y0)
+        sx, sy = (1 if x0 < x1 else -1), (1 if y0 < y1 else -1)
+        err = dx + dy
+        x, y = x0, y0
+        while True:
+            self.set(x, y, value)
+            if (x, y) == (x1, y1):
+                break
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x += sx
+            if e2 <= dx:
+                err += dx
+                y += sy
+
+    def blit(self, src, x=0, y=0, transparent=False):
+        """Copy another Framebuffer or a matrix indexed by [x][y] to x, y.
+        If transparent, only lit pixels are copied."""
+        if isinstance(src, Framebuffer):
+            columns = [[src.pixel(sx, sy) for sy in range(HEIGHT)] for sx in range(WIDTH)]
+        else:
+            columns = src
+        for sx, column in enumerate(columns):
+            for sy, value in enumerate(column):
+                if value or not transparent:
+                    self.set(x + sx, y + sy, value)
+
+    def glyph(self, glyph, x, y, value=0xFF):
+        """Draw a 5x6 pixel font item with its top left corner at x, y"""
+        for i, pixel in enumerate(glyph):
+            if pixel:
+                self.set(x + i % 5, y + i // 5, value)
+
+    def text(self, s, x=2, y=0, value=0xFF):
+        """Draw letters from top to bottom, 7 pixels apart, like show_string"""
+        for i, letter in enumerate(str(s)):
+            self.glyph(convert_font(letter), x, y + 7 * i, value)
+
+    def draw_vals(self):
+        """Payload of the Draw command. Greyscale pixels are on if not 0"""
+        if not self.greyscale:
+            return bytes(self.buf)
+        mask = 0
+        for x, column in enumerate(PIXEL_MASKS):
+            col = self.buf[x * HEIGHT:(x + 1) * HEIGHT]
+            for pixel_mask, level in zip(column, col):
+                if level:
+                    mask |= pixel_mask
+        return mask.to_bytes(DRAW_BYTES, 'little')
+
+    def load(self, frame):
+        """Replace the whole frame with one in the same format"""
+        self.buf[:] = frame
+
+    def grey_cols(self):
+        """Payloads of StageGreyCol, one per column.
+        Black/white pixels that are on are at full brightness"""
+        if self.greyscale:
+            return [self.buf[x * HEIGHT:(x + 1) * HEIGHT] for x in range(WIDTH)]
+        return [bytes(self.pixel(x, y) for y in range(HEIGHT)) for x in range(WIDTH)]
+
+    def show(self, dev=None):
+        """Send the frame to the module, SERIAL_DEV by default, unless it
+        shows this frame already. Returns whether it was sent."""
+        dev = dev or SERIAL_DEV
+        if self.greyscale:
+            return greyscale_renderer(dev).render(self.grey_cols())
+        frame = bytes(self.buf)
+        if DRAWN_FRAMES.get(dev) == frame:
+            return False
+        raw = encode_command(CommandVals.Draw, frame)
+        command_sent(dev, raw)
+        SERIAL_POOL.send(dev, raw)
+        DRAWN_FRAMES[dev] = frame
+        return True
 
 
 def pattern(p):
@@ -875,23 +1992,19 @@ def pattern(p):
 
 def show_string(s):
     """Render a string with up to five letters"""
-    show_font([convert_font(letter) for letter in str(s)[:5]])
+    send_command(CommandVals.Draw, list(string_draw_vals(str(s)[:5])))
 
 
-def show_font(font_items):
-    """Render up to five 5x6 pixel font items"""
-    vals = [0x00 for _ in range(39)]
+@lru_cache(maxsize=256)
+def string_draw_vals(s):
+    """Draw payload of a string with up to five letters.
+    Cached, so that repeated strings, like the time, are only rendered once."""
+    return bytes(draw_vals(font_mask([convert_font(letter) for letter in s])))
 
-    for digit_i, digit_pixels in enumerate(font_items):
-        offset = digit_i * 7
-        for pixel_x in range(5):
-            for pixel_y in range(6):
-                pixel_value = digit_pixels[pixel_x + pixel_y*5]
-                i = (2+pixel_x) + (9*(pixel_y+offset))
-                if pixel_value:
-                    vals[int(i/8)] = vals[int(i/8)] | (1 << i % 8)
 
-    send_command(CommandVals.Draw, vals)
+def show_font(font_items):
+    """Render up to five 5x6 pixel font items"""
+    send_command(CommandVals.Draw, draw_vals(font_mask(font_items)))
 
 
 def show_symbols(symbols):
@@ -910,53 +2023,1481 @@ def show_symbols(symbols):
 def clock():
     """Render the current time and display.
     Loops forever, updating every second"""
-    global STOP_THREAD
-    while True:
-        if STOP_THREAD:
-            STOP_THREAD = False
-            return
+    from datetime import datetime
+    for _ in Ticker(1, stop=STOP_THREAD, name='clock'):
         now = datetime.now()
         current_time = now.strftime("%H:%M")
         print("Current Time =", current_time)
 
         show_string(current_time)
-        time.sleep(1)
+    STOP_THREAD.clear()
+
+
+# How a Compositor layer is combined with the layers below it
+BLEND_OVER = 'over'
+BLEND_XOR = 'xor'
+BLEND_MAX = 'max'
+
+
+class Layer:
+    """A named layer of a Compositor.
+    draw(fb) is called at the layer's own rate to redraw its Framebuffer."""
+    __slots__ = ('name', 'draw', 'fps', 'z', 'blend', 'fb', 'visible', 'due', 'updates')
+
+    def __init__(self, name, draw, fps, z, blend, greyscale):
+        self.name = name
+        self.draw = draw
+        self.fps = fps
+        self.z = z
+        self.blend = blend
+        self.fb = Framebuffer(greyscale)
+        self.visible = True
+        # Tick of the next update, None until the first one
+        self.due = None
+        self.updates = 0
+
+
+class Compositor:
+    """Combines several layers into one frame per tick.
+
+    Each layer is redrawn at its own rate, the layers are then blended from
+    the lowest z up. Only a single thread talks to the module and a frame
+    is only sent if it differs from the previous one.
+    Layers can be added and removed while it's running.
+    """
+
+    def __init__(self, fps=10, greyscale=False, dev=None):
+        self.fps = fps
+        self.greyscale = greyscale
+        self.dev = dev
+        self.out = Framebuffer(greyscale)
+        self.layers = {}
+        self.lock = threading.Lock()
+        # Whether layers were removed or hidden since the last frame
+        self.changed = False
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.frames = 0
+        self.frames_sent = 0
+
+    def add(self, name, draw, fps=1, z=None, blend=BLEND_OVER):
+        """Add or replace a layer. By default on top of the others"""
+        with self.lock:
+            if z is None:
+                z = max((layer.z for layer in self.layers.values()), default=-1) + 1
+            self.layers[name] = Layer(name, draw, fps, z, blend, self.greyscale)
+
+    def remove(self, name):
+        with self.lock:
+            if self.layers.pop(name, None) is not None:
+                self.changed = True
+
+    def show(self, name, visible=True):
+        with self.lock:
+            self.layers[name].visible = visible
+            self.changed = True
+
+    def update(self, tick):
+        """Redraw the layers that are due.
+        Returns whether the frame has to be composed again"""
+        updated, self.changed = self.changed, False
+        for layer in self.layers.values():
+            if layer.due is not None and tick < layer.due:
+                continue
+            layer.draw(layer.fb)
+            layer.updates += 1
+            layer.due = tick + max(1, round(self.fps / layer.fps))
+            updated = True
+        return updated
+
+    def compose(self):
+        """Blend the visible layers into one frame, in the wire format"""
+        layers = sorted((layer for layer in self.layers.values() if layer.visible),
+                        key=lambda layer: layer.z)
+        if not self.greyscale:
+            frame = 0
+            for layer in layers:
+                pixels = int.from_bytes(layer.fb.buf, 'little')
+                if layer.blend == BLEND_XOR:
+                    frame ^= pixels
+                else:
+                    frame |= pixels
+            return frame.to_bytes(DRAW_BYTES, 'little')
+
+        frame = bytes(WIDTH * HEIGHT)
+        for layer in layers:
+            if layer.blend == BLEND_MAX:
+                frame = bytes(map(max, frame, layer.fb.buf))
+            elif layer.blend == BLEND_XOR:
+                frame = bytes(0xFF - below if above else below
+                              for below, above in zip(frame, layer.fb.buf))
+            else:
+                frame = bytes(above or below for below, above in zip(frame, layer.fb.buf))
+        return frame
+
+    def tick(self, tick):
+        """Update, compose and send one frame. Returns whether it was sent"""
+        with self.lock:
+            if not self.update(tick):
+                return False
+            self.out.load(self.compose())
+        self.frames += 1
+        sent = self.out.show(self.dev)
+        self.frames_sent += sent
+        return sent
+
+    def run(self, stop=None):
+        """Compose frames until stop is set"""
+        for tick in Ticker(self.fps, stop=stop or self.stop_event, name='compositor'):
+            self.tick(tick)
+
+    def start(self):
+        """Run in a background thread, if it isn't already"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'frames_sent': self.frames_sent,
+            'layer_updates': {name: layer.updates for name, layer in self.layers.items()},
+        }
+
+
+def clock_layer(fb):
+    """Current time, as a Compositor layer"""
+    from datetime import datetime
+    fb.clear()
+    fb.text(datetime.now().strftime("%H:%M"))
+
+
+def random_eq_layer(fb):
+    """Random equalizer, as a Compositor layer"""
+    import random
+    weights = [i*i for i in range(33, 0, -1)]
+    draw_eq(fb, random.choices(range(1, 34), weights=weights, k=9))
+
+
+def progress_layer(seconds):
+    """Countdown progress bar along the bottom row, as a Compositor layer"""
+    start = time.monotonic()
+
+    def draw(fb):
+        ratio = min(1, (time.monotonic() - start) / seconds)
+        fb.clear()
+        fb.rect(0, HEIGHT - 1, round(WIDTH * ratio), 1)
+    return draw
+
+
+def countdown_layer(seconds):
+    """Countdown that lights more LEDs until all are lit, like countdown(),
+    as a Compositor layer"""
+    start = time.monotonic()
+
+    def draw(fb):
+        ratio = min(1, (time.monotonic() - start) / seconds)
+        leds = int(WIDTH * HEIGHT * ratio)
+        fb.clear()
+        fb.rect(0, 0, WIDTH, leds // WIDTH)
+        fb.rect(0, leds // WIDTH, leds % WIDTH, 1)
+    return draw
+
+
+def dashboard(layers, fps=None):
+    """Show several widgets at once, like 'clock', 'eq' and 'progress:60'"""
+    compositor = Compositor(fps or 10)
+    for spec in layers:
+        name, _, arg = spec.partition(':')
+        if name == 'clock':
+            compositor.add(name, clock_layer, fps=1)
+        elif name == 'eq':
+            compositor.add(name, random_eq_layer, fps=5)
+        elif name == 'progress':
+            try:
+                seconds = float(arg or 60)
+            except ValueError:
+                seconds = None
+            if seconds is None or not 0 < seconds < math.inf:
+                print(f"Progress needs a positive number of seconds, not {arg}")
+                return
+            compositor.add(name, progress_layer(seconds), fps=WIDTH / seconds)
+        else:
+            print(f"Unknown layer: {name}")
+            return
+    compositor.run(STOP_THREAD)
+    STOP_THREAD.clear()
 
 
 def send_command(command, parameters=[], with_response=False):
-    return send_command_raw(FWK_MAGIC + [command] + parameters, with_response)
+    return send_command_raw(encode_command(command, parameters), with_response)
+
+
+MAGIC_BYTES = bytes(FWK_MAGIC)
+# The firmware reads one command per USB packet of up to 64 bytes
+MAX_COMMAND_SIZE = 64
+
+
+def encode_command(command, parameters=[]):
+    """Frame a command for the wire"""
+    return MAGIC_BYTES + bytes((command,)) + bytes(parameters)
+
+
+# Commands that only set a value. If it's set again, the old one doesn't matter.
+LATEST_WINS = [
+    CommandVals.Brightness,
+    CommandVals.Pattern,
+    CommandVals.Sleep,
+    CommandVals.Animate,
+    CommandVals.SetColor,
+    CommandVals.DisplayOn,
+    CommandVals.InvertScreen,
+    CommandVals.ScreenSaver,
+    CommandVals.SetFps,
+    CommandVals.SetPowerMode,
+]
+
+
+class CommandQueue:
+    """Queues fire-and-forget commands in a preallocated buffer and sends
+    them together on flush().
+
+    If a command in LATEST_WINS is queued again before the queue is flushed,
+    the older one is dropped, so a brightness sweep only sends the final
+    value. The firmware parses exactly one command per USB packet, so the
+    remaining commands are not merged into one write(). But they all go out
+    back to back, while holding the connection once.
+    Queries flush the queue first, to keep the order of commands.
+    """
+
+    def __init__(self, dev=None, size=4096):
+        self.dev = dev
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._end = 0
+        # (offset, length) of each command, None if it was dropped
+        self._frames = []
+        # Index into _frames of the latest queued LATEST_WINS commands
+        self._latest = {}
+        self._lock = threading.Lock()
+        self.commands = 0
+        self.coalesced = 0
+        self.writes = 0
+
+    def put(self, command, parameters=[]):
+        length = 3 + len(parameters)
+        assert (length <= MAX_COMMAND_SIZE)
+        with self._lock:
+            if self._end + length > len(self._buf):
+                self._flush()
+            start = self._end
+            self._buf[start:start+2] = MAGIC_BYTES
+            self._buf[start+2] = command
+            self._buf[start+3:start+length] = bytes(parameters)
+            if command in LATEST_WINS:
+                previous = self._latest.get(command)
+                if previous is not None:
+                    self._frames[previous] = None
+                    self.coalesced += 1
+                self._latest[command] = len(self._frames)
+            self._frames.append((start, length))
+            self._end += length
+            self.commands += 1
+
+    def flush(self):
+        """Send everything that's queued"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        frames = [f for f in self._frames if f is not None]
+        if frames:
+            dev = self.dev or SERIAL_DEV
+            with SERIAL_POOL.connection(dev) as s:
+                for (start, length) in frames:
+                    command_sent(dev, self._view[start:start+length])
+                    send_serial(s, self._view[start:start+length])
+            self.writes += len(frames)
+        self._frames.clear()
+        self._latest.clear()
+        self._end = 0
+
+    def query(self, command, parameters=[], timeout=None):
+        """Flush the queue, then send a command and return its response.
+        Waits up to timeout seconds for it, forever by default."""
+        with self._lock:
+            self._flush()
+        # Others may queue commands meanwhile. The device lock keeps them
+        # from getting between the query and its response.
+        return SERIAL_POOL.send(self.dev or SERIAL_DEV, encode_command(command, parameters),
+                                with_response=True, timeout=timeout)
+
+
+# Most setting updates per second that the GUI sends while a slider is dragged
+GUI_UPDATE_RATE = 30
+
+
+class CoalescingWriter:
+    """Sends settings, like the brightness, from a background thread, so the
+    caller never waits for the port.
+
+    Only the latest value of each command is kept until it's sent, and the
+    pending values are sent at most max_rate times per second. Dragging a
+    slider over its whole range only sends a few commands.
+    """
+
+    def __init__(self, dev=None, max_rate=GUI_UPDATE_RATE):
+        self.dev = dev
+        self.interval = 1 / max_rate
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closing = False
+        self._thread = None
+        self.puts = 0
+        self.sent = 0
+
+    def put(self, command, parameters=[]):
+        """Queue a command, replacing the previous value of the same command"""
+        with self._lock:
+            # Keep the order in which the values last changed
+            self._pending.pop(command, None)
+            self._pending[command] = bytes(parameters)
+            self.puts += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        import serial
+        last = -self.interval
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # Wait out the rest of the interval, newer values replace older ones meanwhile
+            remaining = last + self.interval - time.monotonic()
+            if remaining > 0 and not self._closing:
+                time.sleep(remaining)
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                if not pending and self._closing:
+                    return
+            dev = self.dev or SERIAL_DEV
+            try:
+                with SERIAL_POOL.connection(dev) as s:
+                    for command, parameters in pending.items():
+                        raw = encode_command(command, parameters)
+                        command_sent(dev, raw)
+                        send_serial(s, raw)
+                        self.sent += 1
+            except (serial.SerialException, OSError) as e:
+                print(f"Failed to send to {dev}: {e}", file=sys.stderr)
+            last = time.monotonic()
+            if self._closing:
+                # Send whatever came in meanwhile, then stop
+                self._wakeup.set()
+
+    def close(self):
+        """Send what's still pending and stop the thread"""
+        with self._lock:
+            self._closing = True
+            thread = self._thread
+        self._wakeup.set()
+        if thread is not None:
+            thread.join()
+
+
+def default_socket_path():
+    """Where the daemon listens by default, see client.py"""
+    import tempfile
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(runtime_dir, 'inputmodule.sock')
+
+
+class CommandDaemon:
+    """Owns the input modules and sends commands on behalf of local clients,
+    so they don't fight over the serial port. POSIX only.
+
+    Clients connect to a Unix domain socket and send one JSON object per
+    line, each is answered with one line:
+
+        {"cmd": "Brightness", "params": [50]}     -> {"ok": true}
+        {"cmd": "Version", "response": true}      -> {"ok": true, "response": [0, 20, 0, ...]}
+        {"cmd": "Pattern", "params": [0, 10], "dev": "/dev/ttyACM1"}
+        {"cmd": "Brightness", "params": [50], "priority": "high"}
+        {"stats": true}
+
+    Every device has a CommandQueue. Normal commands are flushed by a writer
+    thread every flush_interval, so only the latest of a burst of LATEST_WINS
+    commands, like brightness, is sent. High priority commands and queries
+    flush the queue right away.
+    The firmware doesn't answer every query, e.g. none but Sleep while the
+    module sleeps. If there's no response within query_timeout seconds,
+    the request fails with a timeout error.
+    """
+
+    def __init__(self, path=None, flush_interval=0.01, query_timeout=None):
+        self.path = path or default_socket_path()
+        self.flush_interval = flush_interval
+        self.query_timeout = query_timeout or PROBE_TIMEOUT
+        self.queues = {}
+        self._wakeups = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._server = None
+        # Set once clients can connect
+        self.ready = threading.Event()
+
+    def queue(self, dev):
+        """The CommandQueue of a device, starting its writer thread"""
+        with self._lock:
+            if dev not in self.queues:
+                self.queues[dev] = CommandQueue(dev)
+                self._wakeups[dev] = threading.Event()
+                threading.Thread(target=self._writer, args=(dev,), daemon=True).start()
+            return self.queues[dev]
+
+    def _writer(self, dev):
+        import serial
+        queue, wakeup = self.queues[dev], self._wakeups[dev]
+        while not self._stop.is_set():
+            wakeup.wait()
+            wakeup.clear()
+            # Let a burst of commands arrive, so they can be coalesced
+            self._stop.wait(self.flush_interval)
+            try:
+                queue.flush()
+            except (serial.SerialException, OSError) as e:
+                print(f"Failed to send to {dev}: {e}", file=sys.stderr)
+
+    def handle(self, request):
+        """Handle one request, returns the reply"""
+        import serial
+        if request.get('stats'):
+            return {'ok': True, 'stats': {dev: {'commands': q.commands, 'coalesced': q.coalesced,
+                                                'writes': q.writes}
+                                          for dev, q in self.queues.items()}}
+        cmd = request.get('cmd')
+        try:
+            command = CommandVals[cmd] if isinstance(cmd, str) else CommandVals(cmd)
+        except (KeyError, ValueError):
+            return {'ok': False, 'error': f"Unknown command: {cmd}"}
+        params = request.get('params', [])
+        if len(params) > MAX_COMMAND_SIZE - 3 or not all(0 <= p <= 255 for p in params):
+            return {'ok': False, 'error': "Parameters must be up to 61 bytes"}
+
+        dev = request.get('dev') or SERIAL_DEV
+        queue = self.queue(dev)
+        try:
+            if request.get('response'):
+                response = queue.query(command, params, self.query_timeout)
+                if len(response) < RESPONSE_SIZE:
+                    return {'ok': False, 'error': "timeout"}
+                return {'ok': True, 'response': list(response)}
+            queue.put(command, params)
+            if request.get('priority') == 'high':
+                queue.flush()
+            else:
+                self._wakeups[dev].set()
+        except (serial.SerialException, OSError) as e:
+            return {'ok': False, 'error': str(e)}
+        return {'ok': True}
+
+    def serve_forever(self):
+        import json
+        import socketserver
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        reply = daemon.handle(json.loads(line))
+                    except (ValueError, TypeError, AttributeError) as e:
+                        reply = {'ok': False, 'error': f"Invalid request: {e}"}
+                    self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+        class Server(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(self.path):
+            # Left behind by a daemon that didn't shut down cleanly, unless
+            # one still answers on it
+            import errno
+            import socket
+            with socket.socket(socket.AF_UNIX) as probe:
+                try:
+                    probe.connect(self.path)
+                except ConnectionRefusedError:
+                    os.unlink(self.path)
+                else:
+                    raise OSError(errno.EADDRINUSE, "Another daemon is listening", self.path)
+        self._server = Server(self.path, Handler)
+        self.ready.set()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            os.unlink(self.path)
+
+    def shutdown(self):
+        self._stop.set()
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def daemon(path=None):
+    """Run the daemon until interrupted"""
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        print("The daemon needs Unix domain sockets")
+        return
+    import signal
+    server = CommandDaemon(path)
+    # Clean up the socket when stopped by a service manager
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Listening on {server.path}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"Can't listen: {e}")
+        sys.exit(1)
 
 
 def send_command_raw(command, with_response=False):
     """Send a command to the device.
-    Opens new serial connection every time"""
+    Reuses the pooled serial connection of the device"""
     # print(f"Sending command: {command}")
     global SERIAL_DEV
-    with serial.Serial(SERIAL_DEV, 115200) as s:
-        s.write(command)
+    command_sent(SERIAL_DEV, command)
+    return SERIAL_POOL.send(SERIAL_DEV, command, with_response)
 
-        if with_response:
-            res = s.read(RESPONSE_SIZE)
-            # print(f"Received: {res}")
-            return res
+
+class SerialPool:
+    """Keeps one long-lived serial connection per device and reuses it.
+
+    Every device has its own lock, so the GUI thread and the animation threads
+    can share a port without interleaving commands or stealing responses.
+    If the device goes away, the broken port is closed and reopened on the
+    next use.
+    """
+
+    def __init__(self, baudrate=SERIAL_BAUDRATE):
+        self.baudrate = baudrate
+        self._lock = threading.Lock()
+        self._ports = {}
+        self._dev_locks = {}
+
+    def _dev_lock(self, dev):
+        with self._lock:
+            if dev not in self._dev_locks:
+                self._dev_locks[dev] = threading.RLock()
+            return self._dev_locks[dev]
+
+    def _port(self, dev):
+        import serial
+        s = self._ports.get(dev)
+        if s is None or not s.is_open:
+            start = time.perf_counter_ns()
+            s = serial.Serial(dev, self.baudrate)
+            if STATS is not None:
+                STATS.record_open(dev, time.perf_counter_ns() - start)
+            self._ports[dev] = s
+            self._forget(dev)
+        return s
+
+    def _drop(self, dev):
+        import serial
+        s = self._ports.pop(dev, None)
+        if s is not None:
+            self._forget(dev)
+            try:
+                s.close()
+            except (serial.SerialException, OSError):
+                pass
+
+    def _forget(self, dev):
+        """The module may be reset while it's not connected, forget its
+        settings and what it shows"""
+        state = DEVICE_STATES.get(dev)
+        if state is not None:
+            state.invalidate()
+        grid_changed(dev)
+
+    @contextmanager
+    def connection(self, dev):
+        """Borrow the connection to a device for several consecutive writes.
+        Nobody else can use the device until the block is left."""
+        import serial
+        with self._dev_lock(dev):
+            s = self._port(dev)
+            try:
+                yield s
+            except (serial.SerialException, OSError):
+                self._drop(dev)
+                raise
+
+    def send(self, dev, command, with_response=False, timeout=None):
+        """Write a single command and optionally read the response.
+        Waits up to timeout seconds for the response, forever by default, and
+        returns what came until then. Reconnects once if the port has gone stale."""
+        import serial
+        with self._dev_lock(dev):
+            for attempt in range(2):
+                try:
+                    s = self._port(dev)
+                    send_serial(s, command)
+                    if with_response:
+                        old_timeout = s.timeout
+                        if old_timeout != timeout:
+                            s.timeout = timeout
+                        try:
+                            if STATS is None:
+                                res = s.read(RESPONSE_SIZE)
+                            else:
+                                start = time.perf_counter_ns()
+                                res = s.read(RESPONSE_SIZE)
+                                STATS.record_read(command[2], time.perf_counter_ns() - start)
+                            if len(res) < RESPONSE_SIZE:
+                                # Timed out. Drop what came so far, so it's
+                                # not taken for the start of the next response
+                                s.reset_input_buffer()
+                            return res
+                        finally:
+                            if s.timeout != old_timeout:
+                                s.timeout = old_timeout
+                    return None
+                except (serial.SerialException, OSError):
+                    self._drop(dev)
+                    if attempt > 0:
+                        raise
+
+    def close(self, dev=None):
+        """Close the connection to one or all devices"""
+        with self._lock:
+            devs = [dev] if dev is not None else list(self._ports)
+        for d in devs:
+            with self._dev_lock(d):
+                self._drop(d)
+
+
+SERIAL_POOL = SerialPool()
+atexit.register(SERIAL_POOL.close)
+
+
+# How long a response may still come after its query timed out. It's
+# dropped when it comes, and the next query waits that long at most.
+LATE_RESPONSE_WAIT = 0.2
+
+
+class AsyncDevice:
+    """asyncio client for an input module. POSIX only.
+
+    Commands are queued and written by a single writer task, so callers
+    never wait for the port and fire-and-forget commands are pipelined.
+    Responses carry nothing to tell them apart and some queries are never
+    answered, so only one query is on the wire at a time. Commands after
+    it are still written while it waits for its response.
+
+    Queries that aren't answered within timeout seconds raise
+    asyncio.TimeoutError. If the port fails, queued and waiting commands
+    fail with the OSError, and so does everything after.
+
+    Many animations and queries can share one device on one event loop:
+
+        async with AsyncDevice('/dev/ttyACM0') as dev:
+            dev.brightness(50)
+            print(await dev.get_brightness())
+    """
+
+    def __init__(self, dev, timeout=1):
+        self.dev = dev
+        self.timeout = timeout
+        self._serial = None
+        self._queue = None
+        # The query on the wire, and whether there's none
+        self._waiting = None
+        self._idle = None
+        self._rx = bytearray()
+        self._writer = None
+        self._error = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        import asyncio
+        import serial
+        loop = asyncio.get_running_loop()
+        self._serial = serial.Serial(self.dev, SERIAL_BAUDRATE, timeout=0)
+        self._fd = self._serial.fileno()
+        os.set_blocking(self._fd, False)
+        self._queue = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        loop.add_reader(self._fd, self._on_readable)
+        self._writer = asyncio.create_task(self._write_loop())
+
+    async def close(self):
+        """Write everything that's queued, then close the port"""
+        import asyncio
+        try:
+            await self.drain()
+        finally:
+            self._writer.cancel()
+            asyncio.get_running_loop().remove_reader(self._fd)
+            self._serial.close()
+            if self._waiting is not None:
+                self._waiting.cancel()
+
+    async def drain(self):
+        """Wait until all queued commands are written"""
+        await self._queue.join()
+        self._check()
+
+    def send(self, command, parameters=[]):
+        """Queue a command without response. Doesn't wait for it to be written."""
+        self._check()
+        self._queue.put_nowait((encode_command(command, parameters), None))
+
+    async def query(self, command, parameters=[], timeout=None):
+        """Send a command and wait for its response.
+
+        timeout defaults to the one of the device.
+        """
+        import asyncio
+        self._check()
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((encode_command(command, parameters), fut))
+        return await asyncio.wait_for(fut, timeout or self.timeout)
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    async def _write_loop(self):
+        try:
+            while True:
+                command, fut = await self._queue.get()
+                try:
+                    if fut is not None:
+                        await self._idle.wait()
+                        if fut.done():
+                            # Timed out before it was sent
+                            continue
+                        self._idle.clear()
+                        self._waiting = fut
+                        fut.add_done_callback(self._query_done)
+                    command_sent(self.dev, command)
+                    await self._write(command)
+                finally:
+                    self._queue.task_done()
+        except OSError as e:
+            self._fail(e)
+
+    async def _write(self, command):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        view = memoryview(command)
+        while view:
+            try:
+                view = view[os.write(self._fd, view):]
+            except BlockingIOError:
+                writable = loop.create_future()
+                loop.add_writer(self._fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    loop.remove_writer(self._fd)
+
+    def _query_done(self, fut):
+        import asyncio
+        if fut.cancelled() and self._waiting is fut:
+            # Keep the next query back a while, its response might be late
+            asyncio.get_running_loop().call_later(
+                LATE_RESPONSE_WAIT, self._give_up, fut)
+
+    def _give_up(self, fut):
+        if self._waiting is fut:
+            self._waiting = None
+            self._rx.clear()
+            self._idle.set()
+
+    def _fail(self, error):
+        """The port is gone, fail everything that waits for it"""
+        import asyncio
+        self._error = error
+        asyncio.get_running_loop().remove_reader(self._fd)
+        if self._waiting is not None and not self._waiting.done():
+            self._waiting.set_exception(error)
+        self._waiting = None
+        self._idle.set()
+        while not self._queue.empty():
+            _command, fut = self._queue.get_nowait()
+            if fut is not None and not fut.done():
+                fut.set_exception(error)
+            self._queue.task_done()
+
+    def _on_readable(self):
+        try:
+            self._rx += os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._fail(e)
+            return
+        while len(self._rx) >= RESPONSE_SIZE:
+            fut, self._waiting = self._waiting, None
+            if fut is None:
+                # Nobody's asking, must be debug output of the firmware
+                self._rx.clear()
+                return
+            if not fut.done():
+                fut.set_result(bytes(self._rx[:RESPONSE_SIZE]))
+            del self._rx[:RESPONSE_SIZE]
+            self._idle.set()
+
+    def brightness(self, b):
+        self.send(CommandVals.Brightness, [b])
+
+    async def get_brightness(self):
+        return int((await self.query(CommandVals.Brightness))[0])
+
+    def percentage(self, p):
+        self.send(CommandVals.Pattern, [PatternVals.Percentage, p])
+
+    def pattern(self, p):
+        self.send(CommandVals.Pattern, [p])
+
+    def sleep(self, go_to_sleep):
+        self.send(CommandVals.Sleep, [go_to_sleep])
+
+    async def is_sleeping(self):
+        return bool((await self.query(CommandVals.Sleep))[0])
+
+    def animate(self, b):
+        self.send(CommandVals.Animate, [b])
+
+    async def get_animate(self):
+        return bool((await self.query(CommandVals.Animate))[0])
+
+    def draw(self, vals):
+        """Show a black/white frame, see draw_vals()"""
+        self.send(CommandVals.Draw, vals)
+
+    def draw_greyscale(self, cols):
+        """Stage 9 columns of brightness values and commit them"""
+        for x, vals in enumerate(cols):
+            self.send(CommandVals.StageGreyCol, [x] + list(vals))
+        self.send(CommandVals.DrawGreyColBuffer, [0x00])
+
+    def start_game(self, game, param=None):
+        self.send(CommandVals.StartGame, [game] + ([] if param is None else [param]))
+
+    def game_control(self, control):
+        self.send(CommandVals.GameControl, [control])
+
+    def set_color(self, rgb):
+        self.send(CommandVals.SetColor, rgb)
+
+    async def get_color(self):
+        res = await self.query(CommandVals.SetColor)
+        return (int(res[0]), int(res[1]), int(res[2]))
+
+    async def get_version(self):
+        res = await self.query(CommandVals.Version)
+        version = f"{res[0]}.{(res[1] & 0xF0) >> 4}.{res[1] & 0xF}"
+        if res[2]:
+            version += " (Pre-release)"
+        return version
+
+    def set_fps(self, fps):
+        self.send(CommandVals.SetFps, [fps])
+
+    async def get_fps(self):
+        return int((await self.query(CommandVals.SetFps))[0])
+
+    def set_power_mode(self, mode):
+        self.send(CommandVals.SetPowerMode, [mode])
+
+    async def get_power_mode(self):
+        return int((await self.query(CommandVals.SetPowerMode))[0])
+
+    def set_text(self, text):
+        self.send(CommandVals.SetText, [len(text)] + [ord(x) for x in text])
+
+    def display_on(self, on):
+        self.send(CommandVals.DisplayOn, [on])
+
+    async def get_display_on(self):
+        return bool((await self.query(CommandVals.DisplayOn))[0])
+
+    def invert_screen(self, invert):
+        self.send(CommandVals.InvertScreen, [invert])
+
+    async def get_invert_screen(self):
+        return bool((await self.query(CommandVals.InvertScreen))[0])
+
+    def screen_saver(self, on):
+        self.send(CommandVals.ScreenSaver, [on])
+
+    async def get_screen_saver(self):
+        return bool((await self.query(CommandVals.ScreenSaver))[0])
+
+    def clear_ram(self):
+        self.send(CommandVals.ClearRam)
+
+    def pixel_column(self, x, column):
+        """Set a column of the B1 framebuffer, 50 bytes. Shown on the next flush."""
+        self.send(CommandVals.SetPixelColumn, x.to_bytes(2, 'little') + bytes(column))
+
+    def flush_framebuffer(self):
+        self.send(CommandVals.FlushFramebuffer)
+
+    def b1_frame(self, columns):
+        """Show a full B1 frame, 300 columns, see b1_image_columns"""
+        assert (len(columns) == B1_WIDTH)
+        for x, column in enumerate(columns):
+            self.pixel_column(x, column)
+        self.flush_framebuffer()
+
+
+FRAMEWORK_VID = 0x32AC
+LED_MATRIX_PID = 0x0020
+B1_DISPLAY_PID = 0x0021
+C1_MINIMAL_PID = 0x0022
+
+LED_MATRIX = 'ledmatrix'
+B1_DISPLAY = 'b1display'
+C1_MINIMAL = 'c1minimal'
+MODULE_PIDS = {
+    LED_MATRIX_PID: LED_MATRIX,
+    B1_DISPLAY_PID: B1_DISPLAY,
+    C1_MINIMAL_PID: C1_MINIMAL,
+}
+
+# Seconds to wait for an answer while probing devices
+PROBE_TIMEOUT = 0.2
+
+
+class InputModule:
+    """A discovered input module"""
+
+    def __init__(self, dev, kind, version):
+        self.dev = dev
+        self.kind = kind
+        self.version = version
+
+    def __repr__(self):
+        return f"InputModule({self.dev!r}, {self.kind!r}, {self.version!r})"
+
+
+def probe(dev, command):
+    """Send a query, return the response or None if the device doesn't answer"""
+    res = SERIAL_POOL.send(dev, encode_command(command), with_response=True, timeout=PROBE_TIMEOUT)
+    if len(res) < RESPONSE_SIZE:
+        return None
+    return res
+
+
+def probe_kind(dev):
+    """Tell the kind of module by the queries it answers.
+    Only needed if the device has no USB information."""
+    if probe(dev, CommandVals.SetColor) is not None:
+        return C1_MINIMAL
+    if probe(dev, CommandVals.SetFps) is not None:
+        return B1_DISPLAY
+    return LED_MATRIX
+
+
+def find_modules(devs=None):
+    """Find every input module and what kind it is.
+    Checks all /dev/ttyACM* devices, unless given a list of devices.
+    Devices that don't answer the Version command are skipped."""
+    from concurrent.futures import ThreadPoolExecutor
+    import glob
+    from serial.tools import list_ports
+
+    if devs is None:
+        devs = sorted(glob.glob('/dev/ttyACM*'))
+    pids = {port.device: port.pid for port in list_ports.comports()
+            if port.vid == FRAMEWORK_VID}
+
+    def identify(dev):
+        import serial
+        try:
+            res = probe(dev, CommandVals.Version)
+        except (serial.SerialException, OSError):
+            return None
+        if res is None:
+            SERIAL_POOL.close(dev)
+            return None
+        version = f"{res[0]}.{(res[1] & 0xF0) >> 4}.{res[1] & 0xF}"
+        kind = MODULE_PIDS.get(pids.get(dev)) or probe_kind(dev)
+        return InputModule(dev, kind, version)
+
+    # Probe all devices at the same time, unresponsive ones take a while
+    with ThreadPoolExecutor(max_workers=max(1, len(devs))) as executor:
+        return [m for m in executor.map(identify, devs) if m is not None]
+
+
+class ModuleGroup:
+    """Drives several input modules in parallel.
+    Every device has a single writer thread, so commands to one device stay
+    in order, while all devices are written to at the same time.
+    LED matrices form a canvas, left to right in the order given."""
+
+    def __init__(self, modules):
+        from concurrent.futures import ThreadPoolExecutor
+        self.modules = list(modules)
+        self.matrices = [m for m in self.modules if m.kind == LED_MATRIX]
+        self._writers = {m.dev: ThreadPoolExecutor(max_workers=1) for m in self.modules}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.shutdown()
+
+    def _write(self, dev, commands):
+        with SERIAL_POOL.connection(dev) as s:
+            for command in commands:
+                command_sent(dev, command)
+                send_serial(s, command)
+
+    def submit(self, module, commands):
+        """Queue raw commands for one module, returns a future"""
+        return self._writers[module.dev].submit(self._write, module.dev, commands)
+
+    def shard(self, commands):
+        """Send different commands to each module, at the same time.
+        Takes a dict of module to list of raw commands."""
+        futures = [self.submit(m, cmds) for (m, cmds) in commands.items()]
+        for future in futures:
+            future.result()
+
+    def broadcast(self, command, parameters=[], kind=None):
+        """Send the same command to every module, or every module of a kind"""
+        raw = encode_command(command, parameters)
+        self.shard({m: [raw] for m in self.modules if kind is None or m.kind == kind})
+
+    def draw_canvas_greyscale(self, cols):
+        """Show 9 columns per LED matrix, split across all of them.
+        All matrices are staged first and then committed together, so
+        they switch to the new frame at the same time."""
+        assert (len(cols) == WIDTH * len(self.matrices))
+        self.shard({m: [encode_command(CommandVals.StageGreyCol, bytes((x,)) + bytes(vals))
+                        for (x, vals) in enumerate(cols[i*WIDTH:(i+1)*WIDTH])]
+                    for (i, m) in enumerate(self.matrices)})
+        self.broadcast(CommandVals.DrawGreyColBuffer, [0x00], kind=LED_MATRIX)
+
+
+def list_modules():
+    for module in find_modules():
+        print(f"{module.dev}: {module.kind}, firmware {module.version}")
+
+
+def canvas_greyscale(image_file):
+    """Display an image in greyscale across all LED matrices side by side.
+    Must be 9 pixels wide per LED matrix and 34 pixels high."""
+    with ModuleGroup(find_modules()) as group:
+        from PIL import Image
+        im = Image.open(image_file).convert("RGB")
+        width, height = im.size
+        assert (width == WIDTH * len(group.matrices))
+        assert (height == HEIGHT)
+        group.draw_canvas_greyscale(image_grey_cols(im))
+
+
+# Seconds that a cached device setting is trusted. Other programs may change it.
+STATE_TTL = 5
+
+# Settings that DeviceState keeps track of
+STATE_COMMANDS = [
+    CommandVals.Brightness,
+    CommandVals.Sleep,
+    CommandVals.Animate,
+    CommandVals.SetFps,
+    CommandVals.SetPowerMode,
+    CommandVals.SetColor,
+    CommandVals.Version,
+]
+
+# Settings that each kind of module answers queries for.
+# Others aren't answered at all, so they can't be batched.
+STATE_QUERIES = {
+    LED_MATRIX: [CommandVals.Brightness, CommandVals.Animate,
+                 CommandVals.Sleep, CommandVals.Version],
+    B1_DISPLAY: [CommandVals.SetFps, CommandVals.SetPowerMode,
+                 CommandVals.Sleep, CommandVals.Version],
+    C1_MINIMAL: [CommandVals.Brightness, CommandVals.SetColor,
+                 CommandVals.Sleep, CommandVals.Version],
+    None: [CommandVals.Sleep, CommandVals.Version],
+}
+
+
+class DeviceState:
+    """Cache of the settings of a device, to save query round trips.
+
+    Values are kept as the raw responses. They are updated by every command
+    we send to the device, expire after `ttl` seconds and are forgotten when
+    the port is reopened, since the module may have rebooted.
+    """
+
+    def __init__(self, dev, ttl=STATE_TTL):
+        self.dev = dev
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Command => (response, time.monotonic() when it was learned)
+        self._values = {}
+        self.hits = 0
+        self.queries = 0
+        self.skipped = 0
+
+    def cached(self, command):
+        """The cached value, if it's still fresh, otherwise None"""
+        with self._lock:
+            entry = self._values.get(command)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] > self.ttl:
+                del self._values[command]
+                return None
+            return entry[0]
+
+    def remember(self, command, value):
+        with self._lock:
+            self._values[command] = (bytes(value), time.monotonic())
+
+    def invalidate(self, command=None):
+        """Forget one or all settings"""
+        with self._lock:
+            if command is None:
+                self._values.clear()
+            else:
+                self._values.pop(command, None)
+
+    def note_write(self, command, parameters):
+        """Update the cache with a command that was sent to the device"""
+        if command == CommandVals.Sleep and parameters:
+            if not parameters[0]:
+                # Whatever was sent while asleep wasn't applied
+                self.invalidate()
+            self.remember(command, parameters)
+            return
+        sleeping = self.cached(CommandVals.Sleep)
+        if sleeping is not None and sleeping[0]:
+            # The firmware ignores everything else while asleep
+            return
+        if command in STATE_COMMANDS and parameters:
+            self.remember(command, parameters)
+        elif command == CommandVals.Pattern and bytes(parameters[:1]) == bytes([PatternVals.FullBrightness]):
+            self.remember(CommandVals.Brightness, [0xFF])
+
+    def refresh(self, commands, timeout=None):
+        """Query several settings in one pass: all queries are written before
+        reading the responses. The module has to answer all of them, see
+        STATE_QUERIES. Settings that got no answer in time are left out."""
+        with SERIAL_POOL.connection(self.dev) as s:
+            for command in commands:
+                send_serial(s, encode_command(command))
+            self.queries += len(commands)
+            old_timeout = s.timeout
+            if old_timeout != timeout:
+                s.timeout = timeout
+            try:
+                for command in commands:
+                    res = s.read(RESPONSE_SIZE)
+                    if len(res) < RESPONSE_SIZE:
+                        # Don't let late answers be taken for the next query
+                        s.reset_input_buffer()
+                        return
+                    self.remember(command, res)
+            finally:
+                if s.timeout != old_timeout:
+                    s.timeout = old_timeout
+
+    def get_many(self, commands, timeout=None):
+        """Get several settings, querying the stale ones in one pass.
+        Settings without an answer are None."""
+        values = [self.cached(command) for command in commands]
+        stale = [c for (c, v) in zip(commands, values) if v is None]
+        self.hits += len(commands) - len(stale)
+        if stale:
+            self.refresh(stale, timeout)
+            values = [v if v is not None else self.cached(c) for (c, v) in zip(commands, values)]
+        return values
+
+    def get(self, command, timeout=None):
+        """Get a setting from the cache or else from the device"""
+        return self.get_many([command], timeout)[0]
+
+    def set(self, command, parameters):
+        """Change a setting, unless it's known to be set already.
+        Returns whether the command was sent."""
+        value = self.cached(command)
+        if value is not None and value[:len(parameters)] == bytes(parameters):
+            self.skipped += 1
+            return False
+        raw = encode_command(command, parameters)
+        command_sent(self.dev, raw)
+        SERIAL_POOL.send(self.dev, raw)
+        return True
+
+
+DEVICE_STATES = {}
+DEVICE_STATES_LOCK = threading.Lock()
+
+
+def device_state(dev=None):
+    """Get the settings cache of a device, SERIAL_DEV by default"""
+    dev = dev or SERIAL_DEV
+    with DEVICE_STATES_LOCK:
+        if dev not in DEVICE_STATES:
+            DEVICE_STATES[dev] = DeviceState(dev)
+        return DEVICE_STATES[dev]
+
+
+def command_sent(dev, command):
+    """Keep the caches of a device in line with a raw command sent to it"""
+    if len(command) < 3:
+        return
+    if command[2] in GRID_COMMANDS:
+        grid_changed(dev)
+    state = DEVICE_STATES.get(dev)
+    if state is not None:
+        state.note_write(command[2], command[3:])
 
 
 def send_serial(s, command):
     """Send serial command by using existing serial connection"""
     global SERIAL_DEV
+    if STATS is None:
+        s.write(command)
+        return
+    start = time.perf_counter_ns()
     s.write(command)
+    STATS.record_write(command[2], len(command), time.perf_counter_ns() - start)
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                   0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+
+class Histogram:
+    """Latency histogram with fixed buckets"""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self):
+        bounds = [str(b) for b in LATENCY_BUCKETS] + ['+Inf']
+        return {
+            'buckets': dict(zip(bounds, self.counts)),
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+        }
+
+
+def command_name(command):
+    try:
+        return CommandVals(command).name
+    except ValueError:
+        return f"0x{command:02X}"
+
+
+class CommandStats:
+    """Per command counts, bytes and write/read latency, port opens and the
+    time animation loops spend rendering vs. transmitting each frame.
+    Enabled with --stats, see STATS."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.commands = {}
+        self.opens = Histogram()
+        self.frames = {}
+        self.inputs = {}
+
+    def _command(self, command):
+        name = command_name(command)
+        if name not in self.commands:
+            self.commands[name] = {'count': 0, 'bytes': 0, 'write': Histogram(), 'read': Histogram()}
+        return self.commands[name]
+
+    def io_ns(self):
+        """Time the current thread has spent on serial I/O"""
+        return getattr(self._local, 'io_ns', 0)
+
+    def _add_io(self, ns):
+        self._local.io_ns = self.io_ns() + ns
+
+    def record_open(self, dev, ns):
+        with self._lock:
+            self.opens.observe(ns / 1e9)
+
+    def record_write(self, command, size, ns):
+        self._add_io(ns)
+        with self._lock:
+            stats = self._command(command)
+            stats['count'] += 1
+            stats['bytes'] += size
+            stats['write'].observe(ns / 1e9)
+
+    def record_read(self, command, ns):
+        self._add_io(ns)
+        with self._lock:
+            self._command(command)['read'].observe(ns / 1e9)
+
+    def record_frame(self, loop, total_ns, transmit_ns):
+        with self._lock:
+            if loop not in self.frames:
+                self.frames[loop] = {'render': Histogram(), 'transmit': Histogram()}
+            self.frames[loop]['render'].observe(max(total_ns - transmit_ns, 0) / 1e9)
+            self.frames[loop]['transmit'].observe(transmit_ns / 1e9)
+
+    def record_input(self, game, ns):
+        with self._lock:
+            if game not in self.inputs:
+                self.inputs[game] = Histogram()
+            self.inputs[game].observe(ns / 1e9)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'commands': {name: {'count': c['count'], 'bytes': c['bytes'],
+                                    'write': c['write'].to_dict(), 'read': c['read'].to_dict()}
+                             for (name, c) in self.commands.items()},
+                'port_opens': self.opens.to_dict(),
+                'frames': {loop: {'render': f['render'].to_dict(), 'transmit': f['transmit'].to_dict()}
+                           for (loop, f) in self.frames.items()},
+                'inputs': {game: h.to_dict() for (game, h) in self.inputs.items()},
+            }
+
+    def to_json(self):
+        import json
+        return json.dumps(self.to_dict(), indent=2) + '\n'
+
+    def to_prometheus(self):
+        lines = []
+
+        def histogram(metric, labels, hist):
+            cumulative = 0
+            for bound, count in hist['buckets'].items():
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{{labels}}} {hist["sum"]}')
+            lines.append(f'{metric}_count{{{labels}}} {hist["count"]}')
+
+        stats = self.to_dict()
+        lines.append('# TYPE inputmodule_commands_total counter')
+        for name, c in stats['commands'].items():
+            lines.append(f'inputmodule_commands_total{{command="{name}"}} {c["count"]}')
+        lines.append('# TYPE inputmodule_command_bytes_total counter')
+        for name, c in stats['commands'].items():
+            lines.append(f'inputmodule_command_bytes_total{{command="{name}"}} {c["bytes"]}')
+        for kind in ['write', 'read']:
+            lines.append(f'# TYPE inputmodule_{kind}_seconds histogram')
+            for name, c in stats['commands'].items():
+                if c[kind]['count']:
+                    histogram(f'inputmodule_{kind}_seconds', f'command="{name}"', c[kind])
+        lines.append('# TYPE inputmodule_frame_seconds histogram')
+        for loop, f in stats['frames'].items():
+            for phase in ['render', 'transmit']:
+                histogram('inputmodule_frame_seconds', f'loop="{loop}",phase="{phase}"', f[phase])
+        lines.append('# TYPE inputmodule_input_latency_seconds histogram')
+        for game, h in stats['inputs'].items():
+            histogram('inputmodule_input_latency_seconds', f'game="{game}"', h)
+        return '\n'.join(lines) + '\n'
+
+    def to_text(self):
+        def ms(hist):
+            if not hist['count']:
+                return '-'
+            return f"{1000 * hist['sum'] / hist['count']:.3f}/{1000 * hist['max']:.3f}"
+
+        stats = self.to_dict()
+        lines = [f"{'Command':<20} {'Count':>8} {'Bytes':>10} {'Write avg/max ms':>18} {'Read avg/max ms':>18}"]
+        for name, c in sorted(stats['commands'].items()):
+            lines.append(f"{name:<20} {c['count']:>8} {c['bytes']:>10} {ms(c['write']):>18} {ms(c['read']):>18}")
+        lines.append(f"Port opens: {stats['port_opens']['count']}, avg/max ms: {ms(stats['port_opens'])}")
+        if stats['frames']:
+            lines.append(f"{'Loop':<20} {'Frames':>8} {'Render avg/max ms':>18} {'Transmit avg/max ms':>20}")
+            for loop, f in sorted(stats['frames'].items()):
+                lines.append(f"{loop:<20} {f['render']['count']:>8} {ms(f['render']):>18} {ms(f['transmit']):>20}")
+        if stats['inputs']:
+            lines.append(f"{'Game':<20} {'Inputs':>8} {'Key to LED avg/max ms':>22}")
+            for game, h in sorted(stats['inputs'].items()):
+                lines.append(f"{game:<20} {h['count']:>8} {ms(h):>22}")
+        return '\n'.join(lines) + '\n'
+
+
+def enable_stats(fmt='text', path=None):
+    """Collect statistics and dump them in the given format on exit"""
+    global STATS
+    STATS = CommandStats()
+
+    def dump():
+        out = {'text': STATS.to_text, 'json': STATS.to_json, 'prometheus': STATS.to_prometheus}[fmt]()
+        if path is None:
+            sys.stderr.write(out)
+        else:
+            with open(path, 'w') as f:
+                f.write(out)
+
+    atexit.register(dump)
 
 
 def gui():
     import PySimpleGUI as sg
 
+    # Read all settings in one go, the module may not be plugged in
+    state = device_state()
+    try:
+        state.refresh(STATE_QUERIES[LED_MATRIX], timeout=PROBE_TIMEOUT)
+    except OSError:
+        pass
+    current_brightness = state.cached(CommandVals.Brightness)
+
     layout = [
         [sg.Text("Bootloader")],
         [sg.Button("Bootloader")],
 
         [sg.Text("Brightness")],
-        # TODO: Get default from device
-        [sg.Slider((0, 255), orientation='h', default_value=120,
+        [sg.Slider((0, 255), orientation='h',
+                   default_value=current_brightness[0] if current_brightness else 120,
                    k='-BRIGHTNESS-', enable_events=True)],
 
         [sg.Text("Animation")],
@@ -1010,7 +3551,8 @@ def gui():
         [sg.Button("Quit")]
     ]
     window = sg.Window("LED Matrix Control", layout)
-    global STOP_THREAD
+    widgets = Compositor()
+    settings = CoalescingWriter()
     while True:
         event, values = window.read()
         # print('Event', event)
@@ -1031,18 +3573,26 @@ def gui():
         if event == 'Stop Animation':
             animate(False)
 
+        # Sliders send lots of events while dragged, don't wait for the port
         if event == '-BRIGHTNESS-':
-            brightness(int(values['-BRIGHTNESS-']))
+            settings.put(CommandVals.Brightness, [int(values['-BRIGHTNESS-'])])
 
         if event == '-PERCENTAGE-':
-            percentage(int(values['-PERCENTAGE-']))
+            settings.put(CommandVals.Pattern, [PatternVals.Percentage, int(values['-PERCENTAGE-'])])
 
+        # Widgets are layers of one compositor, so they can run together
         if event == '-START-COUNTDOWN-':
-            thread = threading.Thread(target=countdown, args=(
-                int(values['-COUNTDOWN-']),), daemon=True)
-            thread.start()
+            try:
+                seconds = int(values['-COUNTDOWN-'])
+            except ValueError:
+                seconds = 0
+            if seconds <= 0:
+                print(f"Countdown needs a positive number of seconds, not {values['-COUNTDOWN-']}")
+            else:
+                widgets.add('countdown', countdown_layer(seconds), fps=min(100, WIDTH * HEIGHT / seconds))
+                widgets.start()
         if event == '-STOP-COUNTDOWN-':
-            STOP_THREAD = True
+            widgets.remove('countdown')
 
         if event == '-SEND-BL-IMAGE-':
             image_bl('stripe.gif')
@@ -1051,10 +3601,10 @@ def gui():
             image_greyscale('greyscale.gif')
 
         if event == '-START-TIME-':
-            thread = threading.Thread(target=clock, args=(), daemon=True)
-            thread.start()
+            widgets.add('clock', clock_layer, fps=1)
+            widgets.start()
         if event == '-STOP-TIME-':
-            STOP_THREAD = True
+            widgets.remove('clock')
 
         if event == '-SEND-TEXT-':
             show_symbols(['2', '5', 'degC', ' ', 'thunder'])
@@ -1063,10 +3613,10 @@ def gui():
             snake()
 
         if event == '-RANDOM-EQ-':
-            thread = threading.Thread(target=random_eq, args=(), daemon=True)
-            thread.start()
+            widgets.add('eq', random_eq_layer, fps=5, z=-1)
+            widgets.start()
         if event == '-STOP-EQ-':
-            STOP_THREAD = True
+            widgets.remove('eq')
 
         if event == 'Sleep':
             send_command(CommandVals.Sleep, [True])
@@ -1074,6 +3624,8 @@ def gui():
         if event == 'Wake':
             send_command(CommandVals.Sleep, [False])
 
+    widgets.stop()
+    settings.close()
     window.close()
 
 
@@ -1095,62 +3647,62 @@ def screen_saver_cmd(on):
 
 
 def set_fps_cmd(mode):
-    res = send_command(CommandVals.SetFps, with_response=True)
-    current_fps = res[0]
+    state = device_state()
+    current_fps = state.get(CommandVals.SetFps)[0]
 
     if mode == 'quarter':
         fps = current_fps & ~LOW_FPS_MASK
         fps |= 0b000
-        send_command(CommandVals.SetFps, [fps])
+        state.set(CommandVals.SetFps, [fps])
         set_power_mode_cmd('low')
     elif mode == 'half':
         fps = current_fps & ~LOW_FPS_MASK
         fps |= 0b001
-        send_command(CommandVals.SetFps, [fps])
+        state.set(CommandVals.SetFps, [fps])
         set_power_mode_cmd('low')
     elif mode == 'one':
         fps = current_fps & ~LOW_FPS_MASK
         fps |= 0b010
-        send_command(CommandVals.SetFps, [fps])
+        state.set(CommandVals.SetFps, [fps])
         set_power_mode_cmd('low')
     elif mode == 'two':
         fps = current_fps & ~LOW_FPS_MASK
         fps |= 0b011
-        send_command(CommandVals.SetFps, [fps])
+        state.set(CommandVals.SetFps, [fps])
         set_power_mode_cmd('low')
     elif mode == 'four':
         fps = current_fps & ~LOW_FPS_MASK
         fps |= 0b100
-        send_command(CommandVals.SetFps, [fps])
+        state.set(CommandVals.SetFps, [fps])
         set_power_mode_cmd('low')
     elif mode == 'eight':
         fps = current_fps & ~LOW_FPS_MASK
         fps |= 0b101
-        send_command(CommandVals.SetFps, [fps])
+        state.set(CommandVals.SetFps, [fps])
         set_power_mode_cmd('low')
     elif mode == 'sixteen':
         fps = current_fps & ~HIGH_FPS_MASK
         fps |= 0b00000000
-        send_command(CommandVals.SetFps, [fps])
+        state.set(CommandVals.SetFps, [fps])
         set_power_mode_cmd('high')
     elif mode == 'thirtytwo':
         fps = current_fps & ~HIGH_FPS_MASK
         fps |= 0b00010000
-        send_command(CommandVals.SetFps, [fps])
+        state.set(CommandVals.SetFps, [fps])
         set_power_mode_cmd('high')
 
 
 def set_power_mode_cmd(mode):
     if mode == 'low':
-        send_command(CommandVals.SetPowerMode, [0])
+        device_state().set(CommandVals.SetPowerMode, [0])
     elif mode == 'high':
-        send_command(CommandVals.SetPowerMode, [1])
+        device_state().set(CommandVals.SetPowerMode, [1])
     else:
         print("Unsupported power mode")
         sys.exit(1)
 
 def get_power_mode_cmd():
-    res = send_command(CommandVals.SetPowerMode, with_response=True)
+    res = device_state().get(CommandVals.SetPowerMode)
     current_mode = int(res[0])
     if current_mode == 0:
         print(f"Current Power Mode: Low Power")
@@ -1158,10 +3710,9 @@ def get_power_mode_cmd():
         print(f"Current Power Mode: High Power")
 
 def get_fps_cmd():
-    res = send_command(CommandVals.SetFps, with_response=True)
-    current_fps = res[0]
-    res = send_command(CommandVals.SetPowerMode, with_response=True)
-    current_mode = int(res[0])
+    (res_fps, res_mode) = device_state().get_many([CommandVals.SetFps, CommandVals.SetPowerMode])
+    current_fps = res_fps[0]
+    current_mode = int(res_mode[0])
 
     if current_mode == 0:
         current_fps &= LOW_FPS_MASK
@@ -1180,425 +3731,42 @@ def get_fps_cmd():
     print(f"Current FPS: {fps}")
 
 
-# 5x6 symbol font. Leaves 2 pixels on each side empty
-# We can leave one row empty below and then the display fits 5 of these digits.
-
-
-def convert_symbol(symbol):
-    symbols = {
-        'degC': [
-            0, 0, 0, 1, 1,
-            0, 0, 0, 1, 1,
-            1, 1, 1, 0, 0,
-            1, 0, 0, 0, 0,
-            1, 0, 0, 0, 0,
-            1, 1, 1, 0, 0,
-        ],
-        'degF': [
-            0, 0, 0, 1, 1,
-            0, 0, 0, 1, 1,
-            1, 1, 1, 0, 0,
-            1, 0, 0, 0, 0,
-            1, 1, 1, 0, 0,
-            1, 0, 0, 0, 0,
-        ],
-        'snow': [
-            0, 0, 0, 0, 0,
-            1, 0, 1, 0, 1,
-            0, 1, 1, 1, 0,
-            1, 1, 1, 1, 1,
-            0, 1, 1, 1, 0,
-            1, 0, 1, 0, 1,
-        ],
-        'sun': [
-            0, 0, 0, 0, 0,
-            0, 1, 1, 1, 0,
-            1, 1, 1, 1, 1,
-            1, 1, 1, 1, 1,
-            1, 1, 1, 1, 1,
-            0, 1, 1, 1, 0,
-        ],
-        'cloud': [
-            0, 0, 0, 0, 0,
-            0, 1, 1, 1, 0,
-            1, 1, 1, 1, 1,
-            1, 1, 1, 1, 1,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-        ],
-        'rain': [
-            0, 1, 1, 1, 0,
-            1, 1, 1, 1, 1,
-            1, 1, 1, 1, 1,
-            0, 1, 0, 0, 1,
-            0, 0, 1, 0, 0,
-            1, 0, 0, 1, 0,
-        ],
-        'thunder': [
-            0, 1, 1, 1, 0,
-            1, 1, 1, 1, 1,
-            1, 1, 1, 1, 1,
-            0, 0, 1, 0, 0,
-            0, 1, 0, 0, 0,
-            0, 0, 1, 0, 0,
-        ],
-        'batteryLow': [
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            1, 1, 1, 1, 0,
-            1, 0, 0, 1, 1,
-            1, 0, 0, 1, 1,
-            1, 1, 1, 1, 0,
-        ],
-        '!!': [
-            0, 1, 0, 1, 0,
-            0, 1, 0, 1, 0,
-            0, 1, 0, 1, 0,
-            0, 0, 0, 0, 0,
-            0, 1, 0, 1, 0,
-            0, 1, 0, 1, 0,
-        ],
-        'heart': [
-            0, 0, 0, 0, 0,
-            1, 1, 0, 1, 1,
-            1, 1, 1, 1, 1,
-            0, 1, 1, 1, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 0, 0, 0,
-        ],
-        'heart0': [
-            1, 1, 0, 1, 1,
-            1, 1, 1, 1, 1,
-            0, 1, 1, 1, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-        ],
-        'heart2': [
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            1, 1, 0, 1, 1,
-            1, 1, 1, 1, 1,
-            0, 1, 1, 1, 0,
-            0, 0, 1, 0, 0,
-        ],
-        ':)': [
-            0, 0, 0, 0, 0,
-            0, 1, 0, 1, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            1, 0, 0, 0, 1,
-            0, 1, 1, 1, 0,
-        ],
-        ':|': [
-            0, 0, 0, 0, 0,
-            0, 1, 0, 1, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            1, 1, 1, 1, 1,
-            0, 0, 0, 0, 0,
-        ],
-        ':(': [
-            0, 0, 0, 0, 0,
-            0, 1, 0, 1, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 1, 1, 1, 0,
-            1, 0, 0, 0, 1,
-        ],
-        ';)': [
-            0, 0, 0, 0, 0,
-            1, 1, 0, 1, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            1, 0, 0, 0, 1,
-            0, 1, 1, 1, 0,
-        ],
-    }
-    if symbol in symbols:
-        return symbols[symbol]
-    else:
-        return None
-
-
-def convert_font(num):
-    """ 5x6 font. Leaves 2 pixels on each side empty
-    We can leave one row empty below and then the display fits 5 of these digits."""
-    font = {
-        '0': [
-            0, 1, 1, 0, 0,
-            1, 0, 0, 1, 0,
-            1, 0, 0, 1, 0,
-            1, 0, 0, 1, 0,
-            1, 0, 0, 1, 0,
-            0, 1, 1, 0, 0,
-        ],
-
-        '1': [
-            0, 0, 1, 0, 0,
-            0, 1, 1, 0, 0,
-            1, 0, 1, 0, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 1, 0, 0,
-            1, 1, 1, 1, 1,
-        ],
-
-        '2': [
-            1, 1, 1, 1, 0,
-            0, 0, 0, 0, 1,
-            1, 1, 1, 1, 1,
-            1, 0, 0, 0, 0,
-            1, 0, 0, 0, 0,
-            1, 1, 1, 1, 1,
-        ],
-
-        '3': [
-            1, 1, 1, 1, 0,
-            0, 0, 0, 0, 1,
-            1, 1, 1, 1, 1,
-            0, 0, 0, 0, 1,
-            0, 0, 0, 0, 1,
-            1, 1, 1, 1, 0,
-        ],
-
-        '4': [
-            0, 0, 0, 1, 0,
-            0, 0, 1, 1, 0,
-            0, 1, 0, 1, 0,
-            1, 1, 1, 1, 1,
-            0, 0, 0, 1, 0,
-            0, 0, 0, 1, 0,
-        ],
-
-        '5': [
-            1, 1, 1, 1, 1,
-            1, 0, 0, 0, 0,
-            1, 1, 1, 1, 1,
-            0, 0, 0, 0, 1,
-            0, 0, 0, 0, 1,
-            1, 1, 1, 1, 0,
-        ],
-
-        '6': [
-            0, 1, 1, 1, 0,
-            1, 0, 0, 0, 0,
-            1, 1, 1, 1, 1,
-            1, 0, 0, 0, 1,
-            1, 0, 0, 0, 1,
-            0, 1, 1, 1, 0,
-        ],
-
-        '7': [
-            1, 1, 1, 1, 1,
-            0, 0, 0, 0, 1,
-            0, 0, 0, 1, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 1, 0, 0,
-        ],
-
-        '8': [
-            0, 1, 1, 1, 0,
-            1, 0, 0, 0, 1,
-            0, 1, 1, 1, 0,
-            1, 0, 0, 0, 1,
-            1, 0, 0, 0, 1,
-            0, 1, 1, 1, 0,
-        ],
-
-        '9': [
-            0, 1, 1, 1, 0,
-            1, 0, 0, 0, 1,
-            1, 1, 1, 1, 1,
-            0, 0, 0, 0, 1,
-            0, 0, 0, 0, 1,
-            0, 1, 1, 1, 0,
-        ],
-
-        ':': [
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 0, 0, 0,
-        ],
-
-        ' ': [
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-        ],
+_SYMBOL_GLYPHS = None
+_FONT_GLYPHS = None
 
-        '?': [
-            0, 1, 1, 0, 0,
-            0, 0, 0, 1, 0,
-            0, 0, 0, 1, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 1, 0, 0,
-        ],
 
-        '.': [
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-        ],
+def compile_glyphs(data):
+    """Freeze font data into an immutable mapping of name to 30 bytes of pixels"""
+    return MappingProxyType({name: bytes(pixels) for (name, pixels) in data.items()})
 
-        ',': [
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-        ],
 
-        '!': [
-            0, 0, 1, 0, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 1, 0, 0,
-        ],
+def symbol_glyphs():
+    """All symbols, loaded and compiled once"""
+    global _SYMBOL_GLYPHS
+    if _SYMBOL_GLYPHS is None:
+        from font import SYMBOLS
+        _SYMBOL_GLYPHS = compile_glyphs(SYMBOLS)
+    return _SYMBOL_GLYPHS
 
-        '/': [
-            0, 0, 0, 0, 1,
-            0, 0, 0, 1, 1,
-            0, 0, 1, 1, 0,
-            0, 1, 1, 0, 0,
-            1, 1, 0, 0, 0,
-            1, 0, 0, 0, 0,
-        ],
 
-        '*': [
-            0, 0, 0, 0, 0,
-            0, 1, 0, 1, 0,
-            0, 0, 1, 0, 0,
-            0, 1, 0, 1, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-        ],
+def font_glyphs():
+    """All font characters, loaded and compiled once"""
+    global _FONT_GLYPHS
+    if _FONT_GLYPHS is None:
+        from font import FONT
+        _FONT_GLYPHS = compile_glyphs(FONT)
+    return _FONT_GLYPHS
 
-        '%': [
-            1, 1, 0, 0, 1,
-            1, 1, 0, 1, 1,
-            0, 0, 1, 1, 0,
-            0, 1, 1, 0, 0,
-            1, 1, 0, 1, 1,
-            1, 0, 0, 1, 1,
-        ],
 
-        '+': [
-            0, 0, 1, 0, 0,
-            0, 0, 1, 0, 0,
-            1, 1, 1, 1, 1,
-            0, 0, 1, 0, 0,
-            0, 0, 1, 0, 0,
-            0, 0, 0, 0, 0,
-        ],
+def convert_symbol(symbol):
+    """Pixels of a symbol, None if there's no symbol with that name"""
+    return symbol_glyphs().get(symbol)
 
-        '-': [
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            1, 1, 1, 1, 1,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-        ],
 
-        '=': [
-            0, 0, 0, 0, 0,
-            1, 1, 1, 1, 1,
-            0, 0, 0, 0, 0,
-            1, 1, 1, 1, 1,
-            0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0,
-        ],
-        'A': [
-            0, 1, 1, 1, 0,
-            1, 0, 0, 0, 1,
-            1, 1, 1, 1, 1,
-            1, 0, 0, 0, 1,
-            1, 0, 0, 0, 1,
-            1, 0, 0, 0, 1,
-        ],
-        'D': [
-            1, 1, 1, 1, 0,
-            1, 0, 0, 0, 1,
-            1, 0, 0, 0, 1,
-            1, 0, 0, 0, 1,
-            1, 0, 0, 0, 1,
-            1, 1, 1, 1, 0,
-        ],
-        'O': [
-            0, 1, 1, 1, 0,
-            1, 0, 0, 0, 1,
-            1, 0, 0, 0, 1,
-            1, 0, 0, 0, 1,
-            1, 0, 0, 0, 1,
-            0, 1, 1, 1, 0,
-        ],
-        'V': [
-            1, 0, 0, 0, 1,
-            1, 0, 0, 0, 1,
-            0, 1, 0, 1, 1,
-            0, 1, 0, 1, 1,
-            0, 0, 1, 0, 0,
-            0, 0, 1, 0, 0,
-        ],
-        'E': [
-            1, 1, 1, 1, 1,
-            1, 0, 0, 0, 0,
-            1, 1, 1, 1, 1,
-            1, 0, 0, 0, 0,
-            1, 0, 0, 0, 0,
-            1, 1, 1, 1, 1,
-        ],
-        'R': [
-            1, 1, 1, 1, 0,
-            1, 0, 0, 1, 0,
-            1, 1, 1, 1, 0,
-            1, 1, 0, 0, 0,
-            1, 0, 1, 0, 0,
-            1, 0, 0, 1, 0,
-        ],
-        'G': [
-            0, 1, 1, 1, 0,
-            1, 0, 0, 0, 0,
-            1, 0, 1, 1, 1,
-            1, 0, 0, 0, 1,
-            1, 0, 0, 0, 1,
-            0, 1, 1, 1, 0,
-        ],
-        'M': [
-            0, 0, 0, 0, 0,
-            0, 1, 0, 1, 0,
-            1, 0, 1, 0, 1,
-            1, 0, 1, 0, 1,
-            1, 0, 1, 0, 1,
-            1, 0, 1, 0, 1,
-        ],
-        'P': [
-            1, 1, 1, 0, 0,
-            1, 0, 0, 1, 0,
-            1, 0, 0, 1, 0,
-            1, 1, 1, 0, 0,
-            1, 0, 0, 0, 0,
-            1, 0, 0, 0, 0,
-        ],
-    }
-    if num in font:
-        return font[num]
-    else:
-        return font['?']
+def convert_font(num):
+    """Pixels of a character, '?' if it's not in the font"""
+    glyphs = font_glyphs()
+    return glyphs.get(num, glyphs['?'])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# Stand-in for an input module on a pseudo terminal, so that control.py and
+# the benchmarks can run without hardware.
+#
+# Usage:
+#   ./emulator.py [--kind ledmatrix] [--latency 0.001]
+#   ./control.py --serial-dev /dev/pts/N --brightness 50
+import argparse
+import os
+import pty
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+from control import CommandVals, FWK_MAGIC, PatternVals, Game, RESPONSE_SIZE
+from control import LED_MATRIX, B1_DISPLAY, C1_MINIMAL
+from control import WIDTH, HEIGHT
+
+MAGIC = bytes(FWK_MAGIC)
+
+# Firmware version 0.1.4, as the bcdDevice bytes followed by the pre-release flag
+VERSION = bytes([0x00, 0x14, 0x00])
+
+# State of a freshly booted module, see the state structs in the firmware
+DEFAULT_STATE = {
+    LED_MATRIX: {
+        CommandVals.Brightness: bytes([120]),
+        CommandVals.Animate: bytes([0]),
+    },
+    B1_DISPLAY: {
+        CommandVals.DisplayOn: bytes([1]),
+        CommandVals.InvertScreen: bytes([0]),
+        CommandVals.ScreenSaver: bytes([1]),
+        # 32fps in high power mode, 2fps in low power mode
+        CommandVals.SetFps: bytes([0x13]),
+        CommandVals.SetPowerMode: bytes([0]),
+    },
+    C1_MINIMAL: {
+        CommandVals.Brightness: bytes([10]),
+        CommandVals.SetColor: bytes([0x00, 0xFF, 0x00]),
+    },
+}
+
+# Commands that set a value when they have an argument and query it without one
+OPTIONAL_ARG = [
+    CommandVals.Brightness,
+    CommandVals.Sleep,
+    CommandVals.Animate,
+    CommandVals.DisplayOn,
+    CommandVals.InvertScreen,
+    CommandVals.ScreenSaver,
+    CommandVals.SetFps,
+    CommandVals.SetPowerMode,
+]
+
+# Queries that each kind of module answers, see parse_module_command in the firmware
+QUERIES = {
+    LED_MATRIX: [CommandVals.Brightness, CommandVals.Animate],
+    B1_DISPLAY: [CommandVals.DisplayOn, CommandVals.InvertScreen, CommandVals.ScreenSaver,
+                 CommandVals.SetFps, CommandVals.SetPowerMode],
+    C1_MINIMAL: [CommandVals.Brightness, CommandVals.SetColor],
+}
+GENERIC_QUERIES = [CommandVals.Sleep, CommandVals.Version]
+
+# Total length, including magic and command byte
+FIXED_LENGTH = {
+    CommandVals.BootloaderReset: 4,
+    CommandVals.Panic: 4,
+    CommandVals.Draw: 3 + 39,
+    CommandVals.StageGreyCol: 3 + 1 + 34,
+    CommandVals.DrawGreyColBuffer: 4,
+    CommandVals.GameControl: 4,
+    CommandVals.GameStatus: 3,
+    CommandVals.SetPixelColumn: 3 + 2 + 50,
+    CommandVals.FlushFramebuffer: 3,
+    CommandVals.ClearRam: 3,
+    CommandVals.Version: 3,
+}
+
+
+# A read this big means the writer had filled the pseudo terminal and may
+# have been cut off in the middle of a command
+FULL_READ = 1024
+# How long to wait for the rest of a command that may have been cut off
+CUT_OFF_WAIT = 0.005
+
+
+def _has_arg(buf):
+    """Whether the command at the start of buf is followed by an argument
+    or directly by the next command"""
+    if len(buf) <= 3:
+        return False
+    return buf[3:5] != MAGIC
+
+
+def frame_length(buf):
+    """Length of the command at the start of buf.
+    None if the command hasn't been fully received yet."""
+    if len(buf) < 3:
+        return None
+    command = buf[2]
+
+    if command in OPTIONAL_ARG:
+        length = 4 if _has_arg(buf) else 3
+    elif command == CommandVals.SetColor:
+        length = 6 if _has_arg(buf) else 3
+    elif command == CommandVals.Pattern:
+        if len(buf) < 4:
+            return None
+        length = 5 if buf[3] == PatternVals.Percentage else 4
+    elif command == CommandVals.StartGame:
+        if len(buf) < 4:
+            return None
+        length = 5 if buf[3] == Game.GameOfLife else 4
+    elif command == CommandVals.SetText:
+        if len(buf) < 4:
+            return None
+        length = 4 + buf[3]
+    else:
+        # Unknown commands are assumed to have no arguments
+        length = FIXED_LENGTH.get(command, 3)
+
+    if len(buf) < length:
+        return None
+    return length
+
+
+class FakeDevice:
+    """Emulated input module behind a pseudo terminal.
+
+    Parses the command stream written to `path` and answers queries with a
+    RESPONSE_SIZE reply, like the firmware does.
+    If kind is given, only the queries of that kind of module are answered,
+    otherwise all of them.
+    Each reply is sent `latency` seconds after its query arrived, to model
+    the USB round trip. Queries that arrive together are answered together.
+
+    The LED grid is modelled as well: `grid` holds what is displayed, one
+    bytearray of HEIGHT levels per column, and `staging` the greyscale
+    columns staged for the next DrawGreyColBuffer.
+    """
+
+    def __init__(self, kind=None, latency=0, record=False):
+        self.kind = kind
+        self.latency = latency
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.commands = 0
+        self.bytes = 0
+        # Number of times each command was received
+        self.counts = {}
+        # Every command received, in order, if record is set
+        self.received = [] if record else None
+        # Last value set with each command
+        self.state = {CommandVals.Sleep: bytes([0]), CommandVals.Version: VERSION}
+        for kind_state in ([DEFAULT_STATE[kind]] if kind else reversed(DEFAULT_STATE.values())):
+            self.state.update(kind_state)
+        self.grid = [bytearray(HEIGHT) for _ in range(WIDTH)]
+        self.staging = [bytearray(HEIGHT) for _ in range(WIDTH)]
+        self._buf = bytearray()
+        self._cut_off = False
+        # Replies waiting for their latency to pass: (time.monotonic() when due, reply)
+        self._replies = deque()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _run(self):
+        while not self._stop.is_set():
+            timeout = CUT_OFF_WAIT if self._cut_off and self._buf else 0.05
+            if self._replies:
+                timeout = min(timeout, max(0, self._replies[0][0] - time.monotonic()))
+            ready, _, _ = select.select([self.master], [], [], timeout)
+            if ready:
+                data = os.read(self.master, 4096)
+                self.bytes += len(data)
+                self._buf += data
+                self._cut_off = len(data) >= FULL_READ
+                self._parse(time.monotonic())
+            elif self._cut_off and self._buf:
+                # Nothing followed, so it was complete
+                self._cut_off = False
+                self._parse(time.monotonic())
+            while self._replies and self._replies[0][0] <= time.monotonic():
+                os.write(self.master, self._replies.popleft()[1])
+
+    def _parse(self, received):
+        while True:
+            start = self._buf.find(MAGIC)
+            if start < 0:
+                # Keep a trailing magic byte, the rest may follow
+                del self._buf[:max(0, len(self._buf) - 1)]
+                return
+            del self._buf[:start]
+
+            length = frame_length(self._buf)
+            if length is None:
+                return
+            if self._cut_off and length == len(self._buf) and not _has_arg(self._buf) and \
+                    (self._buf[2] in OPTIONAL_ARG or self._buf[2] == CommandVals.SetColor):
+                # A query, or a command whose argument is still to come
+                return
+            frame = bytes(self._buf[:length])
+            del self._buf[:length]
+
+            self.commands += 1
+            self.counts[frame[2]] = self.counts.get(frame[2], 0) + 1
+            if self.received is not None:
+                self.received.append(frame)
+            response = self.handle(frame[2], frame[3:])
+            if response is not None:
+                self._replies.append((received + self.latency, response))
+
+    def draw(self, command, args):
+        """Update the modelled LED grid"""
+        if command == CommandVals.Draw:
+            for x in range(WIDTH):
+                for y in range(HEIGHT):
+                    i = x + WIDTH * y
+                    self.grid[x][y] = 0xFF if args[i // 8] & (1 << i % 8) else 0x00
+        elif command == CommandVals.StageGreyCol:
+            if args[0] < WIDTH:
+                self.staging[args[0]][:] = args[1:1 + HEIGHT]
+        elif command == CommandVals.DrawGreyColBuffer:
+            # The firmware zeroes the staging buffer after displaying it
+            self.grid = self.staging
+            self.staging = [bytearray(HEIGHT) for _ in range(WIDTH)]
+        elif command == CommandVals.Pattern and args[0] == PatternVals.Percentage:
+            on = args[1] * HEIGHT // 100
+            for col in self.grid:
+                col[:] = bytes(HEIGHT - on) + b'\xff' * on
+
+    def handle(self, command, args):
+        """Handle a single command, return the response, if any"""
+        if self.state[CommandVals.Sleep][0] and \
+                command not in [CommandVals.Sleep, CommandVals.BootloaderReset]:
+            # While asleep the firmware ignores everything but waking up
+            return None
+        if self.kind in [None, LED_MATRIX]:
+            self.draw(command, args)
+        if self.kind is not None and command not in QUERIES[self.kind] + GENERIC_QUERIES:
+            return None
+        if command in OPTIONAL_ARG or command in [CommandVals.SetColor, CommandVals.Version]:
+            if args:
+                # Remember the value, to return it when queried
+                self.state[command] = bytes(args)
+            else:
+                return self.state.get(command, b'').ljust(RESPONSE_SIZE, b'\x00')
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kind', choices=list(QUERIES),
+                        help='Kind of module to emulate. Default: answer all queries')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds to wait before answering a query')
+    args = parser.parse_args()
+
+    with FakeDevice(args.kind, args.latency) as dev:
+        print(f"Emulating input module on {dev.path}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        print(f"Received {dev.commands} commands, {dev.bytes} bytes")
+
+
+if __name__ == "__main__":
+    main()
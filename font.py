@@ -0,0 +1,408 @@
+# Pixels of the 5x6 font and symbols, by name, shown by control.py.
+# Kept in its own module so that control.py only loads it when rendering text.
+# Each item leaves 2 pixels on each side empty. We can leave one row empty
+# below and then the display fits 5 of these digits.
+
+SYMBOLS = {
+    'degC': [
+        0, 0, 0, 1, 1,
+        0, 0, 0, 1, 1,
+        1, 1, 1, 0, 0,
+        1, 0, 0, 0, 0,
+        1, 0, 0, 0, 0,
+        1, 1, 1, 0, 0,
+    ],
+    'degF': [
+        0, 0, 0, 1, 1,
+        0, 0, 0, 1, 1,
+        1, 1, 1, 0, 0,
+        1, 0, 0, 0, 0,
+        1, 1, 1, 0, 0,
+        1, 0, 0, 0, 0,
+    ],
+    'snow': [
+        0, 0, 0, 0, 0,
+        1, 0, 1, 0, 1,
+        0, 1, 1, 1, 0,
+        1, 1, 1, 1, 1,
+        0, 1, 1, 1, 0,
+        1, 0, 1, 0, 1,
+    ],
+    'sun': [
+        0, 0, 0, 0, 0,
+        0, 1, 1, 1, 0,
+        1, 1, 1, 1, 1,
+        1, 1, 1, 1, 1,
+        1, 1, 1, 1, 1,
+        0, 1, 1, 1, 0,
+    ],
+    'cloud': [
+        0, 0, 0, 0, 0,
+        0, 1, 1, 1, 0,
+        1, 1, 1, 1, 1,
+        1, 1, 1, 1, 1,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+    ],
+    'rain': [
+        0, 1, 1, 1, 0,
+        1, 1, 1, 1, 1,
+        1, 1, 1, 1, 1,
+        0, 1, 0, 0, 1,
+        0, 0, 1, 0, 0,
+        1, 0, 0, 1, 0,
+    ],
+    'thunder': [
+        0, 1, 1, 1, 0,
+        1, 1, 1, 1, 1,
+        1, 1, 1, 1, 1,
+        0, 0, 1, 0, 0,
+        0, 1, 0, 0, 0,
+        0, 0, 1, 0, 0,
+    ],
+    'batteryLow': [
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        1, 1, 1, 1, 0,
+        1, 0, 0, 1, 1,
+        1, 0, 0, 1, 1,
+        1, 1, 1, 1, 0,
+    ],
+    '!!': [
+        0, 1, 0, 1, 0,
+        0, 1, 0, 1, 0,
+        0, 1, 0, 1, 0,
+        0, 0, 0, 0, 0,
+        0, 1, 0, 1, 0,
+        0, 1, 0, 1, 0,
+    ],
+    'heart': [
+        0, 0, 0, 0, 0,
+        1, 1, 0, 1, 1,
+        1, 1, 1, 1, 1,
+        0, 1, 1, 1, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 0, 0, 0,
+    ],
+    'heart0': [
+        1, 1, 0, 1, 1,
+        1, 1, 1, 1, 1,
+        0, 1, 1, 1, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+    ],
+    'heart2': [
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        1, 1, 0, 1, 1,
+        1, 1, 1, 1, 1,
+        0, 1, 1, 1, 0,
+        0, 0, 1, 0, 0,
+    ],
+    ':)': [
+        0, 0, 0, 0, 0,
+        0, 1, 0, 1, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        1, 0, 0, 0, 1,
+        0, 1, 1, 1, 0,
+    ],
+    ':|': [
+        0, 0, 0, 0, 0,
+        0, 1, 0, 1, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        1, 1, 1, 1, 1,
+        0, 0, 0, 0, 0,
+    ],
+    ':(': [
+        0, 0, 0, 0, 0,
+        0, 1, 0, 1, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 1, 1, 1, 0,
+        1, 0, 0, 0, 1,
+    ],
+    ';)': [
+        0, 0, 0, 0, 0,
+        1, 1, 0, 1, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        1, 0, 0, 0, 1,
+        0, 1, 1, 1, 0,
+    ],
+}
+
+
+FONT = {
+    '0': [
+        0, 1, 1, 0, 0,
+        1, 0, 0, 1, 0,
+        1, 0, 0, 1, 0,
+        1, 0, 0, 1, 0,
+        1, 0, 0, 1, 0,
+        0, 1, 1, 0, 0,
+    ],
+
+    '1': [
+        0, 0, 1, 0, 0,
+        0, 1, 1, 0, 0,
+        1, 0, 1, 0, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 1, 0, 0,
+        1, 1, 1, 1, 1,
+    ],
+
+    '2': [
+        1, 1, 1, 1, 0,
+        0, 0, 0, 0, 1,
+        1, 1, 1, 1, 1,
+        1, 0, 0, 0, 0,
+        1, 0, 0, 0, 0,
+        1, 1, 1, 1, 1,
+    ],
+
+    '3': [
+        1, 1, 1, 1, 0,
+        0, 0, 0, 0, 1,
+        1, 1, 1, 1, 1,
+        0, 0, 0, 0, 1,
+        0, 0, 0, 0, 1,
+        1, 1, 1, 1, 0,
+    ],
+
+    '4': [
+        0, 0, 0, 1, 0,
+        0, 0, 1, 1, 0,
+        0, 1, 0, 1, 0,
+        1, 1, 1, 1, 1,
+        0, 0, 0, 1, 0,
+        0, 0, 0, 1, 0,
+    ],
+
+    '5': [
+        1, 1, 1, 1, 1,
+        1, 0, 0, 0, 0,
+        1, 1, 1, 1, 1,
+        0, 0, 0, 0, 1,
+        0, 0, 0, 0, 1,
+        1, 1, 1, 1, 0,
+    ],
+
+    '6': [
+        0, 1, 1, 1, 0,
+        1, 0, 0, 0, 0,
+        1, 1, 1, 1, 1,
+        1, 0, 0, 0, 1,
+        1, 0, 0, 0, 1,
+        0, 1, 1, 1, 0,
+    ],
+
+    '7': [
+        1, 1, 1, 1, 1,
+        0, 0, 0, 0, 1,
+        0, 0, 0, 1, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 1, 0, 0,
+    ],
+
+    '8': [
+        0, 1, 1, 1, 0,
+        1, 0, 0, 0, 1,
+        0, 1, 1, 1, 0,
+        1, 0, 0, 0, 1,
+        1, 0, 0, 0, 1,
+        0, 1, 1, 1, 0,
+    ],
+
+    '9': [
+        0, 1, 1, 1, 0,
+        1, 0, 0, 0, 1,
+        1, 1, 1, 1, 1,
+        0, 0, 0, 0, 1,
+        0, 0, 0, 0, 1,
+        0, 1, 1, 1, 0,
+    ],
+
+    ':': [
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 0, 0, 0,
+    ],
+
+    ' ': [
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+    ],
+
+    '?': [
+        0, 1, 1, 0, 0,
+        0, 0, 0, 1, 0,
+        0, 0, 0, 1, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 1, 0, 0,
+    ],
+
+    '.': [
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+    ],
+
+    ',': [
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+    ],
+
+    '!': [
+        0, 0, 1, 0, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 1, 0, 0,
+    ],
+
+    '/': [
+        0, 0, 0, 0, 1,
+        0, 0, 0, 1, 1,
+        0, 0, 1, 1, 0,
+        0, 1, 1, 0, 0,
+        1, 1, 0, 0, 0,
+        1, 0, 0, 0, 0,
+    ],
+
+    '*': [
+        0, 0, 0, 0, 0,
+        0, 1, 0, 1, 0,
+        0, 0, 1, 0, 0,
+        0, 1, 0, 1, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+    ],
+
+    '%': [
+        1, 1, 0, 0, 1,
+        1, 1, 0, 1, 1,
+        0, 0, 1, 1, 0,
+        0, 1, 1, 0, 0,
+        1, 1, 0, 1, 1,
+        1, 0, 0, 1, 1,
+    ],
+
+    '+': [
+        0, 0, 1, 0, 0,
+        0, 0, 1, 0, 0,
+        1, 1, 1, 1, 1,
+        0, 0, 1, 0, 0,
+        0, 0, 1, 0, 0,
+        0, 0, 0, 0, 0,
+    ],
+
+    '-': [
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        1, 1, 1, 1, 1,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+    ],
+
+    '=': [
+        0, 0, 0, 0, 0,
+        1, 1, 1, 1, 1,
+        0, 0, 0, 0, 0,
+        1, 1, 1, 1, 1,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+    ],
+    'A': [
+        0, 1, 1, 1, 0,
+        1, 0, 0, 0, 1,
+        1, 1, 1, 1, 1,
+        1, 0, 0, 0, 1,
+        1, 0, 0, 0, 1,
+        1, 0, 0, 0, 1,
+    ],
+    'D': [
+        1, 1, 1, 1, 0,
+        1, 0, 0, 0, 1,
+        1, 0, 0, 0, 1,
+        1, 0, 0, 0, 1,
+        1, 0, 0, 0, 1,
+        1, 1, 1, 1, 0,
+    ],
+    'O': [
+        0, 1, 1, 1, 0,
+        1, 0, 0, 0, 1,
+        1, 0, 0, 0, 1,
+        1, 0, 0, 0, 1,
+        1, 0, 0, 0, 1,
+        0, 1, 1, 1, 0,
+    ],
+    'V': [
+        1, 0, 0, 0, 1,
+        1, 0, 0, 0, 1,
+        0, 1, 0, 1, 1,
+        0, 1, 0, 1, 1,
+        0, 0, 1, 0, 0,
+        0, 0, 1, 0, 0,
+    ],
+    'E': [
+        1, 1, 1, 1, 1,
+        1, 0, 0, 0, 0,
+        1, 1, 1, 1, 1,
+        1, 0, 0, 0, 0,
+        1, 0, 0, 0, 0,
+        1, 1, 1, 1, 1,
+    ],
+    'R': [
+        1, 1, 1, 1, 0,
+        1, 0, 0, 1, 0,
+        1, 1, 1, 1, 0,
+        1, 1, 0, 0, 0,
+        1, 0, 1, 0, 0,
+        1, 0, 0, 1, 0,
+    ],
+    'G': [
+        0, 1, 1, 1, 0,
+        1, 0, 0, 0, 0,
+        1, 0, 1, 1, 1,
+        1, 0, 0, 0, 1,
+        1, 0, 0, 0, 1,
+        0, 1, 1, 1, 0,
+    ],
+    'M': [
+        0, 0, 0, 0, 0,
+        0, 1, 0, 1, 0,
+        1, 0, 1, 0, 1,
+        1, 0, 1, 0, 1,
+        1, 0, 1, 0, 1,
+        1, 0, 1, 0, 1,
+    ],
+    'P': [
+        1, 1, 1, 0, 0,
+        1, 0, 0, 1, 0,
+        1, 0, 0, 1, 0,
+        1, 1, 1, 0, 0,
+        1, 0, 0, 0, 0,
+        1, 0, 0, 0, 0,
+    ],
+}
@@ -6,39 +6,329 @@
 # (0x00, 0), // x:1, y:1, sw:1, cs:1, id:1
 # (0x1e, 0), // x:2, y:1, sw:2, cs:1, id:2
 # [...]
+#
+# Usage:
+#   ./led-matrix.py > table.txt
+#   ./led-matrix.py --format python
+#   ./led-matrix.py --format bin --output mapping.bin
+#   ./led-matrix.py --height 39 --segments rows:4,columns:4,columns:8,columns:16,rows:7
+#   ./led-matrix.py --check
+#
+# Uses NumPy if it's installed, otherwise only the standard library.
 
+import argparse
+import sys
+from array import array
 from dataclasses import dataclass
 
 WIDTH = 9
 HEIGHT = 34
 
+# The IS31FL3741A has 9 SW and 39 CS lines
+MAX_SW = 9
+MAX_CS = 39
+# Registers per data page, page 1 has fewer
+PAGE_SIZE = 0xB4
+
+# How the LEDs of the Framework Laptop 16 LED Matrix Module are numbered,
+# from the top CS line down. Each segment covers a number of CS lines.
+# In 'rows' segments the ids go right and then down, in 'columns' segments
+# down and then right.
+FL16_SEGMENTS = [
+    ('rows', 4),  # CS1 through CS4
+    ('columns', 4),  # CS5 through CS8
+    ('columns', 8),  # CS9 through CS16
+    ('columns', 16),  # CS17 through CS32
+    ('rows', 2),  # CS33 through CS34
+]
+
 
 @dataclass
-class Led:
-    id: int
-    x: int
-    y: int
-    # Values from 1 to 9
-    sw: int
-    # Values from 1 to 34
-    cs: int
-
-    def led_register(self):
-        # See the IS31FL3741A for how the data pages are separated
-        if self.cs <= 30 and self.sw >= 7:
-            page = 1
-            register = self.cs - 1 + (self.sw-7) * 30
-        if self.cs <= 30 and self.sw <= 6:
-            page = 0
-            register = self.cs - 1 + (self.sw-1) * 30
-        if self.cs >= 31:
-            page = 1
-            register = 0x5A + self.cs - 31 + (self.sw-1) * 9
-        return (register, page)
+class Geometry:
+    """Size of the matrix and how its LEDs are wired.
+    x is connected to SW and y to CS."""
+    width: int
+    height: int
+    segments: list
+
+    def validate(self):
+        if not 0 < self.width <= MAX_SW or not 0 < self.height <= MAX_CS:
+            raise ValueError(f"{self.width}x{self.height} doesn't fit the controller, "
+                             f"at most {MAX_SW}x{MAX_CS}")
+        for order, count in self.segments:
+            if order not in ['rows', 'columns'] or count <= 0:
+                raise ValueError(f"Invalid segment: {order}:{count}")
+        if sum(count for _, count in self.segments) != self.height:
+            raise ValueError(f"Segments cover {sum(c for _, c in self.segments)} CS lines, "
+                             f"expected {self.height}")
+
+
+FL16 = Geometry(WIDTH, HEIGHT, FL16_SEGMENTS)
+
+
+def parse_segments(spec):
+    """Parse segments like 'rows:4,columns:4'"""
+    segments = []
+    for segment in spec.split(','):
+        order, _, count = segment.partition(':')
+        segments.append((order, int(count)))
+    return segments
+
+
+@dataclass
+class RegisterMap:
+    """The mapping of each LED, as arrays indexed by x + y * width (0-based)"""
+    geometry: Geometry
+    x: object
+    y: object
+    sw: object
+    cs: object
+    id: object
+    register: object
+    page: object
+    # LED index of each register, page * PAGE_SIZE + register. -1 if unused
+    inverse: object
+
+    def led_at(self, register, page):
+        """(x, y) of the LED behind a register, 1-based. None if unused"""
+        index = self.inverse[page * PAGE_SIZE + register]
+        if index < 0:
+            return None
+        return (int(self.x[index]), int(self.y[index]))
+
+    def table(self):
+        """The map as a LedTable"""
+        return LedTable.from_columns(self.geometry.width, self.geometry.height, **{
+            field: getattr(self, field) for field in LedTable.FIELDS})
+
+
+def led_registers(cs, sw):
+    """Registers and pages of arrays of CS and SW lines (1-based).
+    See the IS31FL3741A datasheet for how the data pages are separated."""
+    import numpy as np
+    page = np.where((cs <= 30) & (sw <= 6), 0, 1)
+    register = np.where(cs >= 31, 0x5A + cs - 31 + (sw - 1) * 9,
+                        np.where(sw >= 7, cs - 1 + (sw - 7) * 30, cs - 1 + (sw - 1) * 30))
+    return register, page
+
+
+def register_map(geometry=FL16):
+    """Compute the register map of a whole matrix at once"""
+    try:
+        import numpy as np
+    except ImportError:
+        return register_map_slow(geometry)
+    geometry.validate()
+    width = geometry.width
+    sw = np.tile(np.arange(1, width + 1), geometry.height)
+    cs = np.repeat(np.arange(1, geometry.height + 1), width)
+
+    ids = np.empty_like(cs)
+    for order, count, base_cs in segment_bases(geometry.segments):
+        segment = (cs > base_cs) & (cs <= base_cs + count)
+        local_cs = cs[segment] - base_cs
+        if order == 'rows':
+            ids[segment] = width * (base_cs + local_cs - 1) + sw[segment]
+        else:
+            ids[segment] = width * base_cs + count * (sw[segment] - 1) + local_cs
+
+    register, page = led_registers(cs, sw)
+    inverse = np.full(2 * PAGE_SIZE, -1)
+    inverse[page * PAGE_SIZE + register] = np.arange(len(cs))
+
+    # Every LED must have its own id and register
+    n = width * geometry.height
+    if not np.array_equal(np.sort(ids), np.arange(1, n + 1)):
+        raise ValueError("LED ids are not unique")
+    if np.count_nonzero(inverse >= 0) != n:
+        raise ValueError("LEDs share a register")
+
+    return RegisterMap(geometry, x=sw, y=cs, sw=sw, cs=cs, id=ids,
+                       register=register, page=page, inverse=inverse)
+
+
+def register_map_slow(geometry=FL16):
+    """register_map without NumPy, one LED at a time"""
+    geometry.validate()
+    width = geometry.width
+    leds = LedTable(width, geometry.height)
+    segment_of_cs = [(order, count, base_cs)
+                     for (order, count, base_cs) in segment_bases(geometry.segments)
+                     for _ in range(count)]
+    for cs in range(1, geometry.height + 1):
+        order, count, base_cs = segment_of_cs[cs - 1]
+        for sw in range(1, width + 1):
+            if order == 'rows':
+                led_id = width * (cs - 1) + sw
+            else:
+                led_id = width * base_cs + count * (sw - 1) + cs - base_cs
+            leds.append(id=led_id, x=sw, y=cs, sw=sw, cs=cs)
+    leds.validate()
+
+    inverse = [-1] * (2 * PAGE_SIZE)
+    for index in range(len(leds)):
+        inverse[leds.page[index] * PAGE_SIZE + leds.register[index]] = index
+    return RegisterMap(geometry, x=leds.x, y=leds.y, sw=leds.sw, cs=leds.cs, id=leds.id,
+                       register=leds.register, page=leds.page, inverse=inverse)
+
+
+def segment_bases(segments):
+    """(order, count, CS lines above) of each segment"""
+    base_cs = 0
+    for order, count in segments:
+        yield (order, count, base_cs)
+        base_cs += count
+
+
+def emit_rust(mapping, out):
+    """The lookup table in fl16.rs"""
+    for row in zip(mapping.register, mapping.page, mapping.x, mapping.y,
+                   mapping.sw, mapping.cs, mapping.id):
+        out.write("(0x{:02x}, {}), // x:{}, y:{}, sw:{}, cs:{}, id:{}\n".format(*row))
+
+
+def emit_python(mapping, out):
+    """Python tuples of the (register, page) of each LED and the LED behind each register"""
+    out.write(f"WIDTH = {mapping.geometry.width}\n")
+    out.write(f"HEIGHT = {mapping.geometry.height}\n\n")
+    out.write("# (register, page) of each LED, index = x + y * WIDTH\n")
+    out.write("LED_REGISTERS = (\n")
+    for register, page in zip(mapping.register, mapping.page):
+        out.write(f"    (0x{register:02x}, {page}),\n")
+    out.write(")\n\n")
+    out.write(f"# LED index of each register, index = page * {PAGE_SIZE} + register. -1 if unused\n")
+    out.write(f"REGISTER_LEDS = {tuple(int(i) for i in mapping.inverse)}\n")
+
+
+def emit_bin(mapping, out):
+    """Two bytes per LED, register and page, index = x + y * width"""
+    out.write(bytes(int(value) for led in zip(mapping.register, mapping.page) for value in led))
+
+
+EMITTERS = {
+    'rust': emit_rust,
+    'python': emit_python,
+    'bin': emit_bin,
+}
+
+
+def led_register(sw, cs):
+    """Register and page of a single LED (1-based SW and CS)"""
+    # See the IS31FL3741A for how the data pages are separated
+    if cs <= 30 and sw >= 7:
+        page = 1
+        register = cs - 1 + (sw-7) * 30
+    if cs <= 30 and sw <= 6:
+        page = 0
+        register = cs - 1 + (sw-1) * 30
+    if cs >= 31:
+        page = 1
+        register = 0x5A + cs - 31 + (sw-1) * 9
+    return (register, page)
+
+
+# Marks unused entries in the lookup arrays of LedTable
+UNUSED = 0xFFFF
+
+
+class LedTable:
+    """Compact table of LEDs, one array('H') column per field.
+
+    Rows are indexed by x + y * width, with x and y starting at 0 like the
+    framebuffer. The x, y, sw, cs and id values stored in the table start
+    at 1, like the comments in fl16.rs.
+    Call validate() after filling the table, it builds the lookups by id
+    and by register.
+    """
+    __slots__ = ('width', 'height', 'id', 'x', 'y', 'sw', 'cs', 'register', 'page',
+                 '_by_id', '_by_register')
+    FIELDS = ('id', 'x', 'y', 'sw', 'cs', 'register', 'page')
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        for field in self.FIELDS:
+            setattr(self, field, array('H'))
+        self._by_id = None
+        self._by_register = None
+
+    def __len__(self):
+        return len(self.id)
+
+    def append(self, id, x, y, sw, cs):
+        """Add the next LED, computing its register"""
+        (register, page) = led_register(sw, cs)
+        for field, value in zip(self.FIELDS, (id, x, y, sw, cs, register, page)):
+            getattr(self, field).append(value)
+
+    @classmethod
+    def from_columns(cls, width, height, **columns):
+        """Build a table from sequences of ints, e.g. NumPy arrays"""
+        table = cls(width, height)
+        for field in cls.FIELDS:
+            getattr(table, field).extend(int(v) for v in columns[field])
+        table.validate()
+        return table
+
+    def validate(self):
+        """Check that the table is a bijection between positions, ids and
+        registers and build the lookups. Raises ValueError if not."""
+        n = self.width * self.height
+        if any(len(getattr(self, field)) != n for field in self.FIELDS):
+            raise ValueError(f"Expected {n} LEDs")
+
+        by_id = array('H', [UNUSED]) * (n + 1)
+        by_register = array('H', [UNUSED]) * (2 * PAGE_SIZE)
+        for index in range(n):
+            if (self.x[index] - 1, self.y[index] - 1) != (index % self.width, index // self.width):
+                raise ValueError(f"LED {index} is at x:{self.x[index]}, y:{self.y[index]}")
+            led_id = self.id[index]
+            if not 1 <= led_id <= n or by_id[led_id] != UNUSED:
+                raise ValueError(f"LED {index} has invalid or duplicate id {led_id}")
+            by_id[led_id] = index
+            if self.page[index] > 1 or self.register[index] >= PAGE_SIZE:
+                raise ValueError(f"LED {index} has invalid register")
+            key = self.page[index] * PAGE_SIZE + self.register[index]
+            if by_register[key] != UNUSED:
+                raise ValueError(f"LEDs {by_register[key]} and {index} share a register")
+            by_register[key] = index
+        # n positions, n distinct ids in 1..n and n distinct registers
+        self._by_id = by_id
+        self._by_register = by_register
+
+    def by_xy(self, x, y):
+        """Index of the LED at framebuffer position x, y"""
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError(f"{x}, {y} is outside of the matrix")
+        return x + y * self.width
+
+    def by_id(self, led_id):
+        """Index of the LED with the id, None if there is none"""
+        index = self._by_id[led_id] if 0 < led_id < len(self._by_id) else UNUSED
+        return None if index == UNUSED else index
+
+    def by_register(self, register, page):
+        """Index of the LED behind the register, None if it's unused"""
+        index = self._by_register[page * PAGE_SIZE + register]
+        return None if index == UNUSED else index
+
+    def led(self, index):
+        """All fields of a LED, as a tuple in the order of FIELDS"""
+        return tuple(getattr(self, field)[index] for field in self.FIELDS)
+
+    def pages(self, levels):
+        """Convert framebuffer levels, indexed by x + y * width, to the
+        contents of the two PWM pages of the controller"""
+        pages = (bytearray(PAGE_SIZE), bytearray(PAGE_SIZE))
+        register, page = self.register, self.page
+        for index, level in enumerate(levels):
+            pages[page[index]][register[index]] = level
+        return pages
 
 
 def get_leds():
-    leds = []
+    """Build the LED table one LED at a time"""
+    leds = LedTable(WIDTH, HEIGHT)
 
     # Generate LED mapping as how they are mapped in the Framework Laptop 16 LED Matrix Module
 
@@ -46,7 +336,7 @@ def get_leds():
     # CS1 through CS4
     for cs in range(1, 5):
         for sw in range(1, WIDTH+1):
-            leds.append(Led(id=WIDTH * (cs-1) + sw, x=sw, y=cs, sw=sw, cs=cs))
+            leds.append(id=WIDTH * (cs-1) + sw, x=sw, y=cs, sw=sw, cs=cs)
 
     # First right and then down
     # CS5 through CS7
@@ -54,8 +344,8 @@ def get_leds():
     base_id = WIDTH * base_cs
     for cs in range(1, 5):
         for sw in range(1, WIDTH+1):
-            leds.append(Led(id=base_id + 4 * (sw-1) + cs, x=sw,
-                        y=cs+base_cs, sw=sw, cs=cs+base_cs))
+            leds.append(id=base_id + 4 * (sw-1) + cs, x=sw,
+                        y=cs+base_cs, sw=sw, cs=cs+base_cs)
 
     # First right and then down
     # CS9 through CS16
@@ -63,8 +353,8 @@ def get_leds():
     base_id = WIDTH * base_cs
     for cs in range(1, 9):
         for sw in range(1, WIDTH+1):
-            leds.append(Led(id=base_id + 8 * (sw-1) + cs, x=sw,
-                        y=cs+base_cs, sw=sw, cs=cs+base_cs))
+            leds.append(id=base_id + 8 * (sw-1) + cs, x=sw,
+                        y=cs+base_cs, sw=sw, cs=cs+base_cs)
 
     # First right and then down
     # CS17 through CS32
@@ -72,8 +362,8 @@ def get_leds():
     base_id = WIDTH * base_cs
     for cs in range(1, 17):
         for sw in range(1, WIDTH+1):
-            leds.append(Led(id=base_id + 16 * (sw-1) + cs, x=sw,
-                        y=cs+base_cs, sw=sw, cs=cs+base_cs))
+            leds.append(id=base_id + 16 * (sw-1) + cs, x=sw,
+                        y=cs+base_cs, sw=sw, cs=cs+base_cs)
 
     # First down and then right
     # CS33 through CS34
@@ -81,39 +371,77 @@ def get_leds():
     base_id = WIDTH * base_cs
     for cs in range(1, 3):
         for sw in range(1, WIDTH+1):
-            leds.append(Led(id=base_id + 9 * (cs-1) + sw, x=sw,
-                        y=cs+base_cs, sw=sw, cs=cs+base_cs))
+            leds.append(id=base_id + 9 * (cs-1) + sw, x=sw,
+                        y=cs+base_cs, sw=sw, cs=cs+base_cs)
 
+    leds.validate()
     return leds
 
 
-def main():
-    # Assumes that the index in the LEDs list is: index = x + y * 9
+def check(mapping):
+    """Compare the register map with the LED by LED generator"""
     leds = get_leds()
+    table = mapping.table()
+    for index in range(len(leds)):
+        if table.led(index) != leds.led(index):
+            print(f"Mismatch at index {index}: {table.led(index)} != {leds.led(index)}")
+            return False
+        (register, page) = (leds.register[index], leds.page[index])
+        if mapping.led_at(register, page) != (leds.x[index], leds.y[index]):
+            print(f"Inverse mismatch at ({register:#04x}, {page})")
+            return False
+    return len(leds) == len(table)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--format', choices=list(EMITTERS), default='rust',
+                        help='Output format. Default: rust')
+    parser.add_argument('--output', help='Write to a file instead of stdout')
+    parser.add_argument('--width', type=int, default=WIDTH)
+    parser.add_argument('--height', type=int, default=HEIGHT)
+    parser.add_argument('--segments', type=parse_segments,
+                        help="Wiring from the top, like 'rows:4,columns:30'. Default: LED Matrix Module")
+    parser.add_argument('--check', action='store_true',
+                        help='Check the LED Matrix Module map against the LED by LED generator')
+    args = parser.parse_args()
+
+    geometry = Geometry(args.width, args.height, args.segments or FL16_SEGMENTS)
+    try:
+        mapping = register_map(geometry)
+    except ValueError as e:
+        parser.error(str(e))
 
-    debug = False
+    if args.check:
+        if geometry != FL16:
+            parser.error("--check only works with the LED Matrix Module geometry")
+        if not check(mapping):
+            sys.exit(1)
+        print("Register map matches")
+        return
 
-    for led in leds:
-        (register, page) = led.led_register()
-        if debug:
-            print(led, "(0x{:02x}, {})".format(register, page))
+    if args.format == 'bin':
+        if args.output:
+            with open(args.output, 'wb') as f:
+                emit_bin(mapping, f)
         else:
-            print("(0x{:02x}, {}), // x:{}, y:{}, sw:{}, cs:{}, id:{}".format(
-                register, page, led.x, led.y, led.sw, led.cs, led.id))
-    # print_led(leds, 0, 30)
+            emit_bin(mapping, sys.stdout.buffer)
+    elif args.output:
+        with open(args.output, 'w') as f:
+            EMITTERS[args.format](mapping, f)
+    else:
+        EMITTERS[args.format](mapping, sys.stdout)
 
 # For debugging
 
 
 def get_led(leds, x, y):
-    return leds[x + y * WIDTH]
+    return leds.led(leds.by_xy(x, y))
 
 
 # For debugging
 def print_led(leds, x, y):
-    led = get_led(leds, x, y)
-    (register, page) = led.led_register()
-    print(led, "(0x{:02x}, {})".format(register, page))
+    print(dict(zip(LedTable.FIELDS, get_led(leds, x, y))))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,737 @@
+#!/usr/bin/env python3
+# Tests for control.py, running against the emulated input module from
+# emulator.py. No hardware needed. benchmark.py only measures how fast
+# things are, these check that they are right.
+#
+# Usage:
+#   python3 -m unittest test_control
+#   python3 -m unittest test_control.TestConversion
+import asyncio
+import contextlib
+import importlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import control
+from control import CommandVals
+from client import Client
+from emulator import FakeDevice
+from benchmark import random_image, reference_draw_vals, reference_grey_cols, reference_b1_columns
+from benchmark import reference_matrix_vals, reference_font_vals, reference_leds_vals, image_file
+from benchmark import reference_eq_vals, key_stream, key_reader, ReferenceSnake, autopilot
+from benchmark import ReferenceLife, band_tone, reference_spectrum
+
+
+def wait_for(dev):
+    """Query a module. It handles commands in order, so once it replies,
+    everything sent before has been handled."""
+    control.SERIAL_POOL.send(dev, control.encode_command(CommandVals.Version), with_response=True)
+
+
+class DeviceTestCase(unittest.TestCase):
+    """Runs every test against a new emulated module, which is SERIAL_DEV"""
+    kind = None
+    latency = 0
+    record = False
+
+    def setUp(self):
+        self.dev = FakeDevice(self.kind, self.latency, self.record)
+        self.dev.start()
+        control.SERIAL_DEV = self.dev.path
+        self.addCleanup(self.stop_device)
+
+    def stop_device(self):
+        control.SERIAL_POOL.close()
+        # The next module may get the same path, but doesn't show anything yet
+        control.GREYSCALE_RENDERERS.clear()
+        control.DRAWN_FRAMES.clear()
+        control.DEVICE_STATES.clear()
+        self.dev.stop()
+
+
+class TestConversion(unittest.TestCase):
+    """NumPy image conversions are byte-identical to the pure Python ones"""
+
+    def check(self, width, height, convert, reference):
+        for seed in range(10):
+            im = random_image(width, height, seed)
+            self.assertEqual(convert(im), reference(im), f"Seed {seed}")
+
+    def test_draw_vals(self):
+        self.check(control.WIDTH, control.HEIGHT, control.image_draw_vals, reference_draw_vals)
+
+    def test_grey_cols(self):
+        self.check(control.WIDTH, control.HEIGHT, control.image_grey_cols, reference_grey_cols)
+
+    def test_b1_columns(self):
+        self.check(control.B1_WIDTH, control.B1_HEIGHT, control.b1_image_columns, reference_b1_columns)
+
+
+class TestPacking(unittest.TestCase):
+    """Draw payloads packed with bitmasks are the same as packed bit by bit"""
+
+    def test_matrix(self):
+        rng = random.Random(0)
+        for _ in range(10):
+            matrix = [[rng.randint(0, 1) for _ in range(control.HEIGHT)] for _ in range(control.WIDTH)]
+            self.assertEqual(control.draw_vals(control.matrix_mask(matrix)), reference_matrix_vals(matrix))
+
+    def test_font(self):
+        font_items = [control.convert_font(c) for c in '12:34']
+        self.assertEqual(control.draw_vals(control.font_mask(font_items)), reference_font_vals(font_items))
+
+    def test_leds(self):
+        for leds in range(control.WIDTH * control.HEIGHT + 1):
+            self.assertEqual(control.draw_vals(control.leds_mask(leds)), reference_leds_vals(leds), leds)
+
+    def test_string(self):
+        for text in ['12:34', '00:00', 'ab']:
+            self.assertEqual(list(control.string_draw_vals(text)),
+                             reference_font_vals([control.convert_font(c) for c in text]), text)
+
+
+class TestDisplay(DeviceTestCase):
+    """What the emulated module shows"""
+
+    def grid(self):
+        wait_for(self.dev.path)
+        return [list(col) for col in self.dev.grid]
+
+    def test_image_bl(self):
+        for seed in range(2):
+            im = random_image(control.WIDTH, control.HEIGHT, seed).convert('1')
+            control.image_bl(image_file(im))
+            expected = control.draw_vals(control.matrix_mask(
+                [[im.getpixel((x, y)) for y in range(control.HEIGHT)] for x in range(control.WIDTH)]))
+            self.assertEqual(bytes(control.draw_vals(control.matrix_mask(self.grid()))), bytes(expected))
+
+    def test_image_greyscale(self):
+        for seed in range(2):
+            im = random_image(control.WIDTH, control.HEIGHT, seed)
+            control.image_greyscale(image_file(im))
+            self.assertEqual(self.grid(), [list(col) for col in control.image_grey_cols(im)])
+
+    def test_show_string(self):
+        strings = [f"{h:02}:{m:02}" for h in range(2) for m in range(60)]
+        for s in strings:
+            control.show_string(s)
+        wait_for(self.dev.path)
+        self.assertEqual(self.dev.counts[CommandVals.Draw], len(strings))
+        self.assertEqual(bytes(control.draw_vals(control.matrix_mask(self.grid()))),
+                         control.string_draw_vals(strings[-1]))
+
+
+class TestFramebuffer(DeviceTestCase):
+    """Framebuffers and what they send"""
+
+    def test_eq(self):
+        fb = control.Framebuffer()
+        rng = random.Random(0)
+        for _ in range(100):
+            vals = [rng.randint(0, 33) for _ in range(control.WIDTH)]
+            control.draw_eq(fb, vals)
+            self.assertEqual(fb.draw_vals(), reference_eq_vals(vals), vals)
+
+    def test_text(self):
+        fb = control.Framebuffer()
+        fb.text('12:34')
+        self.assertEqual(fb.draw_vals(), control.string_draw_vals('12:34'))
+
+    def test_greyscale_matches_black_white(self):
+        fb = control.Framebuffer()
+        fb.text('12:34')
+        grey = control.Framebuffer(greyscale=True)
+        grey.blit(fb)
+        self.assertEqual(grey.draw_vals(), fb.draw_vals())
+        self.assertEqual(grey.grey_cols(), fb.grey_cols())
+
+    def test_primitives(self):
+        for greyscale in [False, True]:
+            fb = control.Framebuffer(greyscale)
+            fb.line(0, 0, 8, 33)
+            self.assertTrue(fb.pixel(0, 0) and fb.pixel(8, 33))
+            self.assertEqual(sum(1 for x in range(control.WIDTH) for y in range(control.HEIGHT)
+                                 if fb.pixel(x, y)), control.HEIGHT)
+            fb.clear(0xFF)
+            self.assertEqual(fb.draw_vals(), control.ALL_ON)
+            fb.rect(-2, 30, 5, 10, 0)
+            self.assertEqual([fb.pixel(x, y) for (x, y) in [(0, 29), (0, 30), (2, 33), (3, 33)]],
+                             [0xFF, 0, 0, 0xFF])
+            # Outside of the frame
+            fb.set(control.WIDTH, 0, 0)
+            fb.set(-1, -1, 0)
+            self.assertEqual(fb.pixel(8, 0), 0xFF)
+
+    def test_show_skips_shown_frame(self):
+        for greyscale in [False, True]:
+            fb = control.Framebuffer(greyscale)
+            fb.set(1, 2)
+            self.assertTrue(fb.show())
+            self.assertFalse(fb.show())
+            fb.set(3, 4)
+            self.assertTrue(fb.show())
+            wait_for(self.dev.path)
+            self.assertTrue(self.dev.grid[3][4] and self.dev.grid[1][2])
+
+    def test_other_commands_forget_shown_frame(self):
+        fb = control.Framebuffer()
+        fb.set(1, 2)
+        self.assertTrue(fb.show())
+        control.percentage(50)
+        self.assertTrue(fb.show())
+
+    def test_reconnect_forgets_shown_frame(self):
+        # The module may have been reset meanwhile and show nothing
+        for greyscale in [False, True]:
+            fb = control.Framebuffer(greyscale)
+            fb.set(1, 2)
+            self.assertTrue(fb.show())
+            control.SERIAL_POOL.close()
+            self.assertTrue(fb.show())
+
+
+class TestDashboard(DeviceTestCase):
+    """Several widgets on one matrix, through a Compositor"""
+
+    def shown(self):
+        wait_for(self.dev.path)
+        return bytes(control.draw_vals(control.matrix_mask(self.dev.grid)))
+
+    def test_blend(self):
+        compositor = control.Compositor(fps=10)
+        compositor.add('bottom', lambda fb: fb.rect(0, 0, 4, control.HEIGHT), fps=10)
+        compositor.add('top', lambda fb: fb.rect(2, 0, 4, control.HEIGHT), fps=10, blend=control.BLEND_XOR)
+        self.assertTrue(compositor.tick(0))
+        expected = control.Framebuffer()
+        expected.rect(0, 0, 2, control.HEIGHT)
+        expected.rect(4, 0, 2, control.HEIGHT)
+        self.assertEqual(self.shown(), expected.draw_vals())
+
+        compositor.show('top', False)
+        self.assertTrue(compositor.tick(1))
+        expected.clear()
+        expected.rect(0, 0, 4, control.HEIGHT)
+        self.assertEqual(self.shown(), expected.draw_vals())
+
+    def test_unchanged_frame_not_sent(self):
+        compositor = control.Compositor(fps=10)
+        compositor.add('text', lambda fb: fb.text('12:34'), fps=10)
+        compositor.add('slow', lambda fb: fb.set(0, 0), fps=5)
+        self.assertTrue(compositor.tick(0))
+        for tick in range(1, 10):
+            # Redrawn, but the same
+            self.assertFalse(compositor.tick(tick))
+        self.assertEqual(compositor.frames, 10)
+        self.assertEqual(compositor.layers['slow'].updates, 5)
+        self.assertEqual(self.dev.counts[CommandVals.Draw], compositor.frames_sent)
+        self.assertEqual(self.shown(), compositor.out.draw_vals())
+
+    def test_countdown_layer(self):
+        now = [0.0]
+        with mock.patch.object(control.time, 'monotonic', lambda: now[0]):
+            draw = control.countdown_layer(control.WIDTH * control.HEIGHT)
+            for greyscale in [False, True]:
+                fb = control.Framebuffer(greyscale)
+                for leds in range(control.WIDTH * control.HEIGHT + 1):
+                    now[0] = leds + 0.5
+                    draw(fb)
+                    # Lights the LEDs in the same order as countdown()
+                    self.assertEqual(fb.draw_vals(), bytes(control.draw_vals(control.leds_mask(leds))))
+
+    def test_invalid_progress(self):
+        for arg in ['abc', 'nan', 'inf', '0', '-1']:
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                control.dashboard([f'progress:{arg}'])
+            self.assertIn("positive number of seconds", out.getvalue())
+        self.assertEqual(self.dev.commands, 0)
+
+
+class TestDaemon(DeviceTestCase):
+    """Clients sharing a module through the daemon"""
+    kind = control.LED_MATRIX
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'daemon.sock')
+        self.daemon = control.CommandDaemon(self.path, query_timeout=0.1)
+        thread = threading.Thread(target=self.daemon.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.daemon.shutdown)
+        self.daemon.ready.wait()
+
+    def client(self):
+        client = Client(self.path)
+        self.addCleanup(client.close)
+        return client
+
+    def test_burst_coalesced(self):
+        client = self.client()
+        for i in range(100):
+            self.assertEqual(client.send('Brightness', [i]), {'ok': True})
+        self.assertEqual(client.send('Brightness', response=True)['response'][0], 99)
+        self.assertLess(self.dev.counts[CommandVals.Brightness], 100)
+
+    def test_errors(self):
+        client = self.client()
+        self.assertFalse(client.send('NoSuchCommand')['ok'])
+        self.assertFalse(client.send('Brightness', [256])['ok'])
+        self.assertFalse(json.loads(client.request_line(b'{'))['ok'])
+
+    def test_unanswered_query(self):
+        # The LED matrix doesn't answer SetFps queries
+        client = self.client()
+        self.assertEqual(client.send('SetFps', response=True), {'ok': False, 'error': "timeout"})
+        self.assertEqual(client.send('Brightness', [77]), {'ok': True})
+        self.assertEqual(client.send('Brightness', response=True)['response'][0], 77)
+
+    def test_unanswered_query_doesnt_block_others(self):
+        self.daemon.query_timeout = 0.5
+        replies = []
+        waiting = threading.Thread(
+            target=lambda: replies.append(self.client().send('SetFps', response=True)))
+        waiting.start()
+        time.sleep(0.1)
+        other = self.client()
+        start = time.monotonic()
+        self.assertEqual(other.send('Brightness', [77]), {'ok': True})
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.assertEqual(other.send('Brightness', response=True)['response'][0], 77)
+        waiting.join()
+        self.assertEqual(replies, [{'ok': False, 'error': "timeout"}])
+
+    def test_second_daemon(self):
+        with self.assertRaises(OSError):
+            control.CommandDaemon(self.path).serve_forever()
+        self.assertEqual(self.client().send('Brightness', [1]), {'ok': True})
+
+
+class TestEncoding(DeviceTestCase):
+    """Commands reach the module byte for byte like the previous lists of ints"""
+    record = True
+
+    def test_encode_command(self):
+        for (command, parameters) in [(CommandVals.Version, []), (CommandVals.Brightness, [50]),
+                                      (CommandVals.Draw, list(range(39))),
+                                      (CommandVals.StageGreyCol, bytes([3]) + bytes(range(34)))]:
+            self.assertEqual(control.encode_command(command, parameters),
+                             bytes(control.FWK_MAGIC + [command] + list(parameters)))
+
+    def test_send_command(self):
+        control.send_command(CommandVals.Brightness, [50])
+        control.send_command_raw(control.FWK_MAGIC + [CommandVals.Pattern, control.PatternVals.Gradient])
+        wait_for(self.dev.path)
+        self.assertEqual(self.dev.received[:2], [bytes(control.FWK_MAGIC + [CommandVals.Brightness, 50]),
+                                                 bytes(control.FWK_MAGIC + [CommandVals.Pattern,
+                                                                            control.PatternVals.Gradient])])
+
+    def test_queue(self):
+        queue = control.CommandQueue()
+        cols = [bytes([x]) + bytes([x * 20] * control.HEIGHT) for x in range(control.WIDTH)]
+        queue.put(CommandVals.Brightness, [10])
+        for col in cols:
+            queue.put(CommandVals.StageGreyCol, col)
+        queue.put(CommandVals.DrawGreyColBuffer, [0x00])
+        # Replaces the first brightness, the order of the rest is kept
+        queue.put(CommandVals.Brightness, [20])
+        response = queue.query(CommandVals.Brightness)
+        self.assertEqual(response[0], 20)
+        expected = [control.encode_command(CommandVals.StageGreyCol, col) for col in cols]
+        expected += [control.encode_command(CommandVals.DrawGreyColBuffer, [0x00]),
+                     control.encode_command(CommandVals.Brightness, [20]),
+                     control.encode_command(CommandVals.Brightness)]
+        self.assertEqual(self.dev.received, expected)
+        self.assertEqual(queue.coalesced, 1)
+
+
+class TestRegisterMap(unittest.TestCase):
+    """led-matrix.py's register maps, with and without NumPy"""
+
+    def setUp(self):
+        self.led_matrix = importlib.import_module('led-matrix')
+
+    def test_matches_led_by_led(self):
+        lm = self.led_matrix
+        self.assertTrue(lm.check(lm.register_map()))
+        self.assertTrue(lm.check(lm.register_map_slow()))
+
+    def test_slow_is_the_same(self):
+        lm = self.led_matrix
+        geometries = [lm.FL16, lm.Geometry(9, 39, lm.parse_segments('rows:4,columns:4,columns:8,columns:16,rows:7'))]
+        for geometry in geometries:
+            fast, slow = lm.register_map(geometry), lm.register_map_slow(geometry)
+            for field in ['x', 'y', 'sw', 'cs', 'id', 'register', 'page', 'inverse']:
+                self.assertEqual([int(v) for v in getattr(fast, field)], list(getattr(slow, field)), field)
+
+    def test_invalid_geometry(self):
+        lm = self.led_matrix
+        for geometry in [lm.Geometry(9, 34, [('rows', 3)]), lm.Geometry(10, 34, lm.FL16_SEGMENTS)]:
+            with self.assertRaises(ValueError):
+                lm.register_map(geometry)
+            with self.assertRaises(ValueError):
+                lm.register_map_slow(geometry)
+
+    def test_pages(self):
+        table = self.led_matrix.get_leds()
+        levels = bytes(i % 256 for i in range(len(table)))
+        pages = table.pages(levels)
+        for index, level in enumerate(levels):
+            self.assertEqual(pages[table.page[index]][table.register[index]], level)
+
+
+class TestAsyncDevice(DeviceTestCase):
+    """Pipelined commands on one AsyncDevice, with responses matched to
+    their queries"""
+
+    def run_async(self, test, path=None):
+        async def run():
+            async with control.AsyncDevice(path or self.dev.path) as dev:
+                await test(dev)
+        asyncio.run(asyncio.wait_for(run(), 5))
+
+    def test_concurrent_queries(self):
+        async def sweep(set_value, get_value):
+            for _ in range(20):
+                for value in range(0, 256, 17):
+                    set_value(value)
+                # Every task sets and queries its own value
+                self.assertEqual(await get_value(), value, get_value.__name__)
+
+        async def frames(dev):
+            cols = [[0] * control.HEIGHT for _ in range(control.WIDTH)]
+            for i in range(100):
+                cols[i % control.WIDTH][0] = i
+                dev.draw_greyscale(cols)
+                await asyncio.sleep(0)
+
+        async def test(dev):
+            await asyncio.gather(
+                sweep(dev.brightness, dev.get_brightness),
+                sweep(dev.set_fps, dev.get_fps),
+                sweep(dev.set_power_mode, dev.get_power_mode),
+                frames(dev),
+            )
+        self.run_async(test)
+
+    def test_late_response(self):
+        async def test(dev):
+            dev.brightness(10)
+            with self.assertRaises(asyncio.TimeoutError):
+                await dev.query(CommandVals.Brightness, timeout=0.01)
+            dev.brightness(20)
+            # The late response to the first query must not be taken for this one
+            self.assertEqual(await dev.get_brightness(), 20)
+        with FakeDevice(latency=0.05) as dev:
+            self.run_async(test, dev.path)
+
+    def test_unanswered_query(self):
+        async def test(dev):
+            dev.brightness(30)
+            # An LED matrix doesn't answer SetFps
+            with self.assertRaises(asyncio.TimeoutError):
+                await dev.query(CommandVals.SetFps, timeout=0.05)
+            self.assertEqual(await dev.get_brightness(), 30)
+            self.assertEqual(await dev.get_animate(), False)
+        with FakeDevice(control.LED_MATRIX) as dev:
+            self.run_async(test, dev.path)
+
+    def test_port_failure(self):
+        dev = FakeDevice()
+        dev.start()
+
+        async def test(device):
+            await device.get_brightness()
+            dev.stop()
+            device.brightness(5)
+            with self.assertRaises(OSError):
+                await device.get_brightness()
+            with self.assertRaises(OSError):
+                await device.drain()
+            with self.assertRaises(OSError):
+                device.brightness(5)
+        with self.assertRaises(OSError):
+            # Closing fails just the same
+            self.run_async(test, dev.path)
+
+    def test_b1_helpers(self):
+        async def test(dev):
+            for (set_value, get_value) in [(dev.display_on, dev.get_display_on),
+                                           (dev.invert_screen, dev.get_invert_screen),
+                                           (dev.screen_saver, dev.get_screen_saver)]:
+                for value in [False, True]:
+                    set_value(value)
+                    self.assertEqual(await get_value(), value, get_value.__name__)
+            dev.clear_ram()
+            dev.set_text('FPS')
+            dev.b1_frame([bytes(control.B1_COLUMN_BYTES)] * control.B1_WIDTH)
+            await dev.get_display_on()
+        with FakeDevice(control.B1_DISPLAY) as dev:
+            self.run_async(test, dev.path)
+        for command, count in [(CommandVals.SetPixelColumn, control.B1_WIDTH), (CommandVals.FlushFramebuffer, 1),
+                               (CommandVals.ClearRam, 1), (CommandVals.SetText, 1)]:
+            self.assertEqual(dev.counts.get(command), count, command.name)
+
+    def test_draw_replaces_shown_frame(self):
+        fb = control.Framebuffer()
+        fb.set(0, 0)
+        self.assertTrue(fb.show())
+
+        async def test(dev):
+            dev.send(CommandVals.Draw, control.ALL_OFF)
+            await dev.drain()
+        self.run_async(test)
+        self.assertTrue(fb.show(), "Frame wasn't shown again after an async Draw")
+
+
+class TestCoalescingWriter(DeviceTestCase):
+    """Slider updates from the GUI, sent in the background"""
+
+    def test_last_value_wins(self):
+        writer = control.CoalescingWriter(max_rate=30)
+        for value in range(256):
+            writer.put(CommandVals.Brightness, [value])
+        writer.close()
+        wait_for(self.dev.path)
+        self.assertEqual(self.dev.state[CommandVals.Brightness][0], 255)
+        self.assertEqual(self.dev.counts[CommandVals.Brightness], writer.sent)
+        self.assertLess(writer.sent, 5)
+
+    def test_max_rate(self):
+        writer = control.CoalescingWriter(max_rate=20)
+        start = time.monotonic()
+        while time.monotonic() - start < 0.25:
+            writer.put(CommandVals.Brightness, [int(time.monotonic() * 1000) % 256])
+            time.sleep(0.002)
+        writer.close()
+        # 20 per second, plus the first one and the one sent on close
+        self.assertLessEqual(writer.sent, 0.25 * 20 + 2)
+
+    def test_commands_kept_apart(self):
+        writer = control.CoalescingWriter()
+        writer.put(CommandVals.Brightness, [10])
+        writer.put(CommandVals.Pattern, [control.PatternVals.Percentage, 50])
+        writer.put(CommandVals.Brightness, [20])
+        writer.close()
+        wait_for(self.dev.path)
+        self.assertEqual(self.dev.state[CommandVals.Brightness][0], 20)
+        on = control.HEIGHT // 2
+        self.assertEqual([list(col) for col in self.dev.grid],
+                         [[0] * (control.HEIGHT - on) + [0xFF] * on] * control.WIDTH)
+
+
+class TestInputPipeline(DeviceTestCase):
+    """Key presses, read on a thread and taken by a game"""
+
+    def test_every_key_forwarded(self):
+        identity = {event: event for event in control.GameControlVal}
+        keys = key_stream(200) + [control.GameControlVal.Quit]
+        pipeline = control.InputPipeline(identity, read_key=key_reader(keys, 0)).start()
+        control.forward_game_control(pipeline)
+        wait_for(self.dev.path)
+        self.assertEqual(pipeline.received, len(keys))
+        self.assertEqual(self.dev.counts[CommandVals.GameControl], len(keys))
+        self.assertEqual(pipeline.latency.count, len(keys))
+
+    def test_repeated_directions_coalesced(self):
+        Up, Left = control.GameControlVal.Up, control.GameControlVal.Left
+        SecondLeft = control.GameControlVal.SecondLeft
+        pipeline = control.InputPipeline({}, coalesce=control.OPPOSITE_DIRECTION)
+        for event in [Up, Up, Left, Up, SecondLeft, SecondLeft, Up]:
+            pipeline.put(event)
+        self.assertEqual([event for (event, _) in pipeline.poll()],
+                         [Up, Left, Up, SecondLeft, SecondLeft, Up])
+        self.assertEqual(pipeline.coalesced, 1)
+        # The game took it, so this one counts again
+        pipeline.put(Up)
+        self.assertEqual([event for (event, _) in pipeline.poll()], [Up])
+
+    def test_full_pauses_reading(self):
+        pipeline = control.InputPipeline({}, size=2)
+        putter = threading.Thread(
+            target=lambda: [pipeline.put(event) for event in control.GameControlVal])
+        putter.start()
+        putter.join(0.1)
+        self.assertTrue(putter.is_alive())
+        events = []
+        while putter.is_alive():
+            events += pipeline.wait(0.1)
+        events += pipeline.poll()
+        self.assertEqual([event for (event, _) in events], list(control.GameControlVal))
+
+
+class TestModuleGroup(unittest.TestCase):
+    """Discovery and fan-out to several modules"""
+    kinds = [control.LED_MATRIX, control.B1_DISPLAY, control.LED_MATRIX, control.C1_MINIMAL]
+
+    def setUp(self):
+        self.devices = [FakeDevice(kind) for kind in self.kinds]
+        for dev in self.devices:
+            dev.start()
+            self.addCleanup(dev.stop)
+        self.addCleanup(control.SERIAL_POOL.close)
+        self.modules = control.find_modules([dev.path for dev in self.devices])
+
+    def test_kinds(self):
+        self.assertEqual([m.kind for m in self.modules], self.kinds)
+        self.assertEqual([m.dev for m in self.modules], [dev.path for dev in self.devices])
+
+    def test_canvas(self):
+        with control.ModuleGroup(self.modules) as group:
+            self.assertEqual([m.dev for m in group.matrices], [self.devices[0].path, self.devices[2].path])
+            cols = [[x * 10 + y for y in range(control.HEIGHT)] for x in range(control.WIDTH * 2)]
+            group.draw_canvas_greyscale(cols)
+        for (i, dev) in enumerate([self.devices[0], self.devices[2]]):
+            wait_for(dev.path)
+            self.assertEqual([list(col) for col in dev.grid], cols[i * control.WIDTH:(i + 1) * control.WIDTH])
+        self.assertNotIn(CommandVals.StageGreyCol, self.devices[1].counts)
+
+    def test_broadcast(self):
+        with control.ModuleGroup(self.modules) as group:
+            group.broadcast(CommandVals.Brightness, [42], kind=control.LED_MATRIX)
+            group.broadcast(CommandVals.Sleep, [False])
+        for (dev, kind) in zip(self.devices, self.kinds):
+            wait_for(dev.path)
+            self.assertEqual(dev.counts[CommandVals.Sleep], 1)
+            if kind == control.LED_MATRIX:
+                self.assertEqual(dev.state[CommandVals.Brightness][0], 42)
+            else:
+                self.assertNotEqual(dev.state.get(CommandVals.Brightness), bytes([42]))
+
+
+
+class TestDeviceState(DeviceTestCase):
+    """Settings cached on the host, so that queries and no-op writes are
+    skipped"""
+
+    def test_cache_agrees(self):
+        state = control.device_state()
+        for b in [100, 150, 150, 100]:
+            control.get_brightness()
+            control.brightness(b)
+        cached = state.cached(CommandVals.Brightness)
+        self.assertGreater(state.skipped, 0)
+        state.invalidate()
+        self.assertEqual(control.get_brightness(), cached[0])
+
+    def test_get_many(self):
+        queries = [CommandVals.SetFps, CommandVals.SetPowerMode]
+        responses = control.device_state().get_many(queries)
+        self.assertEqual(responses, [self.dev.state[c].ljust(control.RESPONSE_SIZE, b'\x00')
+                                     for c in queries])
+
+    def test_write_while_asleep(self):
+        # Settings sent while asleep aren't applied, so they're sent again after waking up
+        control.brightness(60)
+        control.send_command(CommandVals.Sleep, [True])
+        control.brightness(70)
+        control.send_command(CommandVals.Sleep, [False])
+        control.brightness(70)
+        wait_for(self.dev.path)
+        self.assertEqual(self.dev.state[CommandVals.Brightness][0], 70)
+
+    def test_reconnect(self):
+        state = control.device_state()
+        state.get_many([CommandVals.SetFps])
+        self.assertIsNotNone(state.cached(CommandVals.SetFps))
+        # Reconnecting forgets everything, the module may have been reset
+        control.SERIAL_POOL.close()
+        wait_for(self.dev.path)
+        self.assertIsNone(state.cached(CommandVals.SetFps))
+
+
+class TestSnake(unittest.TestCase):
+    """SnakeGame plays exactly like the previous snake"""
+
+    def test_same_games(self):
+        for seed in range(5):
+            ref = ReferenceSnake(random.Random(seed))
+            game = control.SnakeGame(rng=random.Random(seed))
+            while not ref.over:
+                ref.step(autopilot(ref))
+                game.simulate(1, autopilot)
+                self.assertEqual(ref.over, game.over, f"Seed {seed}")
+                if not ref.over:
+                    self.assertEqual(ref.fb.buf, game.fb.buf, f"Seed {seed}")
+            self.assertEqual(len(ref.body), game.score, f"Seed {seed}")
+
+
+class TestLife(DeviceTestCase):
+    """The bit-parallel Life runs like the firmware"""
+
+    def test_seeds(self):
+        seeds = [p for p in control.GameOfLifeStartParam if p != control.GameOfLifeStartParam.Currentmatrix]
+        for param in seeds:
+            for modules in [1, 2]:
+                ref = ReferenceLife(param, control.WIDTH * modules)
+                life = control.Life.seeded(param, modules)
+                for generation in range(40):
+                    self.assertTrue(ref.matches(life), f"{param} on {modules} modules: generation {generation}")
+                    ref.tick()
+                    life.step()
+
+    def test_shown(self):
+        life = control.Life.seeded(control.GameOfLifeStartParam.Glider)
+        life.run(7)
+        fb = control.Framebuffer()
+        fb.load(life.draw_vals())
+        fb.show()
+        wait_for(self.dev.path)
+        self.assertEqual([[bool(cell) for cell in col] for col in self.dev.grid],
+                         [[life.alive(x, y) for y in range(control.HEIGHT)] for x in range(control.WIDTH)])
+
+
+class TestAudio(DeviceTestCase):
+    """Equalizer levels of AudioSpectrum, and audio_eq on the module"""
+
+    def test_bands(self):
+        import numpy as np
+        spectrum = control.AudioSpectrum()
+        for band in range(control.WIDTH):
+            spectrum.ring.write(band_tone(spectrum, band, 0.5))
+            levels = spectrum.analyse()
+            self.assertEqual(np.argmax(levels), band)
+            # -6dB, a tenth of the dynamic range below full scale
+            self.assertAlmostEqual(levels[band], 0.9, delta=0.02)
+        spectrum.ring.write(np.zeros(spectrum.ring.size, dtype=np.float32))
+        self.assertFalse(spectrum.analyse().any())
+
+    def test_reference(self):
+        import numpy as np
+        spectrum = control.AudioSpectrum()
+        # Ring writes in chunks, like the audio comes in
+        noise = np.random.default_rng(0).standard_normal(spectrum.ring.size * 4).astype(np.float32) * 0.1
+        for i in range(0, len(noise), control.AUDIO_CHUNK):
+            spectrum.ring.write(noise[i:i + control.AUDIO_CHUNK])
+        np.testing.assert_array_equal(spectrum.ring.latest(), noise[-spectrum.ring.size:])
+        ref = reference_spectrum(spectrum.ring.latest(), spectrum.rate, control.WIDTH)
+        # The lowest bands are narrower than an FFT bin, AudioSpectrum widens them
+        np.testing.assert_allclose(spectrum.analyse()[4:], ref[4:], atol=1e-3)
+
+    def test_audio_eq(self):
+        import wave
+        # Half a second of a tone in the seventh band
+        tone = band_tone(control.AudioSpectrum(), 6, 0.5, seconds=0.5)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'tone.wav')
+            with wave.open(path, 'wb') as w:
+                w.setnchannels(1)
+                w.setsampwidth(2)
+                w.setframerate(control.AUDIO_RATE)
+                w.writeframes((tone * 32767).astype('<i2').tobytes())
+            control.audio_eq(path)
+        wait_for(self.dev.path)
+        heights = [sum(1 for level in col if level) for col in self.dev.grid]
+        self.assertEqual(max(range(control.WIDTH), key=lambda x: heights[x]), 6, heights)
+
+if __name__ == '__main__':
+    unittest.main()